@@ -0,0 +1,333 @@
+'''
+The mock open ai server file runs a local stand-in for the
+chat completions endpoint, so the grading pipeline can be
+exercised offline without spending real API money.
+
+It can add latency to every response, answer a share of
+the requests with HTTP 429 rate limit errors (with a
+retry-after header) to exercise our backoff logic, and
+answer another share with HTTP 500 server errors. Streamed
+requests are answered line by line as server-sent events.
+
+It also stands in for the Batch API (see
+openai_actions/batch_api.py): uploaded request files are kept
+in memory, and a batch job processes its request file in one
+go. The job reports itself as in progress until
+`batch_latency_seconds` have passed.
+
+Usage:
+    python -m benchmarks.mock_openai_server --port 8089 --rate-limit-rate 0.2
+
+Then set OPENAI_API_BASE in settings/settings.py to
+'http://127.0.0.1:8089/v1'.
+'''
+import argparse
+import email.parser
+import email.policy
+import json
+import logging
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    '''
+    Handles chat completion requests for the mock server.
+
+    The behavior is read from the server object: `latency_seconds`,
+    `rate_limit_rate`, `retry_after_seconds`, `error_rate`, `grade_text`,
+    `batch_latency_seconds` and `stream_chunk_seconds`.
+    '''
+
+    def do_POST(self):
+        '''
+        Answer a POST to /v1/chat/completions with a canned grade, a 429 or a 500,
+        and uploads to /v1/files and new jobs on /v1/batches.
+        '''
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        path = self.path.rstrip('/')
+        if path.endswith('/files'):
+            self._send_json(200, self.server.store_file(_read_multipart_file(self.headers['Content-Type'], data)))
+            return
+        if path.endswith('/batches'):
+            batch = self.server.create_batch(json.loads(data)['input_file_id'])
+            self._send_json(200 if batch else 404, batch or {'error': {'message': 'Unknown input file',
+                                                                        'type': 'invalid_request_error'}})
+            return
+
+        body = json.loads(data or b'{}')
+        if not path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+            return
+
+        self.server.record_request()
+        if random.random() < self.server.rate_limit_rate:
+            self.server.record_rate_limit()
+            self._send_json(429,
+                            {'error': {'message': 'Rate limit reached for requests. '
+                                                  f'Please try again in {self.server.retry_after_seconds}s.',
+                                       'type': 'requests',
+                                       'code': 'rate_limit_exceeded'}},
+                            headers={'Retry-After': str(self.server.retry_after_seconds)})
+            return
+
+        if random.random() < self.server.error_rate:
+            self.server.record_error()
+            self._send_json(500, {'error': {'message': 'The server had an error while processing your request.',
+                                            'type': 'server_error'}})
+            return
+
+        time.sleep(self.server.latency_seconds)
+        if body.get('stream'):
+            self._send_stream(self.server.complete(body))
+            return
+        self._send_json(200, self.server.complete(body))
+
+    def do_GET(self):
+        '''
+        Answer a GET of /v1/batches/<id> with the job, or of /v1/files/<id>/content with the file.
+        '''
+        parts = self.path.strip('/').split('/')
+        if len(parts) >= 3 and parts[-2] == 'batches':
+            batch = self.server.get_batch(parts[-1])
+            if batch:
+                self._send_json(200, batch)
+                return
+        elif len(parts) >= 4 and parts[-3] == 'files' and parts[-1] == 'content' and parts[-2] in self.server.files:
+            data = self.server.files[parts[-2]]
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        self._send_json(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, completion):
+        '''
+        Send a completion as server-sent events, one chunk per line of the grade text.
+        '''
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        chunk = {key: completion[key] for key in ('id', 'created', 'model')}
+        chunk['object'] = 'chat.completion.chunk'
+        # One chunk per line of every choice, choice after choice
+        deltas = [(choice['index'], delta) for choice in completion['choices']
+                  for delta in [{'role': 'assistant'}] + [{'content': line} for line in
+                                                         choice['message']['content'].splitlines(True)]]
+        try:
+            for index, delta in deltas:
+                event = dict(chunk, choices=[{'index': index, 'delta': delta, 'finish_reason': None}])
+                self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(self.server.stream_chunk_seconds)
+            for choice in completion['choices']:
+                event = dict(chunk, choices=[{'index': choice['index'], 'delta': {}, 'finish_reason': 'stop'}])
+                self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early
+            logging.debug('Mock OpenAI server: the client closed the stream early')
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug('Mock OpenAI server: ' + format, *args)
+
+
+def _read_multipart_file(content_type, data):
+    '''
+    Return the bytes of the "file" field of a multipart/form-data upload.
+    '''
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + data)
+    for part in message.iter_parts():
+        if part.get_param('name', header='content-disposition') == 'file':
+            return part.get_payload(decode=True)
+    return b''
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    '''
+    A threaded HTTP server that serves MockOpenAIHandler and counts what it answered.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, latency_seconds=0.0, rate_limit_rate=0.0, retry_after_seconds=1,
+                 error_rate=0.0, grade_text='Grade: 90/100\nGreat work.', batch_latency_seconds=0.0,
+                 stream_chunk_seconds=0.0):
+        super().__init__(address, MockOpenAIHandler)
+        self.latency_seconds = latency_seconds
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_seconds = retry_after_seconds
+        self.error_rate = error_rate
+        self.grade_text = grade_text
+        self.batch_latency_seconds = batch_latency_seconds
+        self.stream_chunk_seconds = stream_chunk_seconds
+        self.request_count = 0
+        self.rate_limit_count = 0
+        self.error_count = 0
+        self.batch_request_count = 0
+        self.files = {}
+        self.batches = {}
+        self._count_lock = threading.Lock()
+
+    def complete(self, body):
+        '''
+        Build the chat completion response for a request body, with `n` choices when it asks for them.
+        '''
+        messages = body.get('messages', [])
+        choice_count = max(1, int(body.get('n') or 1))
+        prompt_tokens = sum(len(message.get('content') or '') for message in messages) // 4
+        completion_tokens = len(self.grade_text) // 4 * choice_count
+        return {
+            'id': f'chatcmpl-mock-{time.time_ns()}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'mock-model'),
+            'choices': [{'index': index,
+                         'message': {'role': 'assistant', 'content': self.grade_text},
+                         'finish_reason': 'stop'} for index in range(choice_count)],
+            'usage': {'prompt_tokens': prompt_tokens,
+                      'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def store_file(self, data):
+        '''
+        Keep an uploaded file and return its file object.
+        '''
+        with self._count_lock:
+            file_id = f'file-mock-{len(self.files) + 1}'
+            self.files[file_id] = data
+        return {'id': file_id, 'object': 'file', 'bytes': len(data), 'purpose': 'batch'}
+
+    def create_batch(self, input_file_id):
+        '''
+        Process every request in an uploaded request file and return the new batch job,
+        or None if the file is unknown. A share of the requests (error_rate) fails.
+        '''
+        if input_file_id not in self.files:
+            return None
+        output_lines = []
+        error_lines = []
+        for line in self.files[input_file_id].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            if random.random() < self.error_rate:
+                error_lines.append({'id': f'batch-req-{time.time_ns()}', 'custom_id': request['custom_id'],
+                                    'response': {'status_code': 500, 'body': {'error': {'message': 'Server error'}}},
+                                    'error': None})
+                continue
+            output_lines.append({'id': f'batch-req-{time.time_ns()}', 'custom_id': request['custom_id'],
+                                 'response': {'status_code': 200, 'body': self.complete(request['body'])},
+                                 'error': None})
+
+        with self._count_lock:
+            self.batch_request_count += len(output_lines) + len(error_lines)
+            batch_id = f'batch-mock-{len(self.batches) + 1}'
+        batch = {'id': batch_id, 'object': 'batch', 'status': 'in_progress', 'input_file_id': input_file_id,
+                 'created_at': time.time(), 'output_file_id': None, 'error_file_id': None,
+                 'request_counts': {'total': len(output_lines) + len(error_lines),
+                                    'completed': len(output_lines), 'failed': len(error_lines)}}
+        if output_lines:
+            batch['output_file_id'] = self.store_file(''.join(json.dumps(line) + '\n'
+                                                              for line in output_lines).encode('utf-8'))['id']
+        if error_lines:
+            batch['error_file_id'] = self.store_file(''.join(json.dumps(line) + '\n'
+                                                             for line in error_lines).encode('utf-8'))['id']
+        self.batches[batch_id] = batch
+        return self.get_batch(batch_id)
+
+    def get_batch(self, batch_id):
+        '''
+        Return a batch job as the API would show it now, or None if it is unknown.
+        '''
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+        if time.time() - batch['created_at'] < self.batch_latency_seconds:
+            return dict(batch, status='in_progress', output_file_id=None, error_file_id=None)
+        return dict(batch, status='completed')
+
+    @property
+    def api_base(self):
+        '''
+        The value to use for OPENAI_API_BASE to reach this server.
+        '''
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def record_request(self):
+        with self._count_lock:
+            self.request_count += 1
+
+    def record_rate_limit(self):
+        with self._count_lock:
+            self.rate_limit_count += 1
+
+    def record_error(self):
+        with self._count_lock:
+            self.error_count += 1
+
+
+def start_mock_server(host='127.0.0.1', port=0, **options):
+    '''
+    Start a mock open ai server on a background thread.
+
+    Parameters:
+    - host (str, optional): The interface to listen on. Defaults to localhost.
+    - port (int, optional): The port to listen on. Defaults to 0 (any free port).
+    - options: Passed on to MockOpenAIServer (latency_seconds, rate_limit_rate, ...).
+
+    Returns:
+    - MockOpenAIServer: The running server. Call `shutdown()` when done.
+    '''
+    server = MockOpenAIServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info('Mock OpenAI server listening on %s', server.api_base)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local mock of the OpenAI chat completions endpoint.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each response.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help='Share of requests (0-1) answered with HTTP 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After value sent with a 429.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of requests (0-1) answered with HTTP 500.')
+    parser.add_argument('--batch-latency', type=float, default=0.0,
+                        help='Seconds a batch job stays in progress.')
+    parser.add_argument('--stream-chunk-latency', type=float, default=0.0,
+                        help='Seconds between two chunks of a streamed response.')
+    args = parser.parse_args()
+
+    server = MockOpenAIServer((args.host, args.port), latency_seconds=args.latency,
+                              rate_limit_rate=args.rate_limit_rate, retry_after_seconds=args.retry_after,
+                              error_rate=args.error_rate, batch_latency_seconds=args.batch_latency,
+                              stream_chunk_seconds=args.stream_chunk_latency)
+    print(f'Mock OpenAI server listening on {server.api_base}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
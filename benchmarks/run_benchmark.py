@@ -0,0 +1,177 @@
+'''
+The run benchmark file measures the throughput of the grading
+pipeline offline. It generates a synthetic classroom, runs
+grade_assignments end to end against the local mock OpenAI
+server and emails the results to the local SMTP sink, so no
+real API money is spent.
+
+It reports students per second, the peak Python memory
+(tracemalloc) and the per-stage timings from the run metrics
+(see general_functions/instrumentation.py), so regressions in
+the pipeline show up before production.
+
+Usage:
+    python -m benchmarks.run_benchmark --students 200 --files 3 --file-bytes 4000 --latency 0.2 --rate-limit-rate 0.05 --workers 8
+
+Add --json report.json to keep the report for comparing runs.
+'''
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+from benchmarks import mock_openai_server, smtp_sink, synthetic_classroom
+from email_functions import email_delivery as email
+from file_actions import file_actions
+from general_functions import general_functions, instrumentation
+from openai_actions import open_ai_api_calls, usage_ledger
+from settings import settings
+
+# The settings pointed at the local SMTP sink for the duration of a benchmark
+_SMTP_SETTINGS = ('SMTP_SERVER', 'SMTP_PORT', 'SMTP_USE_STARTTLS')
+
+
+def run_benchmark(students=50, files_per_student=2, file_bytes=2000, extensions=('.txt',), empty_rate=0.0,
+                  latency_seconds=0.1, rate_limit_rate=0.0, retry_after_seconds=1, error_rate=0.0,
+                  workers=settings.MAX_GRADING_WORKERS, model_name='gpt-3.5-turbo-16k', send_email=True,
+                  seed=0, use_batch_api=False, stream=False):
+    '''
+    Grade a synthetic classroom against the local fakes and measure the run.
+
+    Parameters:
+    - students, files_per_student, file_bytes, extensions, empty_rate, seed: The shape of the
+      synthetic classroom (see synthetic_classroom.generate_classroom).
+    - latency_seconds, rate_limit_rate, retry_after_seconds, error_rate: The behavior of the
+      mock OpenAI server.
+    - workers (int, optional): Number of students graded at the same time.
+    - model_name (str, optional): The model to grade with. Its rate limits from
+      settings.MODEL_RATE_LIMITS apply, as in production.
+    - send_email (bool, optional): Email the results to the SMTP sink.
+    - use_batch_api (bool, optional): Grade the classroom as one batch job on the mock server.
+    - stream (bool, optional): Grade the classroom with the memory bounded pipeline.
+
+    Returns:
+    - dict: The report: the run metrics summary (stages, counters, students per minute)
+      plus the benchmark settings, students per second, peak memory and what the fakes saw.
+
+    The classroom is graded with resume and the response cache turned off, so every
+    student goes through the full pipeline.
+    '''
+    general_functions.set_interactive(False)
+    api_server = mock_openai_server.start_mock_server(latency_seconds=latency_seconds,
+                                                      rate_limit_rate=rate_limit_rate,
+                                                      retry_after_seconds=retry_after_seconds,
+                                                      error_rate=error_rate)
+    sink = smtp_sink.start_smtp_sink()
+    original_api = (open_ai_api_calls.openai.api_base, open_ai_api_calls.openai.api_key)
+    original_smtp = {name: getattr(settings, name) for name in _SMTP_SETTINGS}
+    open_ai_api_calls.openai.api_base = api_server.api_base
+    open_ai_api_calls.openai.api_key = original_api[1] or 'mock-key'
+    settings.SMTP_SERVER, settings.SMTP_PORT, settings.SMTP_USE_STARTTLS = '127.0.0.1', sink.server_address[1], False
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='grading_benchmark_') as work_folder:
+            assignments_folder = os.path.join(work_folder, 'classroom')
+            total_bytes = synthetic_classroom.generate_classroom(assignments_folder, students, files_per_student,
+                                                                 file_bytes, list(extensions), empty_rate, seed)
+            results_path = os.path.join(work_folder, 'results', 'grading_results.txt')
+
+            instrumentation.start_run()
+            # The mock server's requests go to a scratch ledger, not the real day's spending
+            usage_ledger.start_run(os.path.join(work_folder, 'usage_ledger.sqlite3'))
+            tracemalloc.start()
+            started_at = time.perf_counter()
+            student_records = file_actions.grade_assignments(assignments_folder, 'Grade the assignment out of 100.',
+                                                             list(extensions), resume=False, max_workers=workers,
+                                                             use_cache=False, model_name=model_name,
+                                                             results_path=results_path,
+                                                             use_batch_api=use_batch_api, stream=stream)
+            if send_email and student_records is not None:
+                grading_results, attachment_path = file_actions.get_results_email(results_path)
+                email.send_email_to_user(grading_results, attachment_path=attachment_path)
+            elapsed_seconds = time.perf_counter() - started_at
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        api_server.shutdown()
+        sink.shutdown()
+        open_ai_api_calls.openai.api_base, open_ai_api_calls.openai.api_key = original_api
+        usage_ledger.start_run(settings.USAGE_LEDGER_PATH)
+        for name, value in original_smtp.items():
+            setattr(settings, name, value)
+
+    statuses = {}
+    for record in (student_records or {}).values():
+        statuses[record['status']] = statuses.get(record['status'], 0) + 1
+
+    report = instrumentation.get_run_metrics().summary()
+    report.update({
+        'benchmark': {'students': students, 'files_per_student': files_per_student, 'file_bytes': file_bytes,
+                      'extensions': list(extensions), 'empty_rate': empty_rate, 'latency_seconds': latency_seconds,
+                      'rate_limit_rate': rate_limit_rate, 'error_rate': error_rate, 'workers': workers,
+                      'model': model_name, 'seed': seed, 'batch_api': use_batch_api,
+                      'stream': stream},
+        'input_bytes': total_bytes,
+        'elapsed_seconds': round(elapsed_seconds, 3),
+        'students_per_second': round(students / elapsed_seconds, 2) if elapsed_seconds > 0 else None,
+        'peak_memory_bytes': peak_bytes,
+        'statuses': statuses,
+        'mock_server': {'requests': api_server.request_count, 'rate_limited': api_server.rate_limit_count,
+                        'errors': api_server.error_count, 'batch_requests': api_server.batch_request_count},
+        'emails_delivered': len(sink.messages),
+    })
+    return report
+
+
+def format_report(report):
+    '''
+    Format a benchmark report as a short plain text table.
+    '''
+    lines = [
+        f"{report['benchmark']['students']} students in {report['elapsed_seconds']}s: "
+        f"{report['students_per_second']} students/sec, peak memory {report['peak_memory_bytes'] / 1024 / 1024:.1f} MiB",
+        f"Statuses: {report['statuses']}",
+        f"Mock server: {report['mock_server']}, emails delivered: {report['emails_delivered']}",
+        f"{'stage':<16}{'count':>7}{'total s':>10}{'p50 s':>9}{'p95 s':>9}{'max s':>9}",
+    ]
+    for stage_name, stage in report['stages'].items():
+        lines.append(f"{stage_name:<16}{stage['count']:>7}{stage['total_seconds']:>10.3f}"
+                     f"{stage['p50_seconds']:>9.4f}{stage['p95_seconds']:>9.4f}{stage['max_seconds']:>9.4f}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the grading pipeline offline.')
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--files', type=int, default=2, help='Files per student.')
+    parser.add_argument('--file-bytes', type=int, default=2000, help='Approximate size of every file.')
+    parser.add_argument('--extensions', nargs='+', default=['.txt'])
+    parser.add_argument('--empty-rate', type=float, default=0.0, help='Share of students (0-1) with an empty folder.')
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds the mock server waits before each response.')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Share of requests (0-1) answered with HTTP 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After value sent with a 429.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests (0-1) answered with HTTP 500.')
+    parser.add_argument('--workers', type=int, default=settings.MAX_GRADING_WORKERS)
+    parser.add_argument('--model', default='gpt-3.5-turbo-16k')
+    parser.add_argument('--no-email', action='store_true', help='Do not email the results to the SMTP sink.')
+    parser.add_argument('--batch-api', action='store_true', help='Grade the classroom as one batch job.')
+    parser.add_argument('--stream', action='store_true', help='Grade with the memory bounded pipeline.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='Also write the report to this JSON file.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(levelname)s:%(message)s')
+    report = run_benchmark(args.students, args.files, args.file_bytes, args.extensions, args.empty_rate,
+                           args.latency, args.rate_limit_rate, args.retry_after, args.error_rate,
+                           args.workers, args.model, not args.no_email, args.seed, args.batch_api,
+                           args.stream)
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
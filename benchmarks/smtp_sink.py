@@ -0,0 +1,148 @@
+'''
+The smtp sink file runs a minimal local SMTP server that
+accepts and keeps every message, so email delivery can be
+tested offline (like aiosmtpd or the old smtpd debugging
+server, without the extra dependency).
+
+It can also answer the first few messages with a transient
+451 error to exercise our retry and backoff logic.
+
+Usage:
+    python -m benchmarks.smtp_sink --port 8025
+
+Then set SMTP_SERVER = 'localhost', SMTP_PORT = 8025 and
+SMTP_USE_STARTTLS = False in settings/settings.py.
+'''
+import argparse
+import logging
+import socketserver
+import threading
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    '''
+    Speaks just enough SMTP to accept messages from smtplib.
+    '''
+
+    def handle(self):
+        self.server.record_connection()
+        self._reply('220 localhost SMTP sink ready')
+        mail_from, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb == 'EHLO':
+                self._reply('250-localhost', '250-PIPELINING', '250 AUTH PLAIN LOGIN')
+            elif verb == 'HELO':
+                self._reply('250 localhost')
+            elif verb == 'AUTH':
+                self._reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                mail_from, recipients = command[10:].strip(), []
+                self._reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[8:].strip())
+                self._reply('250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self._read_data()
+                if self.server.take_transient_failure():
+                    self._reply('451 Temporary failure, try again later')
+                else:
+                    self.server.record_message(mail_from, recipients, data)
+                    self._reply('250 OK: queued')
+            elif verb in ('RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+    def _read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line or line in (b'.\r\n', b'.\n'):
+                return b''.join(lines).decode('utf-8', 'replace')
+            lines.append(line[1:] if line.startswith(b'..') else line)
+
+    def _reply(self, *lines):
+        self.wfile.write(''.join(f'{line}\r\n' for line in lines).encode('utf-8'))
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    '''
+    A threaded SMTP server that keeps every accepted message in `messages`.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, transient_failures=0):
+        super().__init__(address, SMTPSinkHandler)
+        self.messages = []
+        self.connection_count = 0
+        self._transient_failures = transient_failures
+        self._lock = threading.Lock()
+
+    def record_connection(self):
+        with self._lock:
+            self.connection_count += 1
+
+    def record_message(self, mail_from, recipients, data):
+        with self._lock:
+            self.messages.append({'from': mail_from, 'to': recipients, 'data': data})
+        logging.debug('SMTP sink accepted a message for %s', recipients)
+
+    def take_transient_failure(self):
+        with self._lock:
+            if self._transient_failures > 0:
+                self._transient_failures -= 1
+                return True
+            return False
+
+
+def start_smtp_sink(host='127.0.0.1', port=0, transient_failures=0):
+    '''
+    Start an SMTP sink on a background thread.
+
+    Parameters:
+    - host (str, optional): The interface to listen on. Defaults to localhost.
+    - port (int, optional): The port to listen on. Defaults to 0 (any free port).
+    - transient_failures (int, optional): How many messages to answer with a 451 first.
+
+    Returns:
+    - SMTPSink: The running server. Its port is `server_address[1]`. Call `shutdown()` when done.
+    '''
+    server = SMTPSink((host, port), transient_failures)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local SMTP server that accepts and prints every message.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    args = parser.parse_args()
+
+    server = SMTPSink((args.host, args.port))
+    print(f'SMTP sink listening on {args.host}:{args.port}')
+    original_record = server.record_message
+
+    def print_message(mail_from, recipients, data):
+        original_record(mail_from, recipients, data)
+        print(f'---------- MESSAGE FROM {mail_from} TO {", ".join(recipients)} ----------\n{data}')
+
+    server.record_message = print_message
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+'''
+The startup benchmark file measures how long the grading bot
+takes to start, and guards the fast startup path: importing
+main.py, and re-running a class whose students are all resumed
+or served from the response cache, must not load the network
+stack (the openai package, requests, tiktoken, smtplib), tkinter
+or settings/app_secrets.py.
+
+Every measurement runs in a fresh Python process, so nothing
+is already imported. The class is first graded once against the
+local mock OpenAI server, then graded again twice, resumed and
+with --no-resume (so every grade comes from the response cache),
+both with --no-email.
+
+Usage:
+    python -m benchmarks.startup_benchmark --repeats 5 --students 20
+
+It exits with status 1 when a guarded module was loaded, or when
+importing main.py took longer than --max-import-ms.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from benchmarks import mock_openai_server, synthetic_classroom
+
+# Modules a start or a run without any request or email must not load
+GUARDED_MODULES = ('openai', 'requests', 'tiktoken', 'smtplib', 'tkinter', 'settings.app_secrets')
+
+_REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child process: argv[1] is the mock API base (or ''), the rest are main.py arguments
+_PROBE = '''
+import json, sys, time
+started_at = time.perf_counter()
+import main
+import_seconds = time.perf_counter() - started_at
+exit_code = 0
+if len(sys.argv) > 2:
+    if sys.argv[1]:
+        from openai_actions import open_ai_api_calls
+        open_ai_api_calls.openai.api_base, open_ai_api_calls.openai.api_key = sys.argv[1], 'mock-key'
+    exit_code = main.run_headless(main.parse_arguments(sys.argv[2:]))
+print(json.dumps({'import_seconds': import_seconds, 'run_seconds': time.perf_counter() - started_at,
+                  'exit_code': exit_code, 'loaded': sorted(name for name in %r if name in sys.modules)}))
+''' % (GUARDED_MODULES,)
+
+
+def run_probe(work_folder, api_base='', main_arguments=()):
+    '''
+    Import main.py in a fresh Python process, and optionally run a headless grading.
+
+    Parameters:
+    - work_folder (str): The working directory of the process. The response cache and
+                         other relative paths from settings end up in it.
+    - api_base (str, optional): The mock OpenAI server to grade against.
+    - main_arguments (tuple, optional): Arguments for main.py. Only the import is
+                                        measured when there are none.
+
+    Returns:
+    - dict: import_seconds, run_seconds, exit_code and the guarded modules that were `loaded`.
+    '''
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [_REPOSITORY_FOLDER, environment.get('PYTHONPATH')]))
+    completed = subprocess.run([sys.executable, '-c', _PROBE, api_base, *main_arguments], cwd=work_folder,
+                               env=environment, capture_output=True, text=True, check=False)
+    if completed.returncode != 0 or not completed.stdout.strip():
+        raise RuntimeError(f'The startup probe failed: {completed.stderr.strip()[-2000:]}')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_startup_benchmark(repeats=5, students=20, files_per_student=2, file_bytes=2000):
+    '''
+    Measure the import time of main.py and check which modules the cached runs load.
+
+    Parameters:
+    - repeats (int, optional): Number of fresh processes timing the import of main.py.
+    - students, files_per_student, file_bytes: The shape of the synthetic classroom
+      (see synthetic_classroom.generate_classroom).
+
+    Returns:
+    - dict: The report: the import time (median, min, max in milliseconds) and the
+            guarded modules loaded by the import, and per run (`first`, `resumed`,
+            `cached`) its wall time, exit code and loaded guarded modules.
+    '''
+    api_server = mock_openai_server.start_mock_server(latency_seconds=0.01)
+    try:
+        with tempfile.TemporaryDirectory(prefix='grading_startup_') as work_folder:
+            imports = [run_probe(work_folder) for _ in range(max(1, repeats))]
+            import_milliseconds = [probe['import_seconds'] * 1000 for probe in imports]
+
+            assignments_folder = os.path.join(work_folder, 'classroom')
+            synthetic_classroom.generate_classroom(assignments_folder, students, files_per_student, file_bytes,
+                                                   ['.txt'], 0.0, 0)
+            criteria_path = os.path.join(work_folder, 'criteria.txt')
+            with open(criteria_path, 'w', encoding='utf-8') as criteria_file:
+                criteria_file.write('Grade the assignment out of 100.')
+            arguments = ('--folder', assignments_folder, '--criteria', criteria_path, '--no-email',
+                         '--backend', 'openai', '--model', 'gpt-3.5-turbo-16k',
+                         '--output', os.path.join(work_folder, 'results', 'grading_results.txt'))
+
+            runs = {'first': run_probe(work_folder, api_server.api_base, arguments),
+                    'resumed': run_probe(work_folder, '', arguments),
+                    'cached': run_probe(work_folder, '', arguments + ('--no-resume',))}
+    finally:
+        api_server.shutdown()
+
+    return {
+        'import': {'repeats': len(imports),
+                   'median_ms': round(statistics.median(import_milliseconds), 1),
+                   'min_ms': round(min(import_milliseconds), 1),
+                   'max_ms': round(max(import_milliseconds), 1),
+                   'loaded': sorted({name for probe in imports for name in probe['loaded']})},
+        'runs': {name: {'seconds': round(probe['run_seconds'], 3), 'exit_code': probe['exit_code'],
+                        'loaded': probe['loaded']} for name, probe in runs.items()},
+        'students': students,
+    }
+
+
+def find_violations(report, max_import_ms=None):
+    '''
+    List what breaks the fast startup path in a report of run_startup_benchmark.
+
+    Parameters:
+    - report (dict): The benchmark report.
+    - max_import_ms (float, optional): The longest acceptable median import time of main.py.
+
+    Returns:
+    - list: One message per problem; empty when the startup path is intact.
+    '''
+    violations = []
+    if report['import']['loaded']:
+        violations.append(f"Importing main.py loads {', '.join(report['import']['loaded'])}")
+    if max_import_ms is not None and report['import']['median_ms'] > max_import_ms:
+        violations.append(f"Importing main.py takes {report['import']['median_ms']} ms (limit {max_import_ms} ms)")
+    for name, run in report['runs'].items():
+        if run['exit_code'] != 0:
+            violations.append(f'The {name} run failed with exit code {run["exit_code"]}')
+        elif name != 'first' and run['loaded']:
+            violations.append(f"The {name} run loads {', '.join(run['loaded'])}")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure and guard the startup time of the grading bot.')
+    parser.add_argument('--repeats', type=int, default=5, help='Fresh processes timing the import of main.py.')
+    parser.add_argument('--students', type=int, default=20)
+    parser.add_argument('--files', type=int, default=2, help='Files per student.')
+    parser.add_argument('--file-bytes', type=int, default=2000)
+    parser.add_argument('--max-import-ms', type=float, help='Fail when importing main.py takes longer.')
+    parser.add_argument('--json', help='Also write the report to this JSON file.')
+    args = parser.parse_args()
+
+    report = run_startup_benchmark(args.repeats, args.students, args.files, args.file_bytes)
+    print(f"import main: median {report['import']['median_ms']} ms "
+          f"(min {report['import']['min_ms']}, max {report['import']['max_ms']}, {report['import']['repeats']} runs)")
+    for name, run in report['runs'].items():
+        print(f"{name:<8} run of {report['students']} students: {run['seconds']}s, exit code {run['exit_code']}, "
+              f"loaded: {', '.join(run['loaded']) or 'none of the guarded modules'}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+    violations = find_violations(report, args.max_import_ms)
+    for violation in violations:
+        print(violation, file=sys.stderr)
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == '__main__':
+    main()
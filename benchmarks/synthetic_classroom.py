@@ -0,0 +1,87 @@
+'''
+The synthetic classroom file generates fake assignment trees
+(one sub folder per student) to benchmark the grading pipeline
+without real student data.
+
+The number of students, files per student, file sizes and
+extensions are configurable, and a share of the students can be
+left with an empty folder. The same seed always generates the
+same classroom.
+
+Usage:
+    python -m benchmarks.synthetic_classroom ./classroom --students 200 --files 3 --file-bytes 4000 --extensions .py .txt
+'''
+import argparse
+import os
+import random
+
+_WORDS = ('def', 'return', 'for', 'while', 'if', 'else', 'print', 'student', 'answer', 'result',
+          'value', 'list', 'total', 'count', 'loop', 'the', 'and', 'because', 'function', 'class')
+
+
+def generate_classroom(root_folder, students=30, files_per_student=2, file_bytes=2000,
+                       extensions=('.txt',), empty_rate=0.0, seed=0):
+    '''
+    Write a synthetic assignments folder.
+
+    Parameters:
+    - root_folder (str): The assignments folder to create. Student folders are added to it.
+    - students (int, optional): Number of student folders.
+    - files_per_student (int, optional): Number of files in every student folder.
+    - file_bytes (int, optional): Approximate size of every file in bytes.
+    - extensions (list, optional): File extensions, used round robin for each student's files.
+    - empty_rate (float, optional): Share of students (0-1) whose folder is left empty.
+    - seed (int, optional): Seed for the random content.
+
+    Returns:
+    - int: The total number of bytes written.
+    '''
+    rng = random.Random(seed)
+    total_bytes = 0
+    for student_index in range(students):
+        student_folder = os.path.join(root_folder, f'student_{student_index:04d}')
+        os.makedirs(student_folder, exist_ok=True)
+        if rng.random() < empty_rate:
+            continue
+
+        for file_index in range(files_per_student):
+            extension = extensions[file_index % len(extensions)]
+            content = _random_text(rng, file_bytes)
+            file_path = os.path.join(student_folder, f'assignment_{file_index}{extension}')
+            with open(file_path, 'w', encoding='utf-8') as file:
+                file.write(content)
+            total_bytes += len(content)
+    return total_bytes
+
+
+def _random_text(rng, size):
+    '''
+    Random lines of words, about `size` characters long.
+    '''
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(4, 12)))
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic assignments folder for benchmarking.')
+    parser.add_argument('folder', help='The assignments folder to create.')
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--files', type=int, default=2, help='Files per student.')
+    parser.add_argument('--file-bytes', type=int, default=2000, help='Approximate size of every file.')
+    parser.add_argument('--extensions', nargs='+', default=['.txt'])
+    parser.add_argument('--empty-rate', type=float, default=0.0, help='Share of students (0-1) with an empty folder.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    total_bytes = generate_classroom(args.folder, args.students, args.files, args.file_bytes,
+                                     args.extensions, args.empty_rate, args.seed)
+    print(f'Wrote {args.students} students ({total_bytes} bytes) to {args.folder}')
+
+
+if __name__ == "__main__":
+    main()
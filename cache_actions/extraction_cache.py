@@ -0,0 +1,108 @@
+'''
+The extraction cache file keeps the text converted from binary
+submissions (spreadsheets, documents, PDFs and notebooks) in a
+SQLite database, so a re-run does not parse the same files again.
+
+Entries are keyed on a hash of the file's bytes and the version
+of the converter, so a changed file or an improved converter is
+converted again. Entries are evicted by age and by count, like
+the response cache.
+'''
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from settings import settings
+
+
+def _connect(cache_path):
+    directory = os.path.dirname(cache_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('''CREATE TABLE IF NOT EXISTS extracted_texts (
+                              cache_key TEXT PRIMARY KEY,
+                              text TEXT NOT NULL,
+                              created_at REAL NOT NULL,
+                              accessed_at REAL NOT NULL)''')
+    return connection
+
+
+def get_cached_texts(cache_keys, cache_path=settings.EXTRACTION_CACHE_PATH):
+    '''
+    Look up the converted text of many files at once.
+
+    Parameters:
+    - cache_keys (iterable): The keys of the files (see document_extraction.make_cache_key).
+    - cache_path (str, optional): The SQLite file holding the cache.
+
+    Returns:
+    - dict: cache_key -> text for every key in the cache. Missing keys are left out, and
+            nothing is returned if the cache cannot be read.
+    '''
+    cache_keys = list(cache_keys)
+    texts = {}
+    try:
+        with closing(_connect(cache_path)) as connection, connection:
+            # SQLite limits the number of parameters of one statement
+            for start in range(0, len(cache_keys), 500):
+                chunk = cache_keys[start:start + 500]
+                placeholders = ', '.join('?' * len(chunk))
+                texts.update(connection.execute(f'SELECT cache_key, text FROM extracted_texts '
+                                                f'WHERE cache_key IN ({placeholders})', chunk))
+                connection.execute(f'UPDATE extracted_texts SET accessed_at = ? WHERE cache_key IN ({placeholders})',
+                                   [time.time()] + chunk)
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while reading the extraction cache: {ex}')
+        return {}
+    return texts
+
+
+def store_text(cache_key, text, cache_path=settings.EXTRACTION_CACHE_PATH):
+    '''
+    Save the converted text of a file in the cache.
+
+    Parameters:
+    - cache_key (str): The key of the file.
+    - text (str): The converted text.
+    - cache_path (str, optional): The SQLite file holding the cache.
+    '''
+    try:
+        now = time.time()
+        with closing(_connect(cache_path)) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO extracted_texts VALUES (?, ?, ?, ?)',
+                               (cache_key, text, now, now))
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while writing to the extraction cache: {ex}')
+
+
+def prune_cache(max_entries=settings.EXTRACTION_CACHE_MAX_ENTRIES,
+                max_age_days=settings.EXTRACTION_CACHE_MAX_AGE_DAYS,
+                cache_path=settings.EXTRACTION_CACHE_PATH):
+    '''
+    Evict expired entries, then the least recently used ones above the size limit.
+
+    Parameters:
+    - max_entries (int, optional): The maximum number of converted files to keep.
+    - max_age_days (float, optional): Entries older than this are removed.
+    - cache_path (str, optional): The SQLite file holding the cache.
+
+    Returns:
+    - int: The number of evicted entries.
+    '''
+    try:
+        with closing(_connect(cache_path)) as connection, connection:
+            expired = connection.execute('DELETE FROM extracted_texts WHERE created_at < ?',
+                                         (time.time() - max_age_days * 86400,)).rowcount
+            overflow = connection.execute('''DELETE FROM extracted_texts WHERE cache_key NOT IN (
+                                                 SELECT cache_key FROM extracted_texts
+                                                 ORDER BY accessed_at DESC LIMIT ?)''',
+                                          (max_entries,)).rowcount
+        if expired or overflow:
+            logging.info('Evicted %s expired and %s least recently used converted files', expired, overflow)
+        return expired + overflow
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while pruning the extraction cache: {ex}')
+        return 0
@@ -0,0 +1,127 @@
+'''
+The response cache file keeps a persistent, content-addressed
+cache of grading responses in a SQLite database, so unchanged
+submissions are not sent to open ai again when a section is
+re-run.
+
+Entries are keyed on a hash of the model, the grading criteria
+hash and the submission content, and are evicted by age and by count.
+'''
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+from settings import settings
+
+
+def make_cache_key(model_name, criteria_hash, assignment_content):
+    '''
+    Build the cache key for one grading request.
+
+    Parameters:
+    - model_name (str): The model the submission is graded with.
+    - criteria_hash (str): The hash of the grading criteria, computed once per run
+                           (see general_functions.build_criteria_prefix).
+    - assignment_content (str): The combined submission content for the student.
+
+    Returns:
+    - str: A SHA-256 hex digest identifying the request.
+    '''
+    digest = hashlib.sha256()
+    for part in (model_name, criteria_hash, assignment_content):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _connect(cache_path):
+    directory = os.path.dirname(cache_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+                              cache_key TEXT PRIMARY KEY,
+                              model_name TEXT NOT NULL,
+                              response TEXT NOT NULL,
+                              created_at REAL NOT NULL,
+                              accessed_at REAL NOT NULL)''')
+    return connection
+
+
+def get_cached_response(cache_key, cache_path=settings.RESPONSE_CACHE_PATH):
+    '''
+    Look up a cached grading response.
+
+    Parameters:
+    - cache_key (str): The key built by make_cache_key.
+    - cache_path (str, optional): The SQLite file holding the cache.
+
+    Returns:
+    - str or None: The cached response, or None if it is missing, expired or the cache cannot be read.
+    '''
+    try:
+        oldest_allowed = time.time() - settings.RESPONSE_CACHE_MAX_AGE_DAYS * 86400
+        with closing(_connect(cache_path)) as connection, connection:
+            row = connection.execute('SELECT response FROM responses WHERE cache_key = ? AND created_at >= ?',
+                                     (cache_key, oldest_allowed)).fetchone()
+            if row is None:
+                return None
+            connection.execute('UPDATE responses SET accessed_at = ? WHERE cache_key = ?', (time.time(), cache_key))
+            return row[0]
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while reading the response cache: {ex}')
+        return None
+
+
+def store_response(cache_key, model_name, response, cache_path=settings.RESPONSE_CACHE_PATH):
+    '''
+    Save a grading response in the cache. Empty responses are not cached.
+
+    Parameters:
+    - cache_key (str): The key built by make_cache_key.
+    - model_name (str): The model the submission was graded with.
+    - response (str): The grading response to cache.
+    - cache_path (str, optional): The SQLite file holding the cache.
+    '''
+    if not response:
+        return
+    try:
+        now = time.time()
+        with closing(_connect(cache_path)) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                               (cache_key, model_name, response, now, now))
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while writing to the response cache: {ex}')
+
+
+def prune_cache(max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+                max_age_days=settings.RESPONSE_CACHE_MAX_AGE_DAYS,
+                cache_path=settings.RESPONSE_CACHE_PATH):
+    '''
+    Evict expired entries, then the least recently used ones above the size limit.
+
+    Parameters:
+    - max_entries (int, optional): The maximum number of responses to keep.
+    - max_age_days (float, optional): Responses older than this are removed.
+    - cache_path (str, optional): The SQLite file holding the cache.
+
+    Returns:
+    - int: The number of evicted entries.
+    '''
+    try:
+        with closing(_connect(cache_path)) as connection, connection:
+            expired = connection.execute('DELETE FROM responses WHERE created_at < ?',
+                                         (time.time() - max_age_days * 86400,)).rowcount
+            overflow = connection.execute('''DELETE FROM responses WHERE cache_key NOT IN (
+                                                 SELECT cache_key FROM responses
+                                                 ORDER BY accessed_at DESC LIMIT ?)''',
+                                          (max_entries,)).rowcount
+        if expired or overflow:
+            logging.info('Evicted %s expired and %s least recently used cached responses', expired, overflow)
+        return expired + overflow
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while pruning the response cache: {ex}')
+        return 0
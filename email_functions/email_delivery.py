@@ -4,33 +4,55 @@ Email Communication Module
 This module provides functionalities related to sending emails to users.
 It encapsulates the SMTP logic and provides a cleaner interface for email communication.
 
+Authenticated SMTP connections are pooled and reused across messages, so sending many
+reports (e.g. one per section in batch mode) only pays for the STARTTLS and login
+handshake once per connection. Dropped connections are re-established in place, and
+transient errors are retried with exponential backoff.
+
+smtplib and email.mime are imported by the first email, so runs that send none
+never load them.
+
+A report can be attached to an email (e.g. the compressed report of a large class),
+so the message body stays short however many students were graded.
+
 Dependencies:
-- email.mime.text: To construct MIME text messages.
+- email.mime: To construct MIME text messages and their attachments.
+- os: To name attachments after their file.
 - smtplib: To handle SMTP communication.
 - time: To introduce delays for retries.
+- random: To add jitter to the retry delays.
 - socket: To handle socket-related errors.
 - logging: To log application events and errors.
+- queue, threading, atexit: To share a pool of SMTP connections between threads.
+- general_functions.instrumentation: To time the email stage of a run.
 - settings.settings: To access application-specific settings.
 """
 
-from email.mime.text import MIMEText
-import smtplib
+import atexit
+import os
+import queue
+import random
+import threading
 import time
 import socket
 import logging
+from contextlib import contextmanager
+from general_functions import instrumentation
 from settings import settings
 
 
-def send_email_to_user(message):
+def send_email_to_user(message, recipient=None, subject=None, attachment_path=None):
     '''
     Sends an email with the given message to multiple users.
 
     Parameters:
-    - email_addresses (dict): A dictionary where keys are email addresses and values are user names.
     - message (str): The message content to be sent to the users.
+    - recipient (str, optional): The address to send to. Defaults to settings.RESULTS_EMAIL.
+    - subject (str, optional): The email subject. Defaults to "<first name>, your grading is done!".
+    - attachment_path (str, optional): A file to attach to the email.
+
+    Uses the sender's email from settings.SENDER_EMAIL, over a pooled SMTP connection.
 
-    Uses the sender's email from settings.SENDER_EMAIL.
-    
     Raises:
     - smtplib.SMTPException: If there's an error during the SMTP communication.
     - socket.gaierror: If there's a socket-related error.
@@ -38,60 +60,107 @@ def send_email_to_user(message):
     Note:
     - Logging is done for informational and error scenarios.
     '''
-    logging.info(f'Sending our grading results to {settings.RESULTS_EMAIL}')
+    send_emails_to_users([(message, recipient, subject, attachment_path)])
+
+
+def send_emails_to_users(reports):
+    '''
+    Sends a batch of emails over a single pooled SMTP connection.
+
+    Parameters:
+    - reports (list): (message, recipient, subject) tuples, optionally followed by the path
+      of a file to attach. recipient and subject may be None to use the defaults of send_email.
+
+    Returns:
+    - int: The number of emails that were delivered.
+
+    Note:
+    - Errors are logged; a failed email does not stop the rest of the batch.
+    '''
+    import smtplib
+
+    delivered = 0
     try:
-        username = settings.SENDER_EMAIL
-        smtp_connection = create_smtp_connection(username)
-        send_email(smtp_connection, message)
-        close_smtp_connection(smtp_connection)
+        with instrumentation.stage('email'), get_smtp_pool().connection() as smtp_connection:
+            for message, recipient, subject, *attachment_paths in reports:
+                logging.info(f'Sending our grading results to {recipient or settings.RESULTS_EMAIL}')
+                if send_email(smtp_connection, message, recipient=recipient, subject=subject,
+                              attachment_path=attachment_paths[0] if attachment_paths else None):
+                    delivered += 1
     except smtplib.SMTPException as _e:
         logging.error('An SMTP error occurred: %s', {_e})
-    except socket.gaierror as _e:
+    except (socket.gaierror, OSError) as _e:
         logging.error('A socket error occurred: %s', {_e})
+    return delivered
 
 
-def send_email(smtp_connection, message, max_retries: int = 3):
+def send_email(smtp_connection, message, max_retries: int = 3, recipient=None, subject=None, attachment_path=None):
     '''
-    Sends a snow day prediction email to a single recipient. If delivery fails, it will retry
+    Sends a grading results email to a single recipient. If delivery fails, it will retry
     up to the specified maximum number of retries.
 
     Parameters:
     - smtp_connection: The active SMTP connection object to use for sending the email.
     - message (str): The main content of the email.
-    - email (str): The recipient's email address.
-    - first_name (str): The recipient's first name for personalizing the email subject.
-    - username (str): The sender's email address.
-    - max_retries (int, optional): Maximum number of delivery retries if an SMTP exception 
+    - max_retries (int, optional): Maximum number of delivery retries if an SMTP exception
     occurs. Default is 3.
+    - recipient (str, optional): The recipient's email address. Defaults to settings.RESULTS_EMAIL.
+    - subject (str, optional): The email subject. Defaults to "<first name>, your grading is done!".
+    - attachment_path (str, optional): A file to attach to the email, under its own name.
+
+    Returns:
+    - bool: True if the message was delivered.
 
     Note:
     - If the delivery fails after the maximum number of retries, an error will be logged.
-    - On each failed delivery attempt, a warning will be logged and the function will wait 
-    for 2 seconds before retrying.
+    - On each failed delivery attempt, a warning will be logged and the function will wait
+    with an exponential backoff (settings.SMTP_BACKOFF_BASE_SECONDS, doubled on every retry,
+    plus jitter) before retrying. A dropped connection is re-established first.
     '''
-    recipient = f'{settings.RESULTS_EMAIL}'
+    import smtplib
+    from email.mime.text import MIMEText
+
+    recipient = recipient or f'{settings.RESULTS_EMAIL}'
     message = f'{message}\n\nBest,\nGrading Bot'
     msg = MIMEText(message)
+    if attachment_path:
+        from email.mime.application import MIMEApplication
+        from email.mime.multipart import MIMEMultipart
+
+        body, msg = msg, MIMEMultipart()
+        msg.attach(body)
+        with open(attachment_path, 'rb') as attachment_file:
+            attachment = MIMEApplication(attachment_file.read())
+        attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment_path))
+        msg.attach(attachment)
     msg['From'] = settings.SENDER_EMAIL
     msg['To'] = recipient
-    msg['Subject'] = f'{settings.FIRST_NAME}, your grading is done!'
+    msg['Subject'] = subject or f'{settings.FIRST_NAME}, your grading is done!'
     retries = 0
     while retries < max_retries:
         try:
-            smtp_connection.send_message(msg)
-            status = smtp_connection.noop()[0]
-            if status == 250:
+            refused = smtp_connection.send_message(msg)
+            if not refused:
                 logging.info('Message delivered to %s', recipient)
-                break
+                return True
 
             retries += 1
-            logging.warning('Delivery failed for %s. Retrying... (retry %s of %s)', recipient, retries, max_retries)
+            logging.warning('Delivery failed for %s (%s). Retrying... (retry %s of %s)', recipient, refused, retries, max_retries)
+        except smtplib.SMTPServerDisconnected as _e:
+            retries += 1
+            logging.warning('The SMTP connection was closed when delivering message to %s. Reconnecting... (retry %s of %s) (%s)', recipient, retries, max_retries, str(_e))
+            try:
+                reconnect_smtp_connection(smtp_connection)
+                continue
+            except (smtplib.SMTPException, OSError) as reconnect_error:
+                logging.warning('Reconnecting to the SMTP server failed: %s', reconnect_error)
         except smtplib.SMTPException as _e:
             retries += 1
             logging.warning('SMTPException occurred when delivering message to %s. Retrying... (retry %s of %s) (%s)',recipient, retries, max_retries, str(_e))
-            time.sleep(2)  # delay before retrying
-    if retries == max_retries:
-        logging.error('Delivery failed for %s after %s retries', recipient, max_retries)
+        if retries < max_retries:
+            time.sleep(settings.SMTP_BACKOFF_BASE_SECONDS * (2 ** (retries - 1)) * random.uniform(1, 1.5))  # delay before retrying
+    logging.error('Delivery failed for %s after %s retries', recipient, max_retries)
+    return False
 
 
 def create_smtp_connection(username):
@@ -107,17 +176,38 @@ def create_smtp_connection(username):
     Notes:
     - This function uses SMTP server settings (server address and port) from the settings module.
     - It also uses the sender's email password from the settings module for authentication.
-    - The function initiates a secure TLS connection with the server.
+    - The function initiates a secure TLS connection with the server, unless
+      settings.SMTP_USE_STARTTLS is turned off (e.g. for a local test server).
     - Designed primarily for Gmail servers, but can be adapted for other SMTP servers by updating the settings module.
     '''
+    import smtplib
+
     # Here we are going to login to our mail server
     # In this particular case, it's a gmail server hooked to the bots email
+    smtp_connection = smtplib.SMTP(timeout=settings.SMTP_TIMEOUT_SECONDS)
+    reconnect_smtp_connection(smtp_connection, username)
+    return smtp_connection
+
+
+def reconnect_smtp_connection(smtp_connection, username=None):
+    '''
+    (Re)connects an SMTP connection object to the server and authenticates it.
+
+    Parameters:
+    - smtp_connection (smtplib.SMTP): A connection created by create_smtp_connection.
+    - username (str, optional): The email address used for authentication. Defaults to
+      settings.SENDER_EMAIL.
+    '''
     smtp_server = settings.SMTP_SERVER
     smtp_port = settings.SMTP_PORT
-    smtp_connection = smtplib.SMTP(smtp_server, smtp_port)
-    smtp_connection.starttls()
-    smtp_connection.login(username, settings.SENDER_EMAIL_PASSWORD)
-    return smtp_connection
+    smtp_connection.close()
+    smtp_connection.connect(smtp_server, smtp_port)
+    # Refresh the server's capabilities, which are left over from the previous session on a reconnect
+    smtp_connection.ehlo()
+    if settings.SMTP_USE_STARTTLS:
+        smtp_connection.starttls()
+    if settings.SENDER_EMAIL_PASSWORD:
+        smtp_connection.login(username or settings.SENDER_EMAIL, settings.SENDER_EMAIL_PASSWORD)
 
 
 def close_smtp_connection(smtp_connection):
@@ -130,5 +220,71 @@ def close_smtp_connection(smtp_connection):
     Note:
     - The function calls the 'quit' method, which logs out and closes the connection gracefully.
     '''
+    import smtplib
+
     # Close the SMTP connection
-    smtp_connection.quit()
+    try:
+        smtp_connection.quit()
+    except (smtplib.SMTPException, OSError):
+        smtp_connection.close()
+
+
+class SMTPConnectionPool:
+    '''
+    A thread safe pool of authenticated SMTP connections.
+
+    Connections are created on demand, up to `size` at a time, and handed back to
+    the pool after each use instead of being closed.
+    '''
+
+    def __init__(self, username, size=settings.SMTP_POOL_SIZE):
+        self.username = username
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Borrow a connection from the pool for the duration of a `with` block.
+        '''
+        self._slots.acquire()
+        try:
+            try:
+                smtp_connection = self._idle.get_nowait()
+            except queue.Empty:
+                smtp_connection = create_smtp_connection(self.username)
+            try:
+                yield smtp_connection
+            except BaseException:
+                close_smtp_connection(smtp_connection)
+                raise
+            self._idle.put(smtp_connection)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        '''
+        Closes every idle connection in the pool.
+        '''
+        while True:
+            try:
+                close_smtp_connection(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_smtp_pool = None
+_smtp_pool_lock = threading.Lock()
+
+
+def get_smtp_pool():
+    '''
+    Returns the SMTP connection pool shared by the whole process, creating it on first use.
+    The pool is closed when the process exits.
+    '''
+    global _smtp_pool
+    with _smtp_pool_lock:
+        if _smtp_pool is None:
+            _smtp_pool = SMTPConnectionPool(settings.SENDER_EMAIL)
+            atexit.register(_smtp_pool.close)
+        return _smtp_pool
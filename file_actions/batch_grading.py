@@ -0,0 +1,203 @@
+"""
+batch_grading Module
+
+This module grades many assignment folders (e.g. every section of a course) in one
+process. All jobs share a single pool of grading workers and the per-model rate
+limits in `open_ai_api_calls`, so the total run time is bounded by the API quota
+rather than by the number of sections, and the OpenAI client and logging are only
+set up once.
+
+A batch manifest is a JSON file listing the jobs:
+
+    {
+        "jobs": [
+            {"folder": "section1", "criteria": "criteria.txt", "extensions": [".py"],
+             "recipient": "teacher1@example.com"},
+            {"name": "Section 2", "folder": "section2", "criteria": "criteria.txt",
+             "extensions": [".py", ".txt"], "recipient": "teacher2@example.com",
+             "output": "results/section2.txt", "model": "gpt-4"},
+            {"folder": "section3", "criteria": "criteria.txt", "backend": "openai_compatible"}
+        ]
+    }
+
+Relative paths are resolved against the folder containing the manifest. `name`
+defaults to the folder name, `extensions` to [".txt"], `recipient` to
+settings.RESULTS_EMAIL, `output` to "<name>_grading_results.txt" in the
+"Grading Results" folder, and `model` and `backend` to the ones passed to
+`grade_batch`. Giving sections different backends spreads the load across
+providers.
+
+Dependencies:
+- json: For reading the batch manifest.
+- logging: For recording the progress of each job.
+- os: For resolving job paths.
+- concurrent.futures: For the shared worker pool and running jobs side by side.
+- file_actions: For grading a single assignments folder.
+- email_delivery: For sending one results email per job.
+"""
+
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from email_functions import email_delivery as email
+from file_actions import file_actions
+from openai_actions import grading_backends
+from settings import settings
+
+
+def load_batch_manifest(manifest_path):
+    """
+    Read and validate the jobs in a batch manifest.
+
+    Args:
+        manifest_path (str): The path to the batch manifest JSON file.
+
+    Returns:
+        list: One dict per job with the keys name, folder, criteria, extensions,
+        recipient, output, model and backend (None when the job does not pick one).
+        The default recipient and output are only looked up when the job is emailed and
+        graded (see get_job_output), so loading a manifest reads no secrets and creates
+        no folders.
+
+    Raises:
+        ValueError: If the manifest is malformed, a job is missing its folder or criteria, or
+        names an unknown backend.
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+        manifest = json.load(manifest_file)
+
+    raw_jobs = manifest.get('jobs') if isinstance(manifest, dict) else manifest
+    if not isinstance(raw_jobs, list) or not raw_jobs:
+        raise ValueError(f'The batch manifest {manifest_path} does not contain a list of jobs.')
+
+    base_folder = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    for index, raw_job in enumerate(raw_jobs, start=1):
+        if not raw_job.get('folder') or not raw_job.get('criteria'):
+            raise ValueError(f'Job {index} in {manifest_path} needs both a "folder" and a "criteria" file.')
+        if raw_job.get('backend') and raw_job['backend'] not in grading_backends.BACKENDS:
+            raise ValueError(f'Job {index} in {manifest_path} uses the unknown backend "{raw_job["backend"]}".')
+
+        folder = os.path.join(base_folder, raw_job['folder'])
+        name = raw_job.get('name') or os.path.basename(os.path.normpath(folder))
+        output = raw_job.get('output')
+        jobs.append({
+            'name': name,
+            'folder': folder,
+            'criteria': os.path.join(base_folder, raw_job['criteria']),
+            'extensions': raw_job.get('extensions') or ['.txt'],
+            'recipient': raw_job.get('recipient'),
+            'output': os.path.join(base_folder, output) if output else None,
+            'model': raw_job.get('model'),
+            'backend': raw_job.get('backend'),
+        })
+
+    names = [job['name'] for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Job names must be unique, but these repeat: {", ".join(duplicates)}')
+    return jobs
+
+
+def get_job_output(job, create=True):
+    """
+    Return the results file of a job.
+
+    Args:
+        job (dict): A job from load_batch_manifest.
+        create (bool, optional): Create the "Grading Results" folder when the job uses the
+        default output and the folder does not exist. Defaults to True.
+
+    Returns:
+        str: The job's "output", or "<name>_grading_results.txt" in the "Grading Results" folder.
+    """
+    if job['output']:
+        return job['output']
+    return os.path.join(file_actions.get_results_folder(create), f"{job['name']}_grading_results.txt")
+
+
+def grade_job(job, executor, model_name=settings.ENGINE_NAME, resume=True,
+              use_cache=settings.USE_RESPONSE_CACHE, send_email=True, use_batch_api=False, backend=None,
+              grade_by_section=settings.GRADE_BY_SECTION, samples=settings.CONSENSUS_SAMPLES,
+              stream=settings.STREAM_PIPELINE):
+    """
+    Grade one job of a batch through the shared worker pool and email its results.
+
+    Args:
+        job (dict): A job from load_batch_manifest.
+        executor (concurrent.futures.Executor): The worker pool shared by all jobs.
+        model_name (str, optional): The model to use when the job does not pick one.
+        resume (bool, optional): Reuse the previous results of unchanged students.
+        use_cache (bool, optional): Reuse cached grades for unchanged submissions.
+        send_email (bool, optional): Email the job's results to its recipient.
+        use_batch_api (bool, optional): Grade the job as one OpenAI Batch API job.
+        backend (str, optional): The grading backend to use when the job does not pick one.
+        grade_by_section (bool, optional): Grade every section of the job's criteria separately.
+        samples (int, optional): Grade every student this many times and keep the median grade.
+        stream (bool, optional): Grade the job with bounded memory (see file_actions.grade_assignments).
+
+    Returns:
+        dict or None: The student records of the job, or None if it failed.
+    """
+    logging.info(f"Batch job {job['name']} starting for {job['folder']}")
+    try:
+        grading_criteria = file_actions.read_grading_criteria(job['criteria'])
+    except Exception as ex:
+        logging.error(f"Batch job {job['name']} could not read its criteria. Error: {ex}")
+        return None
+
+    results_path = get_job_output(job)
+    student_records = file_actions.grade_assignments(job['folder'], grading_criteria, job['extensions'],
+                                                     resume=resume, use_cache=use_cache,
+                                                     model_name=job['model'] or model_name,
+                                                     results_path=results_path, executor=executor,
+                                                     use_batch_api=use_batch_api,
+                                                     backend=job['backend'] or backend,
+                                                     grade_by_section=grade_by_section, samples=samples,
+                                                     stream=stream)
+    if student_records is None:
+        logging.error(f"Batch job {job['name']} failed")
+        return None
+
+    if send_email:
+        grading_results, attachment_path = file_actions.get_results_email(results_path)
+        # No recipient in the manifest: send_email_to_user defaults to settings.RESULTS_EMAIL
+        email.send_email_to_user(grading_results, recipient=job['recipient'],
+                                 subject=f"{settings.FIRST_NAME}, the grading for {job['name']} is done!",
+                                 attachment_path=attachment_path)
+    logging.info(f"Batch job {job['name']} completed. Results written to {results_path}")
+    return student_records
+
+
+def grade_batch(jobs, max_workers=settings.MAX_GRADING_WORKERS, max_concurrent_jobs=settings.MAX_CONCURRENT_JOBS,
+                **job_options):
+    """
+    Grade every job of a batch with one shared pool of grading workers.
+
+    Args:
+        jobs (list): The jobs from load_batch_manifest.
+        max_workers (int, optional): Number of students graded at the same time across all jobs.
+        max_concurrent_jobs (int, optional): Number of jobs that scan folders and feed the
+        worker pool at the same time.
+        job_options: Passed on to grade_job (model_name, resume, use_cache, send_email, use_batch_api,
+        backend, grade_by_section, samples, stream).
+
+    Returns:
+        dict: Job name -> the job's student records, or None for jobs that failed.
+
+    Each job runs on its own lightweight coordinator thread, which reads the students'
+    files and waits for their grades, while the actual API calls of every job go through
+    the same worker pool and rate limits. A failing job is logged and does not stop the others.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='grader') as executor, \
+         ThreadPoolExecutor(max_workers=max(1, max_concurrent_jobs), thread_name_prefix='batch-job') as job_runner:
+        job_futures = [(job['name'], job_runner.submit(grade_job, job, executor, **job_options)) for job in jobs]
+        for name, future in job_futures:
+            try:
+                results[name] = future.result()
+            except Exception as ex:
+                logging.error(f'An unexpected error occurred in batch job {name}. Error: {ex}')
+                results[name] = None
+    return results
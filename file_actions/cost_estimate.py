@@ -0,0 +1,232 @@
+"""
+cost_estimate Module
+
+This module estimates what grading an assignments folder will cost before anything is
+sent, so a run can be planned against the API quota and the budget caps of the usage
+ledger (see `usage_ledger`).
+
+The estimate walks the assignments tree the way `file_actions.grade_assignments` does:
+students resumed from the run manifest, empty folders, identical submissions and grades
+already in the response cache cost nothing. Every other request is built, its prompt
+tokens are counted and it is routed to its model, and its completion is expected to use
+settings.EXPECTED_COMPLETION_TOKENS per sample. Spreadsheets, documents, PDFs and
+notebooks are converted to text for it, which also fills the extraction cache for the run.
+
+The estimate is an upper bound when the local pre-screen (settings.PRESCREEN_WITH_LOCAL_RUBRIC)
+or budget downgrades would settle some students more cheaply.
+
+Dependencies:
+- folder_scanner: For indexing the student folders.
+- run_manifest: For the students a run would resume.
+- submission_similarity: For the starter code a run would leave out.
+- document_extraction: For converting binary submissions to text.
+- response_cache: For the grades a run would take from the cache.
+- grading_backends, model_routing, token_counter: For building, routing and pricing requests.
+- usage_ledger: For the budget caps and what was already spent today.
+"""
+
+from cache_actions import response_cache
+from file_actions import (document_extraction, file_actions, folder_scanner, grade_consensus, rubric_sections,
+                          run_manifest, submission_similarity)
+from general_functions import general_functions
+from openai_actions import grading_backends, model_routing, token_counter, usage_ledger
+from settings import settings
+
+
+def estimate_assignments(assignments_folder, grading_criteria, allowed_extensions, resume=True,
+                         use_cache=settings.USE_RESPONSE_CACHE, model_name=settings.ENGINE_NAME, results_path=None,
+                         backend=None, grade_by_section=settings.GRADE_BY_SECTION,
+                         samples=settings.CONSENSUS_SAMPLES, deduplicate=settings.DEDUPLICATE_SUBMISSIONS,
+                         use_batch_api=False):
+    """
+    Estimate the requests, tokens, cost and time of grading an assignments folder, without sending anything.
+
+    Args:
+        assignments_folder (str): Path to the main folder containing individual student
+        assignment folders.
+        grading_criteria (str): The criteria to use for grading assignments.
+        allowed_extensions (list): List of file extensions that are considered valid for assignments.
+        resume, use_cache, model_name, results_path, backend, grade_by_section, samples,
+        deduplicate, use_batch_api: As for `file_actions.grade_assignments`.
+
+    Returns:
+        dict: The counts of `students`, `empty` folders, `resumed` students, `duplicates`,
+        `cached` requests and students `too_large` for any model; the `requests`,
+        `prompt_tokens`, `completion_tokens` and `dollars` in total and per model in
+        `models`; and the `minutes` the requests take at least under the per-minute rate
+        limits of the OpenAI models (see settings.MODEL_RATE_LIMITS).
+    """
+    # Only looked up: an estimate creates no folders
+    results_path = results_path or file_actions.get_results_file_path(create=False)
+    criteria_prefix = general_functions.build_criteria_prefix(grading_criteria)
+    backend = grading_backends.get_backend(backend)
+    if use_batch_api and backend.name != grading_backends.OpenAIBackend.name:
+        use_batch_api = False
+    sections = rubric_sections.build_sections(grading_criteria) if grade_by_section and not use_batch_api else []
+    samples = 1 if use_batch_api else samples
+    prefixes = [section.criteria_prefix for section in sections] or [criteria_prefix]
+    cache_model = backend.cache_model(model_name)
+    run_model = cache_model + (f' x{samples}' if samples > 1 else '')
+    previous_students = {}
+    if resume:
+        previous_students = run_manifest.load_manifest(run_manifest.get_manifest_path(results_path),
+                                                       criteria_prefix.criteria_hash, run_model)
+
+    scanned_folders = folder_scanner.scan_assignments_folder(assignments_folder, allowed_extensions)
+    boilerplate_files = submission_similarity.find_boilerplate_files(scanned_folders) if deduplicate else {}
+    fingerprints = {scanned_folder.name: run_manifest.fingerprint_files(scanned_folder.files)
+                    for scanned_folder in scanned_folders}
+    extracted_texts = document_extraction.extract_files(
+        [assignment_file.path for scanned_folder in scanned_folders
+         if run_manifest.needs_grading(previous_students.get(scanned_folder.name), fingerprints[scanned_folder.name])
+         for assignment_file in scanned_folder.files
+         if document_extraction.needs_extraction(assignment_file.name)
+         and assignment_file.path not in boilerplate_files])
+
+    estimate = {'students': 0, 'empty': 0, 'resumed': 0, 'duplicates': 0, 'cached': 0, 'too_large': 0,
+                'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'dollars': 0.0, 'models': {}}
+    content_hashes = set()
+    for scanned_folder in scanned_folders:
+        estimate['students'] += 1
+        previous_record = previous_students.get(scanned_folder.name)
+        if not scanned_folder.entry_count:
+            estimate['empty'] += 1
+            continue
+        if not run_manifest.needs_grading(previous_record, fingerprints[scanned_folder.name]):
+            estimate['resumed'] += 1
+            continue
+
+        combined_assignment_content = file_actions.read_student_files(scanned_folder.path, allowed_extensions,
+                                                                      scanned_folder=scanned_folder,
+                                                                      boilerplate_files=boilerplate_files,
+                                                                      extracted_texts=extracted_texts)
+        content_hash = run_manifest.hash_text(combined_assignment_content)
+        if (previous_record and previous_record.get('status') in run_manifest.REUSABLE_STATUSES
+                and previous_record.get('content_hash') == content_hash):
+            estimate['resumed'] += 1
+            continue
+        if not combined_assignment_content:
+            estimate['empty'] += 1
+            continue
+        if deduplicate and content_hash in content_hashes:
+            estimate['duplicates'] += 1
+            continue
+        content_hashes.add(content_hash)
+
+        for prefix in prefixes:
+            missing_samples = _count_missing_samples(prefix, combined_assignment_content, cache_model, samples,
+                                                     use_cache)
+            if not missing_samples:
+                estimate['cached'] += 1
+                continue
+            message = general_functions.combine_contents_into_message(prefix, combined_assignment_content)
+            prompt_tokens = token_counter.count_tokens(message, model_name)
+            try:
+                routed_model = backend.select_model(prompt_tokens, model_name)
+            except model_routing.SubmissionTooLargeError:
+                estimate['too_large'] += 1
+                break
+            _add_request(estimate, routed_model, prompt_tokens,
+                         settings.EXPECTED_COMPLETION_TOKENS * missing_samples)
+
+    estimate['minutes'] = (_estimate_minutes(estimate['models'])
+                           if backend.name == grading_backends.OpenAIBackend.name and not use_batch_api else None)
+    return estimate
+
+
+def _count_missing_samples(criteria_prefix, combined_assignment_content, cache_model, samples, use_cache):
+    """
+    Count the gradings of a request that are not in the response cache yet.
+    """
+    if not use_cache:
+        return samples
+    return sum(1 for index in range(samples) if response_cache.get_cached_response(response_cache.make_cache_key(
+        grade_consensus.sample_cache_model(cache_model, index), criteria_prefix.criteria_hash,
+        combined_assignment_content)) is None)
+
+
+def _add_request(estimate, model_name, prompt_tokens, completion_tokens):
+    dollars = model_routing.estimate_cost(model_name, prompt_tokens, completion_tokens)
+    model_estimate = estimate['models'].setdefault(model_name, {'requests': 0, 'prompt_tokens': 0,
+                                                                'completion_tokens': 0, 'dollars': 0.0})
+    for totals in (estimate, model_estimate):
+        totals['requests'] += 1
+        totals['prompt_tokens'] += prompt_tokens
+        totals['completion_tokens'] += completion_tokens
+        totals['dollars'] += dollars
+
+
+def _estimate_minutes(models):
+    """
+    The fewest minutes the requests take under the per-minute rate limits, with the models used side by side.
+    """
+    minutes = 0.0
+    for model_name, model_estimate in models.items():
+        rate_limit = settings.MODEL_RATE_LIMITS.get(model_name, settings.DEFAULT_RATE_LIMIT)
+        minutes = max(minutes, model_estimate['requests'] / rate_limit['requests_per_minute'],
+                      (model_estimate['prompt_tokens'] + model_estimate['completion_tokens'])
+                      / rate_limit['tokens_per_minute'])
+    return minutes
+
+
+def check_budget(estimates):
+    """
+    Compare one or more estimates with the budget caps of the usage ledger.
+
+    Args:
+        estimates (list): Estimates from `estimate_assignments`, e.g. one per batch job,
+        graded in the same run.
+
+    Returns:
+        list: One dict per cap that is set, with its `name`, `unit`, `cap`, what was `spent`
+        already (today, for the daily caps), the `estimated` usage of the run and whether
+        the run `fits` under the cap.
+    """
+    estimated = {'tokens': sum(estimate['prompt_tokens'] + estimate['completion_tokens'] for estimate in estimates),
+                 'dollars': sum(estimate['dollars'] for estimate in estimates)}
+    caps = usage_ledger.get_budget_caps()
+    spending = None
+    budget = []
+    for scope, name in (('run', 'per-run'), ('day', 'daily')):
+        for unit in ('tokens', 'dollars'):
+            cap = caps.get(f'{scope}_{unit}')
+            if cap is None:
+                continue
+            if scope == 'day' and spending is None:
+                spending = usage_ledger.get_ledger().get_spending()
+            spent = spending[scope][unit] if scope == 'day' else 0
+            budget.append({'name': name, 'unit': unit, 'cap': cap, 'spent': spent, 'estimated': estimated[unit],
+                           'fits': spent + estimated[unit] <= cap})
+    return budget
+
+
+def format_estimate(estimate):
+    """
+    Format an estimate from `estimate_assignments` as plain text.
+    """
+    lines = [f"{estimate['students']} students: {estimate['requests']} requests to send, "
+             f"{estimate['resumed']} resumed, {estimate['cached']} cached, {estimate['duplicates']} duplicates, "
+             f"{estimate['empty']} empty"
+             + (f", {estimate['too_large']} too large for any model" if estimate['too_large'] else ''),
+             f"Estimated {usage_ledger.format_amount('tokens', estimate['prompt_tokens'])} of prompt and "
+             f"{usage_ledger.format_amount('tokens', estimate['completion_tokens'])} of completion, "
+             f"{usage_ledger.format_amount('dollars', estimate['dollars'])}"
+             + (f", at least {estimate['minutes']:.1f} minutes under the rate limits"
+                if estimate.get('minutes') else '')]
+    for model_name, model_estimate in sorted(estimate['models'].items()):
+        tokens = model_estimate['prompt_tokens'] + model_estimate['completion_tokens']
+        lines.append(f"  {model_name}: {model_estimate['requests']} requests, "
+                     f"{usage_ledger.format_amount('tokens', tokens)}, "
+                     f"{usage_ledger.format_amount('dollars', model_estimate['dollars'])}")
+    return '\n'.join(lines)
+
+
+def format_budget(budget):
+    """
+    Format the budget check from `check_budget` as plain text, one line per cap.
+    """
+    return '\n'.join(f"{'Within' if row['fits'] else 'OVER'} the {row['name']} cap of "
+                     f"{usage_ledger.format_amount(row['unit'], row['cap'])}: "
+                     f"{usage_ledger.format_amount(row['unit'], row['spent'])} spent + "
+                     f"{usage_ledger.format_amount(row['unit'], row['estimated'])} estimated"
+                     for row in budget)
@@ -0,0 +1,276 @@
+"""
+document_extraction Module
+
+This module converts submissions that are not plain text into compact text for grading:
+
+- .xlsx: every non-empty cell per sheet, with its formula when it has one.
+- .docx: the text of every paragraph (including the ones in tables).
+- .pdf: the text of every page (needs the optional pypdf package).
+- .ipynb: the code and markdown cells, without their outputs.
+
+Parsing these files is CPU bound, so the files of a run are converted in a pool of
+worker processes (settings.EXTRACTION_WORKERS) while the grading goes on. The text is
+cached per file hash (see extraction_cache), so a re-run only parses new or changed files.
+
+Dependencies:
+- json: For reading notebooks.
+- zipfile, xml.etree.ElementTree: For reading .xlsx and .docx files, which are zipped XML. 
+  Like pypdf, they are only imported when such a file is converted.
+- concurrent.futures: For converting files in worker processes.
+- extraction_cache: Custom module caching the converted text on disk.
+- submission_similarity: For hashing the files.
+- pypdf: For reading .pdf files. It is only imported when a PDF is converted.
+"""
+
+import json
+import logging
+import os
+import posixpath
+import re
+from concurrent.futures import Future
+from cache_actions import extraction_cache
+from file_actions import submission_similarity
+from settings import settings
+
+# Bump when the converted text changes, so cached text from older versions is not used
+EXTRACTOR_VERSION = 1
+
+_SPREADSHEET_NAMESPACE = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_DOCUMENT_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_RELATIONSHIP_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+_BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+
+
+class ExtractionError(ValueError):
+    """
+    Raised when a file cannot be converted to text.
+    """
+
+
+def needs_extraction(file_name):
+    """
+    Check whether a file has to be converted before it can be graded.
+
+    Args:
+        file_name (str): The name or path of the file.
+
+    Returns:
+        bool: True for the formats in EXTRACTORS, False for files read as plain text.
+    """
+    return os.path.splitext(file_name)[1].lower() in EXTRACTORS
+
+
+def extract_text(file_path):
+    """
+    Convert a spreadsheet, document, PDF or notebook to text.
+
+    Args:
+        file_path (str): The path to the file. Its extension picks the converter.
+
+    Returns:
+        str: The compact text of the file.
+
+    Raises:
+        ExtractionError: If the file is damaged, is not in the format its extension says,
+        or needs a package that is not installed.
+    """
+    import zipfile
+    from xml.etree import ElementTree
+
+    extension = os.path.splitext(file_path)[1].lower()
+    try:
+        return _BLANK_LINES_PATTERN.sub('\n\n', EXTRACTORS[extension](file_path)).strip()
+    except ExtractionError:
+        raise
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError, ValueError, TypeError) as ex:
+        raise ExtractionError(f'{os.path.basename(file_path)} is not a readable {extension} file: {ex}') from ex
+
+
+def make_cache_key(file_hash):
+    """
+    Build the extraction cache key of a file.
+
+    Args:
+        file_hash (str): The SHA-256 hex digest of the file's bytes.
+
+    Returns:
+        str: The key, which also changes with EXTRACTOR_VERSION.
+    """
+    return f'{file_hash}:{EXTRACTOR_VERSION}'
+
+
+def extract_files(file_paths, max_workers=settings.EXTRACTION_WORKERS, use_cache=settings.USE_EXTRACTION_CACHE):
+    """
+    Start converting many files to text.
+
+    Args:
+        file_paths (list): The paths of the files to convert.
+        max_workers (int, optional): Number of worker processes. 1 converts the files one
+        after another in this process, before returning. Defaults to settings.EXTRACTION_WORKERS.
+        use_cache (bool, optional): Serve unchanged files from the extraction cache and
+        cache the new text. Defaults to settings.USE_EXTRACTION_CACHE.
+
+    Returns:
+        dict: File path -> a concurrent.futures.Future with the file's text, or with an
+        ExtractionError (or OSError) if it could not be converted.
+
+    Cached files are done right away. The others are converted by a pool that shuts down
+    by itself once they are all done, so the caller can grade while they are converted.
+    """
+    extracted_texts = {}
+    cache_keys = {}
+    for file_path in file_paths:
+        try:
+            cache_keys[file_path] = make_cache_key(submission_similarity.hash_file(file_path))
+        except OSError as ex:
+            extracted_texts[file_path] = _failed_future(ex)
+
+    cached_texts = extraction_cache.get_cached_texts(set(cache_keys.values())) if use_cache else {}
+    to_convert = []
+    for file_path, cache_key in cache_keys.items():
+        if cache_key in cached_texts:
+            extracted_texts[file_path] = Future()
+            extracted_texts[file_path].set_result(cached_texts[cache_key])
+        else:
+            to_convert.append(file_path)
+    if len(to_convert) < len(cache_keys):
+        logging.info(f'Reusing the converted text of {len(cache_keys) - len(to_convert)} unchanged files')
+    if not to_convert:
+        return extracted_texts
+
+    logging.info(f'Converting {len(to_convert)} files to text')
+    if max_workers <= 1 or len(to_convert) == 1:
+        for file_path in to_convert:
+            extracted_texts[file_path] = Future()
+            try:
+                extracted_texts[file_path].set_result(extract_text(file_path))
+            except (ExtractionError, OSError) as ex:
+                extracted_texts[file_path].set_exception(ex)
+    else:
+        # multiprocessing is only loaded by runs that have files to convert
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(max_workers=min(max_workers, len(to_convert)))
+        for file_path in to_convert:
+            extracted_texts[file_path] = executor.submit(extract_text, file_path)
+        # The submitted conversions still run; the workers exit once they are done
+        executor.shutdown(wait=False)
+
+    if use_cache:
+        for file_path in to_convert:
+            extracted_texts[file_path].add_done_callback(
+                lambda future, cache_key=cache_keys[file_path]: _cache_text(cache_key, future))
+    return extracted_texts
+
+
+def _cache_text(cache_key, future):
+    if not future.cancelled() and future.exception() is None:
+        extraction_cache.store_text(cache_key, future.result())
+
+
+def _failed_future(ex):
+    future = Future()
+    future.set_exception(ex)
+    return future
+
+
+def _extract_xlsx(file_path):
+    import zipfile
+    from xml.etree import ElementTree
+
+    with zipfile.ZipFile(file_path) as workbook:
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in workbook.namelist():
+            for item in ElementTree.fromstring(workbook.read('xl/sharedStrings.xml')):
+                shared_strings.append(''.join(text.text or '' for text in item.iter(f'{_SPREADSHEET_NAMESPACE}t')))
+
+        relationships = {relationship.get('Id'): relationship.get('Target') for relationship in
+                         ElementTree.fromstring(workbook.read('xl/_rels/workbook.xml.rels'))}
+        lines = []
+        for sheet in ElementTree.fromstring(workbook.read('xl/workbook.xml')).iter(f'{_SPREADSHEET_NAMESPACE}sheet'):
+            target = relationships[sheet.get(_RELATIONSHIP_ID)]
+            sheet_path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+            lines.append(f"## Sheet: {sheet.get('name')}")
+            for cell in ElementTree.fromstring(workbook.read(sheet_path)).iter(f'{_SPREADSHEET_NAMESPACE}c'):
+                value = _cell_value(cell, shared_strings)
+                formula = cell.findtext(f'{_SPREADSHEET_NAMESPACE}f')
+                if formula:
+                    lines.append(f"{cell.get('r')}: ={formula}" + (f' -> {value}' if value else ''))
+                elif value:
+                    lines.append(f"{cell.get('r')}: {value}")
+            lines.append('')
+    return '\n'.join(lines)
+
+
+def _cell_value(cell, shared_strings):
+    cell_type = cell.get('t')
+    if cell_type == 'inlineStr':
+        return ''.join(text.text or '' for text in cell.iter(f'{_SPREADSHEET_NAMESPACE}t'))
+    value = cell.findtext(f'{_SPREADSHEET_NAMESPACE}v') or ''
+    if cell_type == 's' and value:
+        return shared_strings[int(value)]
+    if cell_type == 'b':
+        return 'TRUE' if value == '1' else 'FALSE'
+    return value
+
+
+def _extract_docx(file_path):
+    import zipfile
+    from xml.etree import ElementTree
+
+    with zipfile.ZipFile(file_path) as document:
+        body = ElementTree.fromstring(document.read('word/document.xml'))
+    paragraphs = []
+    for paragraph in body.iter(f'{_DOCUMENT_NAMESPACE}p'):
+        parts = []
+        for element in paragraph.iter():
+            if element.tag == f'{_DOCUMENT_NAMESPACE}t':
+                parts.append(element.text or '')
+            elif element.tag == f'{_DOCUMENT_NAMESPACE}tab':
+                parts.append('\t')
+            elif element.tag in (f'{_DOCUMENT_NAMESPACE}br', f'{_DOCUMENT_NAMESPACE}cr'):
+                parts.append('\n')
+        text = ''.join(parts).strip()
+        if text:
+            paragraphs.append(text)
+    return '\n'.join(paragraphs)
+
+
+def _extract_pdf(file_path):
+    try:
+        from pypdf import PdfReader
+        from pypdf.errors import PdfReadError
+    except ImportError as ex:
+        raise ExtractionError('Reading .pdf files needs the pypdf package (pip install pypdf)') from ex
+
+    try:
+        pages = [page.extract_text() or '' for page in PdfReader(file_path).pages]
+    except PdfReadError as ex:
+        raise ExtractionError(f'{os.path.basename(file_path)} is not a readable .pdf file: {ex}') from ex
+    return '\n\n'.join(f'## Page {number}\n{text.strip()}' for number, text in enumerate(pages, 1) if text.strip())
+
+
+def _extract_ipynb(file_path):
+    with open(file_path, 'r', encoding='utf-8') as notebook_file:
+        notebook = json.load(notebook_file)
+    # nbformat 4 keeps the cells at the top level, older notebooks in worksheets
+    cells = notebook.get('cells')
+    if cells is None:
+        cells = [cell for worksheet in notebook.get('worksheets', []) for cell in worksheet.get('cells', [])]
+
+    parts = []
+    for cell in cells:
+        source = cell.get('source', cell.get('input', ''))
+        source = ''.join(source) if isinstance(source, list) else source
+        if source.strip() and cell.get('cell_type') in ('code', 'markdown'):
+            parts.append(f"# [{cell['cell_type']}]\n{source.strip()}")
+    return '\n\n'.join(parts)
+
+
+# Extension -> the function converting such a file to text
+EXTRACTORS = {
+    '.xlsx': _extract_xlsx,
+    '.docx': _extract_docx,
+    '.pdf': _extract_pdf,
+    '.ipynb': _extract_ipynb,
+}
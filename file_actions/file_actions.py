@@ -5,8 +5,17 @@ This module provides a collection of functions designed to facilitate
 the grading process of student assignments. The primary functions include:
 
 - Prompting the user to select the assignments folder and grading criteria file.
-- Reading and combining all assignment files for individual students.
+- Reading and combining all assignment files for individual students, converting 
+  spreadsheets, documents, PDFs and notebooks to text first.
 - Grading the combined content of all assignment files for a single student.
+- Grading many students at once with a pool of worker threads, or as one Batch API job.
+- Grading the sections of the rubric side by side and merging their scores.
+- Grading each student several times in one request and keeping the median grade.
+- Reusing cached grades for submissions that have not changed since the last run.
+- Resuming interrupted runs and regrading only new, failed or modified students, or only 
+  the students watch mode saw change.
+- Streaming very large classes through the pipeline with a bounded number of students in flight.
+- Leaving out shared starter code, grading identical submissions once and flagging similar ones.
 - Writing the grading results to a designated file.
 - Logging and user notifications for error handling and process updates.
 
@@ -15,23 +24,50 @@ Key Features:
 - Error handling to ensure continuous grading even if issues arise with individual files.
 - Integration with external APIs for grading.
 - Tkinter-based user interface elements for folder and file selection, as well as error notifications.
+- A headless mode where notifications are logged instead of shown (see general_functions.set_interactive).
 
 Dependencies:
 - logging: For recording the grading process and any potential issues.
 - os: For directory and file path operations.
-- tkinter: For user interface elements.
+- concurrent.futures: For grading several students at the same time.
+- tkinter: For user interface elements. It is only imported by the dialogs, so headless 
+  runs never load it.
 - general_functions: Custom module containing auxiliary functions.
-- open_ai_api_calls: Custom module for interfacing with the external grading API.
+- instrumentation: Custom module recording the time spent in each stage of a run.
+- grading_backends: Custom module for interfacing with the grading API or a local scorer.
+- batch_api: Custom module grading a whole run as one OpenAI Batch API job.
+- response_cache: Custom module caching grading responses on disk.
+- extraction_cache: Custom module caching the text converted from binary files, pruned once per run.
+- folder_scanner: Custom module indexing the student folders and their files in one pass.
+- document_extraction: Custom module converting binary submissions to text in worker processes.
+- run_manifest: Custom module recording the progress of a grading run.
+- submission_similarity: Custom module finding starter code and similar submissions.
+- rubric_sections: Custom module splitting the grading criteria into separately graded sections.
+- grade_consensus: Custom module merging several gradings of a student into one grade.
+- results_store: Custom module storing structured results and rendering reports from them.
+- usage_ledger: Custom module recording the tokens and cost of every request and keeping runs within budget.
 
 Note: Ensure that the dependencies are properly installed and accessible.
 """
 
+import codecs
+import io
 import logging
 import os
-from tkinter import filedialog, messagebox, simpledialog
-import tkinter
-from general_functions import general_functions
-from openai_actions import open_ai_api_calls
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from cache_actions import extraction_cache, response_cache
+from file_actions import (document_extraction, folder_scanner, grade_consensus, results_store, rubric_sections,
+                          run_manifest, submission_similarity)
+from general_functions import general_functions, instrumentation
+from openai_actions import batch_api, grading_backends, model_routing, token_counter, usage_ledger
+from settings import settings
+
+# Share of the per-file byte limit kept from the start of an oversized file; the rest comes from its end
+FILE_HEAD_SHARE = 0.8
 
 
 def prompt_user_for_input():
@@ -52,6 +88,9 @@ def prompt_user_for_input():
     Raises:
         ValueError: If the user cancels either of the file dialogs.
     """
+    import tkinter
+    from tkinter import filedialog, messagebox
+
     try:
         root = tkinter.Tk()
         root.withdraw()
@@ -95,122 +134,715 @@ def read_grading_criteria(file_path):
             return grading_file.read()
     except FileNotFoundError:
         logging.error(f"File not found: {file_path}")
-        messagebox.showerror('Error!', f'File not found: {file_path}')
+        general_functions.show_error('Error!', f'File not found: {file_path}')
         raise
     except UnicodeDecodeError:
         logging.error(f"File not encoded in UTF-8: {file_path}")
-        messagebox.showerror('Error!', f'File not encoded in UTF-8: {file_path}')
+        general_functions.show_error('Error!', f'File not encoded in UTF-8: {file_path}')
         raise
     except IOError as ex:
         logging.error(f"I/O error occurred while reading the file: {ex}")
-        messagebox.showerror('Error!', f'I/O error occurred: {ex}')
+        general_functions.show_error('Error!', f'I/O error occurred: {ex}')
         raise
 
 
-def write_results_to_file(grade_response, student_name, first_run):
+def get_results_folder(create=True):
+    """
+    Return the "Grading Results" folder inside the user's Downloads folder, creating it if needed.
+
+    Args:
+        create (bool, optional): Create the folder when it does not exist. Pass False to 
+        only look up the path, e.g. for an estimate. Defaults to True.
+
+    Returns:
+        str: The path to the "Grading Results" folder.
+    """
+    # Detecting the operating system and setting the downloads folder path accordingly
+    downloads_folder = os.path.join(os.path.expanduser('~'), 'Downloads')
+
+    # Create the "Grading Results" folder inside the Downloads folder if it doesn't exist
+    grading_results_folder = os.path.join(downloads_folder, 'Grading Results')
+    if create and not os.path.exists(grading_results_folder):
+        os.makedirs(grading_results_folder)
+    return grading_results_folder
+
+
+def get_results_file_path(create=True):
+    """
+    Return the default results file, 'grading_results.txt' in the "Grading Results" folder.
+
+    Args:
+        create (bool, optional): Create the "Grading Results" folder when it does not exist.
+
+    Returns:
+        str: The path to the default results file.
+    """
+    return os.path.join(get_results_folder(create), 'grading_results.txt')
+
+
+def get_batch_request_path(results_path):
+    """
+    Return the Batch API request file that belongs to a results file.
+
+    Args:
+        results_path (str): The path to the results file of the run.
+
+    Returns:
+        str: e.g. grading_results.txt -> grading_results_batch.jsonl
+    """
+    return os.path.splitext(results_path)[0] + '_batch.jsonl'
+
+
+def write_results_to_file(student_records, file_path=None):
     '''
-    This function writes the given prediction to a text file as a record
+    This function writes the grades of a run to the structured results
+    store (see results_store), then renders the text report and a CSV
+    export from it, one entry per student in sorted student order. The
+    text report defaults to get_results_file_path(); the store and the
+    CSV sit next to it with the .jsonl and .csv extensions. The records
+    can be a dict of student name -> record, or be streamed in sorted
+    student order (see run_manifest.ManifestWriter.iter_records).
     '''
     try:
         logging.info('Writing grades to a file...')
-        # Detecting the operating system and setting the downloads folder path accordingly
-        downloads_folder = os.path.join(os.path.expanduser('~'), 'Downloads')
+        file_path = file_path or get_results_file_path()
 
-        # Create the "Grading Results" folder inside the Downloads folder if it doesn't exist
-        grading_results_folder = os.path.join(downloads_folder, 'Grading Results')
-        if not os.path.exists(grading_results_folder):
-            os.makedirs(grading_results_folder)
+        with instrumentation.stage('write'):
+            store = results_store.ResultsStore(results_store.get_store_path(file_path))
+            store.write(student_records)
+            store.render_text_report(file_path)
+            store.render_csv(os.path.splitext(file_path)[0] + '.csv')
 
-        # Set the file path within the "Grading Results" folder
-        file_path = os.path.join(grading_results_folder, 'grading_results.txt')
+    except Exception as ex:
+        logging.error(f"An error occurred while writing to the file: {ex}")
 
-        # Delete the existing file if first_run is True
-        if first_run and os.path.exists(file_path):
-            logging.info('Deleting prior grading file')
-            os.remove(file_path)
 
-        with open(file_path, "a", encoding="utf-8") as file:
-            # Adding four new lines for separation, the student's name, and their grade
-            file.write(f'\n\n\n\nStudent: {student_name}\nGrade: {grade_response}')
+def read_file_bounded(file_path, max_bytes=settings.MAX_FILE_BYTES, file_size=None):
+    """
+    Read a UTF-8 text file, keeping only its head and tail if it is larger than `max_bytes`.
 
-    except Exception as ex:
-        logging.error(f"An error occurred while writing to the file: {ex}")
+    Args:
+        file_path (str): The path to the file.
+        max_bytes (int, optional): The most bytes of the file to keep. Defaults to 
+        settings.MAX_FILE_BYTES.
+        file_size (int, optional): The size of the file, if the caller already knows it 
+        (e.g. from the folder_scanner index). Looked up otherwise.
+
+    Returns:
+        tuple: (text, omitted_bytes). When the file is too large, `text` holds the first 
+        FILE_HEAD_SHARE of the allowed bytes and the end of the file, joined by a marker 
+        saying how many bytes were left out, and `omitted_bytes` is that number. Only the 
+        kept bytes are ever read into memory.
+
+    Raises:
+        UnicodeDecodeError: If the kept part of the file is not UTF-8 encoded.
+        FileNotFoundError: If the file does not exist.
+    """
+    if file_size is None:
+        file_size = os.path.getsize(file_path)
+    if file_size <= max_bytes:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read(), 0
 
+    head_bytes = int(max_bytes * FILE_HEAD_SHARE)
+    tail_bytes = max_bytes - head_bytes
+    with open(file_path, 'rb') as f:
+        head = f.read(head_bytes)
+        f.seek(file_size - tail_bytes)
+        tail = f.read(tail_bytes)
 
-def read_student_files(student_folder_path, allowed_extensions):
+    # The cut points can fall inside a multi-byte character, so drop the partial
+    # character at the end of the head and any continuation bytes at the start of the tail
+    head_text = codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+    tail_text = tail.lstrip(bytes(range(0x80, 0xC0))).decode('utf-8')
+    omitted_bytes = file_size - head_bytes - tail_bytes
+    marker = f'\n[... {omitted_bytes} bytes of {os.path.basename(file_path)} omitted ...]\n'
+    return head_text + marker + tail_text, omitted_bytes
+
+
+def bound_text(text, file_name, max_characters=settings.MAX_FILE_BYTES):
+    """
+    Keep only the head and tail of a text that is longer than `max_characters`.
+
+    Args:
+        text (str): The text, e.g. converted from a spreadsheet or notebook.
+        file_name (str): The name of the file the text came from, used in the marker.
+        max_characters (int, optional): The most characters to keep. Defaults to 
+        settings.MAX_FILE_BYTES.
+
+    Returns:
+        tuple: (text, omitted_characters), cut like `read_file_bounded` cuts a file.
+    """
+    if len(text) <= max_characters:
+        return text, 0
+
+    head_characters = int(max_characters * FILE_HEAD_SHARE)
+    tail_characters = max_characters - head_characters
+    omitted_characters = len(text) - head_characters - tail_characters
+    marker = f'\n[... {omitted_characters} characters of {file_name} omitted ...]\n'
+    return text[:head_characters] + marker + text[len(text) - tail_characters:], omitted_characters
+
+
+def read_student_files(student_folder_path, allowed_extensions, dropped_content=None,
+                       max_file_bytes=settings.MAX_FILE_BYTES,
+                       max_submission_tokens=settings.MAX_SUBMISSION_TOKENS, scanned_folder=None,
+                       boilerplate_files=None, extracted_texts=None):
     """
     Read and combine all assignment files for a single student.
 
     Args:
         student_folder_path (str): The path to the individual student's folder.
         allowed_extensions (list): List of file extensions that are considered valid for assignments.
+        dropped_content (list, optional): If given, one dict is appended for every file that 
+        was truncated or left out, with the keys `file`, `reason`, `original_bytes` and 
+        `kept_characters`.
+        max_file_bytes (int, optional): The most bytes kept from a single file. Defaults to 
+        settings.MAX_FILE_BYTES.
+        max_submission_tokens (int, optional): The most (estimated) tokens kept for the whole 
+        submission. Defaults to settings.MAX_SUBMISSION_TOKENS.
+        scanned_folder (folder_scanner.StudentFolder, optional): The student's entry in the 
+        index built by `folder_scanner.scan_assignments_folder`. When given, its files are 
+        read without listing or stat'ing the folder again; otherwise the folder is scanned here.
+        boilerplate_files (dict, optional): File path -> number of students sharing it, from 
+        `submission_similarity.find_boilerplate_files`. These files are not read; a one line 
+        marker takes their place.
+        extracted_texts (dict, optional): File path -> the pending text of a spreadsheet, 
+        document, PDF or notebook, from `document_extraction.extract_files`. Such files 
+        missing from it are converted here.
 
     Returns:
         str: Combined content of all valid assignment files in the student's folder.
 
-    This function iterates over all files in the student's folder. It skips files that do not have 
-    an allowed extension. For each valid assignment file, it reads the content and appends it to 
-    a combined content string, separated by two newlines. In case of any errors while reading a file 
-    (e.g., not UTF-8 encoded, file not found), appropriate logging and user notifications are done.
+    This function iterates over all files in the student's folder in sorted order. It skips files 
+    that do not have an allowed extension. For each valid assignment file, it reads the content and 
+    appends it to a single buffer, separated by two newlines. Spreadsheets, documents, PDFs and 
+    notebooks are converted to text (see `document_extraction`) instead of being read as UTF-8. 
+    Files larger than `max_file_bytes` keep only their head and tail (see `read_file_bounded` 
+    and `bound_text`), and once the submission reaches 
+    `max_submission_tokens` the current file is cut short and later files are left out. Every cut 
+    is marked in the content, logged and reported through `dropped_content`. In case of any errors 
+    while reading a file (e.g., not UTF-8 encoded, file not found), appropriate logging and user 
+    notifications are done.
 
     Note: The function continues reading other files even if an error occurs with one file.
     """
-    combined_assignment_content = ""
+    combined_assignment_content = io.StringIO()
+    remaining_characters = max_submission_tokens * token_counter.CHARACTERS_PER_TOKEN
+    dropped_content = dropped_content if dropped_content is not None else []
+    if scanned_folder is None:
+        scanned_folder = folder_scanner.scan_student_folder(student_folder_path, allowed_extensions)
 
-    for assignment_file in os.listdir(student_folder_path):
-        if not any(assignment_file.lower().endswith(ext) for ext in allowed_extensions):
-            logging.warning(f"Skipping file {assignment_file} as it's not a recognized text file.")
-            continue
+    for skipped_file in scanned_folder.skipped_files:
+        logging.warning(f"Skipping file {skipped_file} as it's not a recognized text file.")
+
+    boilerplate_files = boilerplate_files or {}
+    extracted_texts = extracted_texts or {}
+    for assignment_file_entry in scanned_folder.files:
+        assignment_file = assignment_file_entry.name
         try:
-            assignment_file_path = os.path.join(student_folder_path, assignment_file)
-            with open(assignment_file_path, 'r', encoding='utf-8') as f:
-                combined_assignment_content += f.read() + "\n\n"  # Combine content with two newlines as a separator
+            if assignment_file_entry.path in boilerplate_files:
+                shared_by = boilerplate_files[assignment_file_entry.path]
+                logging.info(f"Leaving out {assignment_file}: it is unchanged starter code shared by {shared_by} students.")
+                dropped_content.append({'file': assignment_file, 'reason': 'shared starter code',
+                                        'original_bytes': assignment_file_entry.size,
+                                        'kept_characters': 0})
+                combined_assignment_content.write(submission_similarity.boilerplate_marker(assignment_file) + '\n\n')
+                continue
+
+            if remaining_characters <= 0:
+                logging.warning(f"Leaving out {assignment_file}: the submission limit of {max_submission_tokens} tokens was reached.")
+                dropped_content.append({'file': assignment_file, 'reason': 'submission limit reached',
+                                        'original_bytes': assignment_file_entry.size,
+                                        'kept_characters': 0})
+                continue
+
+            if document_extraction.needs_extraction(assignment_file):
+                extracted_text = extracted_texts.get(assignment_file_entry.path)
+                if extracted_text is None:
+                    extracted_text = document_extraction.extract_files([assignment_file_entry.path], 1)[
+                        assignment_file_entry.path]
+                content, omitted_characters = bound_text(extracted_text.result(), assignment_file, max_file_bytes)
+                omitted = f'{omitted_characters} characters' if omitted_characters else None
+            else:
+                content, omitted_bytes = read_file_bounded(assignment_file_entry.path, max_file_bytes,
+                                                           assignment_file_entry.size)
+                omitted = f'{omitted_bytes} bytes' if omitted_bytes else None
+            if omitted:
+                logging.warning(f"Truncated {assignment_file}: {omitted} over the file limit were left out.")
+                dropped_content.append({'file': assignment_file, 'reason': 'file limit exceeded',
+                                        'original_bytes': assignment_file_entry.size,
+                                        'kept_characters': len(content)})
+
+            if len(content) > remaining_characters:
+                logging.warning(f"Truncated {assignment_file}: the submission limit of {max_submission_tokens} tokens was reached.")
+                dropped_content.append({'file': assignment_file, 'reason': 'submission limit reached',
+                                        'original_bytes': assignment_file_entry.size,
+                                        'kept_characters': remaining_characters})
+                omitted_characters = len(content) - remaining_characters
+                combined_assignment_content.write(content[:remaining_characters])
+                combined_assignment_content.write(f'\n[... {omitted_characters} characters of {assignment_file} '
+                                                  'omitted: submission limit reached ...]')
+            else:
+                combined_assignment_content.write(content)
+            combined_assignment_content.write("\n\n")  # Combine content with two newlines as a separator
+            remaining_characters -= len(content)
         except UnicodeDecodeError:
             logging.error(f"The file {assignment_file} is not UTF-8 encoded.")
-            messagebox.showinfo('Error!', f'The file {assignment_file} is not UTF-8 encoded. Click "OK" to continue grading.')
+            general_functions.show_info('Error!', f'The file {assignment_file} is not UTF-8 encoded. Click "OK" to continue grading.')
+        except document_extraction.ExtractionError as ex:
+            logging.error(f"Could not convert {assignment_file} to text: {ex}")
+            general_functions.show_info('Error!', f'I could not read {assignment_file}. Error: {ex}. Click "OK" to continue grading.')
         except FileNotFoundError:
             logging.error(f"The file {assignment_file} was not found.")
         except Exception as ex:
             logging.error(f"An unexpected error occurred while reading {assignment_file}: {ex}")
-            messagebox.showinfo('Error!', f'I ran into an error reading the assignment. Error: {ex}. Click "OK" to continue grading.')
+            general_functions.show_info('Error!', f'I ran into an error reading the assignment. Error: {ex}. Click "OK" to continue grading.')
 
-    return combined_assignment_content
+    return combined_assignment_content.getvalue()
 
 
-def grade_combined_assignment(grading_criteria, combined_assignment_content, student_folder, first_run):
+def grade_combined_assignment(grading_criteria, combined_assignment_content, student_folder,
+                              use_cache=settings.USE_RESPONSE_CACHE, model_name=settings.ENGINE_NAME,
+                              grading_details=None, backend=None, samples=settings.CONSENSUS_SAMPLES):
     """
     Grade the combined content of all assignment files for a single student.
 
     Args:
-        grading_criteria (str): The criteria to use for grading the assignments.
+        grading_criteria (general_functions.CriteriaPrefix or str): The criteria to use for 
+        grading the assignments, ideally prepared once per run with 
+        `general_functions.build_criteria_prefix`.
         combined_assignment_content (str): The combined content of all valid assignment
         files for a student.
-        student_folder (str): The name of the student's folder, used for logging and 
-        result file naming.
-        first_run (bool): Flag to indicate if this is the first grading run.
+        student_folder (str): The name of the student's folder, used for logging.
+        use_cache (bool, optional): Serve and store the response in the local response 
+        cache. Defaults to settings.USE_RESPONSE_CACHE.
+        model_name (str, optional): The model to grade with. Defaults to settings.ENGINE_NAME.
+        grading_details (dict, optional): If given, it is filled with the `model` that 
+        graded the student, the `prompt_tokens` and `completion_tokens` used, the 
+        `latency_seconds` of the API call, whether the grade was `cached` and whether 
+        it was settled by the local pre-screen (`prescreened`).
+        backend (str or grading_backends.GradingBackend, optional): The backend to grade 
+        with. Defaults to settings.GRADING_BACKEND.
+        samples (int, optional): Number of independent gradings to merge into the grade 
+        (see `grade_consensus`). Defaults to settings.CONSENSUS_SAMPLES.
+
+    Returns:
+        str or None: The grading response from the external API, or None if the
+        student did not submit anything gradable.
 
     This function takes the combined assignment content for a student, and grades 
-    it using an external API. The grading results are then written to a file. In 
-    case of any errors during the grading process, appropriate logging and user 
-    notifications are done.
+    it using an external API, through the grading backend (see `grading_backends`). It is safe to call from a worker thread: it does not 
+    touch any Tkinter elements or the results file, so `grade_assignments` can run 
+    many of these calls at once and write the results afterwards.
+
+    When the cache is enabled and the same criteria and submission were already graded 
+    with the same model, the cached response is returned without calling the API. A 
+    response from the backup model (see `open_ai_api_calls.generate_chat_completions`), or 
+    from the cheaper model the budget downgraded the request to, is cached under that model, 
+    not the requested one.
+
+    Before the request is sent, its prompt tokens are counted and the backend picks its 
+    model; the OpenAI backend routes it to the cheapest model whose context window fits 
+    it (see `model_routing.select_model`). The token count, model and estimated cost of 
+    every request are logged.
+
+    With settings.PRESCREEN_WITH_LOCAL_RUBRIC, the submission is first scored by the 
+    local rubric backend, and when it earns less than settings.PRESCREEN_ACCEPT_BELOW 
+    of the rubric's points, that grade is kept and no request is sent. Such grades are 
+    not cached, so a later run without the pre-screen sends the request.
+
+    With settings.STREAM_STOP_AFTER_GRADE, the streamed response is cut off as soon as 
+    its grade line is complete (see `results_store.has_complete_grade`), which saves the 
+    completion tokens of the feedback after it.
+
+    With more than one sample, all of them are asked for in one request where the backend 
+    allows it (the API's `n` parameter), and merged by `grade_consensus.merge_samples` into 
+    the median grade. grading_details then also holds the `sample_scores` and whether the 
+    student `needs_review` because the samples disagree. Every sample is cached on its own, 
+    so raising the number of samples only requests the new ones.
+
+    Raises:
+        model_routing.SubmissionTooLargeError: If the submission fits no model's context window.
+        Exception: Any error raised while grading is passed on to the caller so 
+        it can be reported for this student without stopping the others.
+    """
+    if not combined_assignment_content:
+        logging.warning(f'No assignment submitted for: {student_folder}')
+        return None
+
+    if isinstance(grading_criteria, str):
+        grading_criteria = general_functions.build_criteria_prefix(grading_criteria)
+    grading_details = grading_details if grading_details is not None else {}
+    backend = grading_backends.get_backend(backend)
+    cache_model = backend.cache_model(model_name)
+    if samples > 1:
+        return _grade_consensus(grading_criteria, combined_assignment_content, student_folder, use_cache,
+                                model_name, grading_details, backend, samples)
+    cache_key, cached_response = _get_cached_grade(grading_criteria, combined_assignment_content, student_folder,
+                                                   use_cache, cache_model, grading_details)
+    if cached_response is not None:
+        return cached_response
+
+    if settings.PRESCREEN_WITH_LOCAL_RUBRIC and backend.name != grading_backends.LocalRubricBackend.name:
+        prescreen_response = _prescreen(grading_criteria, combined_assignment_content, student_folder,
+                                        grading_details)
+        # The local grade is not cached: it is free to recompute, and must never be served as an API grade
+        if prescreen_response is not None:
+            return prescreen_response
+
+    message, prompt_tokens, routed_model = _build_grading_request(grading_criteria, combined_assignment_content,
+                                                                  student_folder, model_name, backend)
+    started_at = time.perf_counter()
+    stop_when = results_store.has_complete_grade if settings.STREAM_STOP_AFTER_GRADE else None
+    ai_response = backend.grade(message, routed_model, prompt_tokens=prompt_tokens, details=grading_details,
+                                stop_when=stop_when)
+    latency_seconds = time.perf_counter() - started_at
+    instrumentation.record('api_call', latency_seconds)
+    grading_details['latency_seconds'] = round(latency_seconds, 3)
+    # A response cut off after its grade line is not cached, so it is never served to a full run
+    if use_cache and not grading_details.get('stopped_early'):
+        cache_key, cache_model = _answer_cache_key(grading_criteria, combined_assignment_content, cache_key,
+                                                   cache_model, routed_model, grading_details, backend)
+        response_cache.store_response(cache_key, cache_model, ai_response)
+    logging.info(f"Graded combined assignments for {student_folder}")
+    return ai_response
+
+
+def _grade_consensus(criteria_prefix, combined_assignment_content, student_folder, use_cache, model_name,
+                     grading_details, backend, samples):
+    """
+    Grade a student `samples` times and merge the gradings (see `grade_combined_assignment`).
+
+    Returns:
+        str or None: The merged grade response, or None if every sample failed.
+    """
+    cache_model = backend.cache_model(model_name)
+    cached_samples = {}
+    cache_keys = []
+    if use_cache:
+        cache_keys = [response_cache.make_cache_key(grade_consensus.sample_cache_model(cache_model, index),
+                                                    criteria_prefix.criteria_hash, combined_assignment_content)
+                      for index in range(samples)]
+        for index, cache_key in enumerate(cache_keys):
+            cached_response = response_cache.get_cached_response(cache_key)
+            if cached_response is not None:
+                cached_samples[index] = cached_response
+    missing = [index for index in range(samples) if index not in cached_samples]
+    grading_details.update(cached=not missing, model=cache_model)
+    if cached_samples:
+        logging.info(f"Using {len(cached_samples)} cached gradings of {samples} for {student_folder}")
+        instrumentation.count('cache_hits', len(cached_samples))
+
+    if missing and settings.PRESCREEN_WITH_LOCAL_RUBRIC and backend.name != grading_backends.LocalRubricBackend.name:
+        prescreen_response = _prescreen(criteria_prefix, combined_assignment_content, student_folder,
+                                        grading_details)
+        if prescreen_response is not None:
+            return prescreen_response
+
+    if missing:
+        message, prompt_tokens, routed_model = _build_grading_request(criteria_prefix, combined_assignment_content,
+                                                                      student_folder, model_name, backend)
+        started_at = time.perf_counter()
+        responses = backend.grade_samples(message, routed_model, len(missing), prompt_tokens=prompt_tokens,
+                                          details=grading_details)
+        latency_seconds = time.perf_counter() - started_at
+        instrumentation.record('api_call', latency_seconds)
+        grading_details['latency_seconds'] = round(latency_seconds, 3)
+        for index, response in zip(missing, responses):
+            cached_samples[index] = response
+            if use_cache and response is not None:
+                response_cache.store_response(*_answer_cache_key(criteria_prefix, combined_assignment_content,
+                                                                 cache_keys[index], cache_model, routed_model,
+                                                                 grading_details, backend, index), response)
+
+    ai_response, consensus = grade_consensus.merge_samples([cached_samples.get(index) for index in range(samples)])
+    grading_details.update(consensus)
+    if consensus['needs_review']:
+        logging.warning(f"The gradings of {student_folder} disagree "
+                        f"({results_store.format_sample_scores(consensus['sample_scores'])}). Flagged for review.")
+    logging.info(f"Graded combined assignments for {student_folder} {samples} times")
+    return ai_response
+
+
+def _get_cached_grade(criteria_prefix, combined_assignment_content, student_folder, use_cache, model_name,
+                      grading_details):
+    """
+    Look up a student's grade in the response cache.
+
+    Returns:
+        tuple: (cache_key, cached_response). The key is None when the cache is not used, 
+        and the response is None when there is no cached grade.
+    """
+    grading_details['cached'] = False
+    if not use_cache:
+        return None, None
+
+    cache_key = response_cache.make_cache_key(model_name, criteria_prefix.criteria_hash, combined_assignment_content)
+    cached_response = response_cache.get_cached_response(cache_key)
+    if cached_response is not None:
+        logging.info(f"Using cached grade for {student_folder}")
+        grading_details.update(cached=True, model=model_name)
+        instrumentation.count('cache_hits')
+    return cache_key, cached_response
+
+
+def _answer_cache_key(criteria_prefix, combined_assignment_content, cache_key, cache_model, routed_model,
+                      grading_details, backend, index=0):
+    """
+    Return the cache key and cache model to store a response under.
+
+    When the rate limits sent the request on to the backup model, or the budget downgraded it 
+    (see `usage_ledger`), it was answered by another model than the one it was routed to. Its 
+    response is cached under the model that answered, so it is never served as a grade of the 
+    requested model.
+
+    Returns:
+        tuple: (cache_key, cache_model), for the sample `index` of a consensus grading.
+    """
+    answered_model = grading_details.get('model')
+    if cache_key is None or not answered_model or answered_model == routed_model:
+        return cache_key, grade_consensus.sample_cache_model(cache_model, index)
+    answer_cache_model = grade_consensus.sample_cache_model(backend.cache_model(answered_model), index)
+    return (response_cache.make_cache_key(answer_cache_model, criteria_prefix.criteria_hash,
+                                          combined_assignment_content), answer_cache_model)
+
+
+def _prescreen(criteria_prefix, combined_assignment_content, student_folder, grading_details):
+    """
+    Score a submission with the local rubric backend and keep the grade if it is low enough.
+
+    Returns:
+        str or None: The local grade when it is below settings.PRESCREEN_ACCEPT_BELOW of the 
+        rubric's points, otherwise None.
+    """
+    message = general_functions.combine_contents_into_message(criteria_prefix, combined_assignment_content)
+    local_details = {}
+    local_response = grading_backends.get_backend(grading_backends.LocalRubricBackend.name).grade(
+        message, grading_backends.LocalRubricBackend.name, details=local_details)
+    score, max_score = results_store.extract_score(local_response)
+    if score is None or not max_score or score / max_score >= settings.PRESCREEN_ACCEPT_BELOW:
+        return None
+
+    logging.info(f"{student_folder} scored {score:g}/{max_score:g} in the local pre-screen. Keeping that grade.")
+    grading_details.update(local_details, prescreened=True)
+    instrumentation.count('prescreened')
+    return local_response
+
+
+def _build_grading_request(criteria_prefix, combined_assignment_content, student_folder, model_name, backend):
+    """
+    Build a student's chat messages, count their tokens and let the backend pick their model.
+
+    Returns:
+        tuple: (message, prompt_tokens, routed_model).
+    """
+    with instrumentation.stage('prompt_build'):
+        message = general_functions.combine_contents_into_message(criteria_prefix, combined_assignment_content)
+        prompt_tokens = token_counter.count_tokens(message, model_name)
+        routed_model = backend.select_model(prompt_tokens, model_name)
+    logging.info(f"{student_folder}: {prompt_tokens} prompt tokens sent to {routed_model} "
+                 f"(estimated cost ${model_routing.estimate_cost(routed_model, prompt_tokens):.4f})")
+    return message, prompt_tokens, routed_model
+
+
+def submit_section_grades(executor, sections, combined_assignment_content, student_folder,
+                          use_cache=settings.USE_RESPONSE_CACHE, model_name=settings.ENGINE_NAME,
+                          grading_details=None, backend=None, max_retries=settings.SECTION_MAX_RETRIES,
+                          samples=settings.CONSENSUS_SAMPLES):
+    """
+    Grade every rubric section of a student's submission at the same time and merge the grades.
+
+    Args:
+        executor (concurrent.futures.Executor): The worker pool the sections are graded in.
+        sections (list): The rubric_sections.Section entries of the run.
+        combined_assignment_content (str): The combined content of all valid assignment
+        files for a student.
+        student_folder (str): The name of the student's folder, used for logging.
+        use_cache (bool, optional): Serve and store each section's response in the response cache.
+        model_name (str, optional): The model to grade with. Defaults to settings.ENGINE_NAME.
+        grading_details (dict, optional): Filled like by `grade_combined_assignment` once every 
+        section is graded: the tokens of all sections, the slowest section's latency, the 
+        models used, the `section_scores`, and with several samples whether any section 
+        `needs_review`.
+        backend (str, optional): The grading backend. Defaults to settings.GRADING_BACKEND.
+        max_retries (int, optional): How many times a failed section is graded again right 
+        away. Defaults to settings.SECTION_MAX_RETRIES.
+        samples (int, optional): Number of independent gradings merged into each section's 
+        grade. Defaults to settings.CONSENSUS_SAMPLES.
+
+    Returns:
+        concurrent.futures.Future: The merged grade (see `rubric_sections.merge_section_results`), 
+        or None if a section still failed after its retries.
+
+    Each section is a separate `grade_combined_assignment` call in the worker pool, so the 
+    sections of a student run side by side. Nothing waits on a worker thread: the merged 
+    grade is completed by the callback of the last section to finish.
+    """
+    merged = Future()
+    grading_details = grading_details if grading_details is not None else {}
+    responses = [None] * len(sections)
+    section_details = [{} for _ in sections]
+    attempts = [0] * len(sections)
+    remaining = [len(sections)]
+    lock = threading.Lock()
+
+    def submit(index):
+        section_details[index] = {}
+        future = instrumentation.submit_timed(executor, grade_combined_assignment, sections[index].criteria_prefix,
+                                              combined_assignment_content,
+                                              f'{student_folder} [{sections[index].title}]', use_cache,
+                                              model_name, section_details[index], backend, samples)
+        future.add_done_callback(lambda done, index=index: section_done(index, done))
+
+    def section_done(index, future):
+        try:
+            response = future.result()
+        except Exception as ex:
+            logging.error(f"Grading section {sections[index].title} for {student_folder} failed. Error: {ex}")
+            response = None
+        if response is None and attempts[index] < max_retries:
+            attempts[index] += 1
+            instrumentation.count('section_retries')
+            logging.warning(f"Grading section {sections[index].title} for {student_folder} again")
+            submit(index)
+            return
+
+        with lock:
+            responses[index] = response
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        try:
+            merged.set_result(merge_sections())
+        except Exception as ex:
+            merged.set_exception(ex)
+
+    def merge_sections():
+        grading_details.update(
+            model=', '.join(sorted({details['model'] for details in section_details if details.get('model')})),
+            prompt_tokens=sum(details.get('prompt_tokens') or 0 for details in section_details),
+            completion_tokens=sum(details.get('completion_tokens') or 0 for details in section_details),
+            latency_seconds=max(details.get('latency_seconds') or 0 for details in section_details),
+            cached=all(details.get('cached') for details in section_details))
+        if samples > 1:
+            grading_details['needs_review'] = any(details.get('needs_review') for details in section_details)
+        if None in responses:
+            failed = [section.title for section, response in zip(sections, responses) if response is None]
+            logging.error(f"Could not grade {', '.join(failed)} for {student_folder}")
+            return None
+        ai_response, grading_details['section_scores'] = rubric_sections.merge_section_results(sections, responses)
+        return ai_response
+
+    for index in range(len(sections)):
+        submit(index)
+    return merged
+
+
+def queue_batch_grade(batch_requests, grading_criteria, combined_assignment_content, student_folder,
+                      use_cache=settings.USE_RESPONSE_CACHE, model_name=settings.ENGINE_NAME,
+                      grading_details=None):
+    """
+    Add a student's grading request to a Batch API run instead of sending it right away.
 
-    Note: The function continues the grading process for other students even if 
-    an error occurs with one student.
+    Args:
+        batch_requests (list): The requests of the run, later sent by `grade_batch_requests`.
+        grading_criteria (general_functions.CriteriaPrefix): The criteria prepared once per run.
+        combined_assignment_content (str): The combined content of all valid assignment
+        files for a student.
+        student_folder (str): The name of the student's folder. It identifies the request 
+        in the batch, so it must be unique within the run.
+        use_cache (bool, optional): Serve and store the response in the local response cache.
+        model_name (str, optional): The model to grade with. Defaults to settings.ENGINE_NAME.
+        grading_details (dict, optional): Filled in like by `grade_combined_assignment` once 
+        the batch has been graded.
+
+    Returns:
+        concurrent.futures.Future: The student's grade. It is already done when the grade 
+        came from the cache, the request could not be built or would pass a budget cap 
+        (see `usage_ledger`), and is completed by `grade_batch_requests` otherwise.
     """
+    future = Future()
+    grading_details = grading_details if grading_details is not None else {}
     try:
-        if not combined_assignment_content:
-            logging.warning(f'No assignment submitted for: {student_folder}')
-        else:
-            message = general_functions.combine_contents_into_message(grading_criteria, combined_assignment_content)
-            ai_response = open_ai_api_calls.generate_chat_completions(message)
-            write_results_to_file(ai_response, student_folder, first_run)
-            logging.info(f"Graded combined assignments for {student_folder}")
+        cache_key, cached_response = _get_cached_grade(grading_criteria, combined_assignment_content,
+                                                       student_folder, use_cache, model_name, grading_details)
+        if cached_response is not None:
+            future.set_result(cached_response)
+            return future
+
+        message, prompt_tokens, routed_model = _build_grading_request(
+            grading_criteria, combined_assignment_content, student_folder, model_name,
+            grading_backends.get_backend(grading_backends.OpenAIBackend.name))
+        # Held against the budget until the job's results are in
+        reservation = usage_ledger.get_ledger().reserve(routed_model, prompt_tokens)
     except Exception as ex:
-        logging.error(f"An unexpected error occurred while grading combined assignments for {student_folder}: {ex}")
-        messagebox.showinfo('Error!', f'I ran into an error grading the combined assignments for {student_folder}. Error: {ex}. Click "OK" to continue grading.')
+        future.set_exception(ex)
+        return future
+
+    grading_details.update(model=reservation.model_name, prompt_tokens=prompt_tokens, completion_tokens=None)
+    # A request the budget downgraded is cached under the downgraded model
+    cache_key, cache_model = _answer_cache_key(grading_criteria, combined_assignment_content, cache_key, model_name,
+                                               routed_model, grading_details,
+                                               grading_backends.get_backend(grading_backends.OpenAIBackend.name))
+    batch_requests.append({'student': student_folder, 'model': reservation.model_name, 'message': message,
+                           'cache_key': cache_key, 'cache_model': cache_model, 'future': future,
+                           'grading_details': grading_details, 'reservation': reservation})
+    return future
+
+
+def grade_batch_requests(batch_requests, request_path):
+    """
+    Grade the queued requests of a run as one Batch API job and complete their futures.
 
+    Args:
+        batch_requests (list): The requests added by `queue_batch_grade`.
+        request_path (str): The JSON Lines request file of the job (see `batch_api.run_batch`).
 
-def grade_assignments(assignments_folder, grading_criteria, allowed_extensions, first_run=True):
+    Every student's future gets the grade from the job's output, None when their request 
+    failed, or the error when the whole job failed, so they are recorded as failed and 
+    graded again by the next run. The usage of every answered request is written to the 
+    usage ledger.
+    """
+    logging.info(f'Sending {len(batch_requests)} grading requests as one batch job')
+    try:
+        with instrumentation.stage('batch_api'):
+            results = batch_api.run_batch([(request['student'], request['model'], request['message'])
+                                           for request in batch_requests], request_path)
+    except Exception as ex:
+        logging.error(f'The grading batch job failed. Error: {ex}')
+        for request in batch_requests:
+            usage_ledger.get_ledger().release(request['reservation'])
+            request['future'].set_exception(ex)
+        return
+
+    for request in batch_requests:
+        if request['student'] not in results:
+            usage_ledger.get_ledger().release(request['reservation'])
+            request['future'].set_exception(batch_api.BatchJobError('The batch job returned no result.'))
+            continue
+
+        response = results[request['student']]
+        ai_response = response['choices'][0]['message']['content'] if response else None
+        usage = (response or {}).get('usage') or {}
+        grading_details = request['grading_details']
+        grading_details['prompt_tokens'] = usage.get('prompt_tokens') or grading_details['prompt_tokens']
+        grading_details['completion_tokens'] = usage.get('completion_tokens')
+        if response:
+            usage_ledger.get_ledger().record(request['model'], grading_details['prompt_tokens'],
+                                             grading_details['completion_tokens'], request['reservation'])
+        else:
+            usage_ledger.get_ledger().release(request['reservation'])
+        if request['cache_key']:
+            response_cache.store_response(request['cache_key'], request['cache_model'], ai_response)
+        request['future'].set_result(ai_response)
+
+def grade_assignments(assignments_folder, grading_criteria, allowed_extensions, resume=True,
+                      max_workers=settings.MAX_GRADING_WORKERS, use_cache=settings.USE_RESPONSE_CACHE,
+                      model_name=settings.ENGINE_NAME, results_path=None, executor=None,
+                      scan_workers=settings.SCAN_WORKERS, deduplicate=settings.DEDUPLICATE_SUBMISSIONS,
+                      use_batch_api=False, backend=None, grade_by_section=settings.GRADE_BY_SECTION,
+                      students=None, samples=settings.CONSENSUS_SAMPLES, stream=settings.STREAM_PIPELINE,
+                      max_pending_grades=settings.MAX_PENDING_GRADES):
     """
     Grade assignments for each student based on the provided criteria.
 
@@ -220,14 +852,90 @@ def grade_assignments(assignments_folder, grading_criteria, allowed_extensions,
         grading_criteria (str): The criteria to use for grading assignments.
         allowed_extensions (list): List of file extensions that are considered 
         valid for assignments.
-        first_run (bool, optional): Flag to indicate if this is the initial run of the 
-        grading process. Defaults to True.
+        resume (bool, optional): Reuse the results of the previous run for students 
+        whose files have not changed. Pass False to regrade everyone. Defaults to True.
+        max_workers (int, optional): Number of students graded at the same time. 
+        Defaults to settings.MAX_GRADING_WORKERS.
+        use_cache (bool, optional): Reuse cached grades for unchanged submissions. Pass 
+        False to bypass the response cache. Defaults to settings.USE_RESPONSE_CACHE.
+        model_name (str, optional): The model to grade with. Defaults to settings.ENGINE_NAME.
+        results_path (str, optional): The results file to write. Defaults to 
+        get_results_file_path().
+        executor (concurrent.futures.Executor, optional): A worker pool shared with other 
+        runs, e.g. by the batch orchestrator. It is left running afterwards. When not 
+        given, a pool of `max_workers` threads is created for this run.
+        scan_workers (int, optional): Number of threads scanning the student folders. 
+        Defaults to settings.SCAN_WORKERS.
+        deduplicate (bool, optional): Leave out starter files shared by many students and 
+        grade identical submissions once. Defaults to settings.DEDUPLICATE_SUBMISSIONS.
+        use_batch_api (bool, optional): Send all requests as one OpenAI Batch API job 
+        (see `batch_api`) and wait for it, instead of sending them one by one. Defaults to False. 
+        Only the OpenAI backend supports it.
+        backend (str, optional): The grading backend (see `grading_backends`). Defaults to 
+        settings.GRADING_BACKEND.
+        grade_by_section (bool, optional): Grade every section of the criteria with its own 
+        request and merge the scores (see `rubric_sections`). Criteria that cannot be split 
+        are graded as a whole. Defaults to settings.GRADE_BY_SECTION.
+        students (set, optional): Only read and grade these students, e.g. the ones watch 
+        mode saw change (see `watch_mode`). Everyone else keeps their record from the 
+        previous run, or is left out until they have one. Defaults to every student.
+        samples (int, optional): Grade every student this many times and keep the median 
+        grade, flagging students whose gradings disagree (see `grade_consensus`). Changing 
+        it regrades everyone, but the gradings already cached are reused. Defaults to 
+        settings.CONSENSUS_SAMPLES.
+        stream (bool, optional): Keep memory flat for very large classes: scan the student 
+        folders lazily, convert binary files a chunk of students ahead, and keep the grade 
+        responses in the run manifest on disk instead of in memory. Defaults to 
+        settings.STREAM_PIPELINE.
+        max_pending_grades (int, optional): The most students read but not yet recorded. 
+        Reading waits for the oldest grade when there are more, so submissions never pile 
+        up in memory faster than they are graded. Defaults to settings.MAX_PENDING_GRADES.
+
+    Returns:
+        dict or None: Student name -> the student's record in the run manifest, or None 
+        if the grading process failed. In a streamed run the records leave out the 
+        `result`, which is in the results store.
+
+    The assignments folder is first indexed in a single pass by `folder_scanner`, which 
+    records every student's gradable files with their size and mtime. This function then 
+    iterates over the students in sorted order. For each student, it reads and combines all valid assignment files 
+    using the `read_student_files` function and hands the combined content to a pool of 
+    worker threads, which grade it with the `grade_combined_assignment` function. If a 
+    student's folder is empty, a log message is recorded, and the result "No assignment 
+    submitted" is recorded for them.
+
+    Every student's status, file fingerprint, content hash and result is checkpointed 
+    in a run manifest (see `run_manifest`) as soon as it is known. When resuming, students 
+    that were graded before and whose files are unchanged (same size and mtime, or same 
+    content hash) are not read or graded again; only new, failed and modified students are. 
+    Once all students are done, the results file is rewritten in sorted student order.
 
-    This function iterates over each student's folder within the main assignments folder. 
-    For each student, it reads and combines all valid assignment files using the 
-    `read_student_files` function. The combined content is then graded using the 
-    `grade_combined_assignment` function. If a student's folder is empty, 
-    a log message is recorded, and the result "No assignment submitted" is written to a file.
+    When deduplicating, files that many students share unchanged (see 
+    `submission_similarity.find_boilerplate_files`) are left out of every submission, and 
+    a student whose submission is identical to one already sent is graded by that same 
+    request; their record names the student it was graded with as `duplicate_of`. Every 
+    submission is also sketched with MinHash, and students whose submissions are at least 
+    settings.SIMILARITY_THRESHOLD alike are listed in each other's `similar_to` in the report.
+
+    With `use_batch_api`, the requests are queued by `queue_batch_grade` instead, written to 
+    a JSON Lines request file next to the results (grading_results_batch.jsonl) and graded 
+    as one batch job by `grade_batch_requests` once every student has been read. Such runs 
+    are not bound by `max_pending_grades`.
+
+    Every request is held to the budget caps of the usage ledger (see `usage_ledger`). Once 
+    a cap is reached no more requests are sent, and the students left ungraded are recorded 
+    as failed, so the next run grades them. `cost_estimate.estimate_assignments` tells what 
+    a run will cost before it is started.
+
+    File reading and user notifications stay on the calling thread, since Tkinter 
+    is not thread safe; only the API calls run in the worker threads.
+
+    Spreadsheets, documents, PDFs and notebooks of the students to grade are converted to 
+    text by `document_extraction.extract_files` in worker processes, which run while the 
+    first students are read and graded (see `_convert_ahead`).
+
+    The time spent in each stage (scan, extract, read, queue_wait, prompt_build, api_call, similarity, write) 
+    and the token usage are recorded in the current run's metrics (see `instrumentation`).
 
     In case of any unexpected errors during the grading process, appropriate logging 
     and user notifications are done.
@@ -236,56 +944,343 @@ def grade_assignments(assignments_folder, grading_criteria, allowed_extensions,
     error occurs with one student.
     """
     try:
-        for student_folder in os.listdir(assignments_folder):
-            student_folder_path = os.path.join(assignments_folder, student_folder)
+        if use_cache:
+            response_cache.prune_cache()
+        if settings.USE_EXTRACTION_CACHE:
+            extraction_cache.prune_cache()
+
+        results_path = results_path or get_results_file_path()
+        if os.path.dirname(results_path):
+            os.makedirs(os.path.dirname(results_path), exist_ok=True)
+        manifest_path = run_manifest.get_manifest_path(results_path)
+        criteria_prefix = general_functions.build_criteria_prefix(grading_criteria)
+        criteria_hash = criteria_prefix.criteria_hash
+        backend = grading_backends.get_backend(backend)
+        if use_batch_api and backend.name != grading_backends.OpenAIBackend.name:
+            logging.warning(f'The {backend.name} backend has no Batch API. Sending the requests one by one.')
+            use_batch_api = False
+        sections = rubric_sections.build_sections(grading_criteria) if grade_by_section else []
+        if sections and use_batch_api:
+            logging.warning('Rubric sections are not graded separately in a Batch API run.')
+            sections = []
+        if samples > 1 and use_batch_api:
+            logging.warning('Every student is graded once in a Batch API run.')
+            samples = 1
+        if sections:
+            logging.info(f"Grading the {len(sections)} rubric sections separately: "
+                         f"{', '.join(section.title for section in sections)}")
+        # Runs on another backend, or with another number of samples, never resume from (or into) this manifest
+        run_model = backend.cache_model(model_name)
+        if samples > 1:
+            run_model += f' x{samples}'
+        previous_students = {}
+        # A streamed run keeps the results on disk: student name -> offset of their record in the manifest
+        result_offsets = {} if stream else None
+        if resume:
+            previous_students = run_manifest.load_manifest(manifest_path, criteria_hash, run_model, result_offsets)
+
+        with run_manifest.ManifestWriter(manifest_path, criteria_hash, run_model,
+                                         previous_students, result_offsets) as manifest:
+            worker_pool = nullcontext(executor) if executor else ThreadPoolExecutor(max_workers=max(1, max_workers))
+            with worker_pool as executor:
+                # The grades not recorded yet, oldest first
+                pending_grades = deque()
+                with instrumentation.stage('scan'):
+                    if stream:
+                        scanned_folders = folder_scanner.iter_assignments_folder(assignments_folder,
+                                                                                 allowed_extensions, scan_workers)
+                    else:
+                        scanned_folders = folder_scanner.scan_assignments_folder(assignments_folder,
+                                                                                 allowed_extensions, scan_workers)
+                boilerplate_files = {}
+                if deduplicate:
+                    with instrumentation.stage('similarity'):
+                        # A streamed run scans the class a second time rather than keeping the first scan
+                        boilerplate_files = submission_similarity.find_boilerplate_files(
+                            folder_scanner.iter_assignments_folder(assignments_folder, allowed_extensions,
+                                                                   scan_workers) if stream else scanned_folders)
+                    instrumentation.count('boilerplate_files', len(boilerplate_files))
+
+                def files_to_convert(scanned_folder):
+                    if students is not None and scanned_folder.name not in students:
+                        return []
+                    if not run_manifest.needs_grading(previous_students.get(scanned_folder.name),
+                                                      run_manifest.fingerprint_files(scanned_folder.files)):
+                        return []
+                    return [assignment_file.path for assignment_file in scanned_folder.files
+                            if document_extraction.needs_extraction(assignment_file.name)
+                            and assignment_file.path not in boilerplate_files]
+
+                extracted_texts = {}
+                scanned_folders = _convert_ahead(scanned_folders, extracted_texts, files_to_convert,
+                                                 max(1, max_pending_grades) if stream else None)
+                # Content hash -> the student whose request grades that submission, and its pending grade
+                first_graded = {}
+                batch_requests = []
+
+                def record_oldest_grade():
+                    (student_folder, fingerprint, content_hash, future, dropped_content,
+                     grading_details, extra_fields) = pending_grades.popleft()
+                    record_graded_result(manifest, student_folder, fingerprint, content_hash, future,
+                                         dropped_content, grading_details, **extra_fields)
+                    if stream and first_graded.get(content_hash, (None,))[0] == student_folder:
+                        # Later identical submissions read the grade back from the manifest
+                        first_graded[content_hash] = (student_folder, None, grading_details)
+
+                for scanned_folder in scanned_folders:
+                    student_folder = scanned_folder.name
+                    student_folder_path = scanned_folder.path
+                    if students is not None and student_folder not in students:
+                        if student_folder in previous_students:
+                            manifest.carry_over(previous_students[student_folder])
+                        continue
+                    instrumentation.count('students')
+                    if not scanned_folder.entry_count:
+                        logging.info(f"The folder for {student_folder} is empty. Skipping...")
+                        manifest.record(student_folder, 'empty', result="No assignment submitted")
+                        continue
+
+                    fingerprint = run_manifest.fingerprint_files(scanned_folder.files)
+                    previous_record = previous_students.get(student_folder)
+                    if not run_manifest.needs_grading(previous_record, fingerprint):
+                        logging.info(f"The files for {student_folder} have not changed. Reusing the previous result.")
+                        manifest.carry_over(previous_record)
+                        continue
+
+                    dropped_content = []
+                    with instrumentation.stage('read'):
+                        combined_assignment_content = read_student_files(student_folder_path, allowed_extensions,
+                                                                         dropped_content,
+                                                                         scanned_folder=scanned_folder,
+                                                                         boilerplate_files=boilerplate_files,
+                                                                         extracted_texts=extracted_texts)
+                        content_hash = run_manifest.hash_text(combined_assignment_content)
+                        for assignment_file in scanned_folder.files:
+                            extracted_texts.pop(assignment_file.path, None)
+                    if (previous_record and previous_record.get('status') in run_manifest.REUSABLE_STATUSES
+                            and previous_record.get('content_hash') == content_hash):
+                        logging.info(f"The files for {student_folder} were touched but not changed. Reusing the previous result.")
+                        manifest.carry_over(previous_record, fingerprint)
+                        continue
 
-            if os.path.isdir(student_folder_path):
-                if not os.listdir(student_folder_path):
-                    logging.info(f"The folder for {student_folder} is empty. Skipping...")
-                    write_results_to_file("No assignment submitted", student_folder, first_run)
-                    continue
+                    if not combined_assignment_content:
+                        logging.warning(f'No assignment submitted for: {student_folder}')
+                        manifest.record(student_folder, 'no_submission', fingerprint, content_hash)
+                        continue
 
-                combined_assignment_content = read_student_files(student_folder_path, allowed_extensions)
-                grade_combined_assignment(grading_criteria, combined_assignment_content, student_folder, first_run)
+                    with instrumentation.stage('similarity'):
+                        extra_fields = {'minhash': submission_similarity.sketch_submission(combined_assignment_content)}
+                    if deduplicate and content_hash in first_graded:
+                        original_student, future, grading_details = first_graded[content_hash]
+                        if future is None:
+                            future = Future()
+                            future.set_result(manifest.read_result(original_student))
+                        logging.info(f"The submission of {student_folder} is identical to {original_student}'s. Grading it once.")
+                        instrumentation.count('duplicate_submissions')
+                        extra_fields['duplicate_of'] = original_student
+                    else:
+                        grading_details = {}
+                        if use_batch_api:
+                            future = queue_batch_grade(batch_requests, criteria_prefix, combined_assignment_content,
+                                                       student_folder, use_cache, model_name, grading_details)
+                        elif sections:
+                            future = submit_section_grades(executor, sections, combined_assignment_content,
+                                                           student_folder, use_cache, model_name, grading_details,
+                                                           backend, samples=samples)
+                        else:
+                            future = instrumentation.submit_timed(executor, grade_combined_assignment,
+                                                                  criteria_prefix, combined_assignment_content,
+                                                                  student_folder, use_cache, model_name,
+                                                                  grading_details, backend, samples)
+                        first_graded[content_hash] = (student_folder, future, grading_details)
+                    pending_grades.append((student_folder, fingerprint, content_hash, future, dropped_content,
+                                           grading_details, extra_fields))
+                    # Backpressure: stop reading until the oldest grades are in (a batch job grades them all at the end)
+                    while not use_batch_api and len(pending_grades) > max(1, max_pending_grades):
+                        record_oldest_grade()
 
-                first_run = False
+                if batch_requests:
+                    grade_batch_requests(batch_requests, get_batch_request_path(results_path))
+
+                while pending_grades:
+                    record_oldest_grade()
+
+            manifest.compact()
+
+        with instrumentation.stage('similarity'):
+            sketches = {student: record['minhash'] for student, record in manifest.students.items()
+                        if record.get('minhash')}
+            similar_submissions = submission_similarity.find_similar_submissions(sketches)
+        for student, matches in similar_submissions.items():
+            manifest.students[student]['similar_to'] = matches
+        if similar_submissions:
+            logging.warning(f"{len(similar_submissions)} students handed in submissions similar to another student's.")
+
+        if usage_ledger.get_ledger().exhausted:
+            logging.warning('The grading budget ran out during the run. The students it left ungraded are '
+                            'graded by the next run.')
+        write_results_to_file(manifest.iter_records(), results_path)
+        return manifest.students
     except Exception as ex:
         logging.error(f"An unexpected error occurred in grade_assignments. Error: {ex}")
-        messagebox.showerror('Error!', f'The grading process failed. Error: {ex}')
+        general_functions.show_error('Error!', f'The grading process failed. Error: {ex}')
+        return None
+
+
+def _convert_ahead(scanned_folders, extracted_texts, files_to_convert, chunk_size=None):
+    """
+    Hand out the scanned student folders, converting the binary files of the next chunk 
+    of students while the current chunk is read and graded.
+
+    Args:
+        scanned_folders (iterable): The folder_scanner.StudentFolder entries of the class.
+        extracted_texts (dict): Filled with file path -> pending text, from 
+        `document_extraction.extract_files`.
+        files_to_convert (callable): Returns the paths of a student's files to convert.
+        chunk_size (int, optional): Number of students whose files are converted together. 
+        Defaults to the whole class, converted before the first student is handed out.
+
+    Yields:
+        folder_scanner.StudentFolder: The scanned folders, in the same order.
+    """
+    previous_chunk = []
+    chunk = []
+    for scanned_folder in scanned_folders:
+        chunk.append(scanned_folder)
+        if chunk_size and len(chunk) >= chunk_size:
+            _convert_chunk(chunk, extracted_texts, files_to_convert)
+            yield from previous_chunk
+            previous_chunk, chunk = chunk, []
+    _convert_chunk(chunk, extracted_texts, files_to_convert)
+    yield from previous_chunk
+    yield from chunk
+
 
+def _convert_chunk(scanned_folders, extracted_texts, files_to_convert):
+    file_paths = [file_path for scanned_folder in scanned_folders for file_path in files_to_convert(scanned_folder)]
+    if file_paths:
+        with instrumentation.stage('extract'):
+            extracted_texts.update(document_extraction.extract_files(file_paths))
 
-def get_file_extension():
+
+def record_graded_result(manifest, student_folder, fingerprint, content_hash, future, dropped_content=None,
+                         grading_details=None, **fields):
     """
-    Prompt the user to input a file extension using a tkinter dialog.
+    Wait for a student's grade and checkpoint it in the run manifest.
+
+    Args:
+        manifest (run_manifest.ManifestWriter): The manifest of the current run.
+        student_folder (str): The name of the student's folder.
+        fingerprint (list): The student's file fingerprint.
+        content_hash (str): The hash of the student's combined submission.
+        future (concurrent.futures.Future): The pending grade for the student.
+        dropped_content (list, optional): The files `read_student_files` truncated or left 
+        out for the student. Kept in the record as `dropped_content` when not empty.
+        grading_details (dict, optional): The model, token counts, latency and cache flag 
+        filled in by `grade_combined_assignment`. Kept in the record, together with the 
+        score parsed from the response.
+        fields: Any other values to keep in the record, e.g. the `minhash` sketch of the 
+        submission, or `duplicate_of` when the grade came from an identical submission.
+
+    If grading the student failed, the error is logged, the user is notified and the 
+    student is recorded as failed, so the next run grades them again. Students left 
+    ungraded because the budget ran out (see `usage_ledger`) are recorded as failed 
+    without notifying the user.
+    """
+    if dropped_content:
+        fields['dropped_content'] = dropped_content
+    try:
+        ai_response = future.result()
+    except usage_ledger.BudgetExceededError as ex:
+        # Not an error in the submission: the student waits for a later run, without a dialog per student
+        logging.warning(f"{student_folder} was not graded. {ex}")
+        instrumentation.count('budget_deferred')
+        manifest.record(student_folder, 'failed', fingerprint, content_hash, **fields)
+        return
+    except Exception as ex:
+        logging.error(f"An unexpected error occurred while grading combined assignments for {student_folder}: {ex}")
+        general_functions.show_info('Error!', f'I ran into an error grading the combined assignments for {student_folder}. Error: {ex}. Click "OK" to continue grading.')
+        manifest.record(student_folder, 'failed', fingerprint, content_hash, **fields)
+        return
+
+    status = 'graded' if ai_response is not None else 'failed'
+    fields.update(grading_details or {})
+    if not fields.get('cached') and not fields.get('duplicate_of') and fields.get('model'):
+        instrumentation.count(f"requests[{fields['model']}]")
+        instrumentation.count('prompt_tokens', fields.get('prompt_tokens') or 0)
+        instrumentation.count('completion_tokens', fields.get('completion_tokens') or 0)
+    fields['score'], fields['max_score'] = results_store.extract_score(ai_response)
+    manifest.record(student_folder, status, fingerprint, content_hash, result=ai_response, **fields)
+
+
+def get_file_extensions():
+    """
+    Prompt the user to input the file extensions to grade using a tkinter dialog.
 
     Returns:
-        str or None: The provided file extension (e.g., ".xlsx") 
+        list or None: The provided file extensions (e.g., [".py", ".ipynb"]), 
         or None if the user cancels the dialog.
 
     Raises:
-        ValueError: If the provided string does not start with a 
+        ValueError: If a provided extension does not start with a 
         dot (e.g., "xlsx" instead of ".xlsx").
+
+    Several extensions can be entered at once, separated by spaces or commas.
     """
+    import tkinter
+    from tkinter import simpledialog
+
     try:
         root = tkinter.Tk()
         root.withdraw()  # Hide the main window
-        file_extension = simpledialog.askstring("Input", 'Please enter the file extension. (e.g., .xlsx):')
+        answer = simpledialog.askstring("Input", 'Please enter the file extensions, separated by spaces. '
+                                                 '(e.g., .py .ipynb .docx):')
+        file_extensions = answer.replace(',', ' ').split() if answer else []
 
-        if file_extension and not file_extension.startswith('.'):
-            raise ValueError("The provided file extension should start with a dot (e.g., '.xlsx').")
+        for file_extension in file_extensions:
+            if not file_extension.startswith('.'):
+                raise ValueError(f"The file extension {file_extension} should start with a dot (e.g., '.xlsx').")
 
         root.quit()
         root.destroy()
-        return file_extension
+        return file_extensions or None
     except Exception as ex:
-        logging.error(f"An unexpected error occurred in get_file_extension. Error: {ex}")
+        logging.error(f"An unexpected error occurred in get_file_extensions. Error: {ex}")
         return None
 
 
-def read_results_from_file():
+def get_results_email(results_path=None, max_inline_students=settings.EMAIL_INLINE_MAX_STUDENTS):
+    """
+    Build the results email of a run from its structured results store.
+
+    Args:
+        results_path (str, optional): The text results file of the run. Defaults to 
+        get_results_file_path().
+        max_inline_students (int, optional): The most students whose grades are written in 
+        the email body. Defaults to settings.EMAIL_INLINE_MAX_STUDENTS.
+
+    Returns:
+        tuple: (body, attachment_path). The body is a summary of the run followed by every 
+        student's grade, and attachment_path is None. For larger classes, the body only 
+        holds the summary, and attachment_path is the text report compressed with gzip 
+        next to the results file (grading_results.txt.gz), so the email stays small.
+    """
+    try:
+        results_path = results_path or get_results_file_path()
+        store = results_store.ResultsStore(results_store.get_store_path(results_path))
+        if store.count_report_entries() <= max_inline_students:
+            return store.render_email_body(), None
+        attachment_path = results_path + '.gz'
+        store.render_compressed_report(attachment_path)
+        return store.render_email_body(include_grades=False), attachment_path
+    except Exception as ex:
+        return f"An error occurred while reading the grading results: {ex}", None
+
+
+def read_results_from_file(file_path=None):
     """
     Retrieve the content of the 'grading_results.txt' file from the "Grading Results" 
-    folder in the user's Downloads directory.
+    folder in the user's Downloads directory, or of the results file at `file_path`.
 
     :return: A string containing the content of the 'grading_results.txt' file.
              If the file does not exist, it returns a message indicating so.
@@ -298,14 +1293,8 @@ def read_results_from_file():
     and its message is returned.
     """
     try:
-        # Detecting the operating system and setting the downloads folder path accordingly
-        downloads_folder = os.path.join(os.path.expanduser('~'), 'Downloads')
-
-        # Set the path to the "Grading Results" folder inside the Downloads folder
-        grading_results_folder = os.path.join(downloads_folder, 'Grading Results')
-
         # Set the file path within the "Grading Results" folder
-        file_path = os.path.join(grading_results_folder, 'grading_results.txt')
+        file_path = file_path or get_results_file_path()
 
         # Check if the file exists
         if os.path.exists(file_path):
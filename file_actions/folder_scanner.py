@@ -0,0 +1,131 @@
+"""
+folder_scanner Module
+
+This module scans an assignments folder in a single pass with `os.scandir` and
+builds an in-memory index of students -> gradable files, with each file's size
+and modification time. The graders then work from this index, so every folder
+is listed once and every gradable file is stat'ed once, instead of listing each
+student folder several times and calling `os.path.isdir` and `os.path.getsize`
+along the way. That metadata traffic is what makes large classes slow on
+network shares.
+
+On slow filesystems the student folders can be scanned by several threads at
+once (settings.SCAN_WORKERS); the index is always returned in sorted student
+order. Very large classes can also be scanned lazily with
+`iter_assignments_folder`, which only keeps the folder names and the next few
+scanned folders in memory.
+
+Dependencies:
+- logging: For recording files that are skipped or vanish while scanning.
+- os: For scanning the folders.
+- collections.deque: For the scanned folders not yet handed out.
+- collections.namedtuple: For the index entries.
+- concurrent.futures: For scanning student folders in parallel.
+- settings: For the default number of scanning threads.
+"""
+
+import logging
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from settings import settings
+
+# A gradable file of a student: its name, full path, size in bytes and mtime in nanoseconds
+AssignmentFile = namedtuple('AssignmentFile', ['name', 'path', 'size', 'mtime_ns'])
+
+# A scanned student folder: the student's name, the folder path, the number of entries
+# in the folder, its gradable files sorted by name, and the names of the other files
+StudentFolder = namedtuple('StudentFolder', ['name', 'path', 'entry_count', 'files', 'skipped_files'])
+
+
+def scan_assignments_folder(assignments_folder, allowed_extensions, max_workers=settings.SCAN_WORKERS):
+    """
+    Index every student folder in an assignments folder.
+
+    Args:
+        assignments_folder (str): Path to the main folder containing individual student
+        assignment folders.
+        allowed_extensions (list): List of file extensions that are considered valid for assignments.
+        max_workers (int, optional): Number of threads scanning student folders at the same
+        time. 1 scans them one after another. Defaults to settings.SCAN_WORKERS.
+
+    Returns:
+        list: One StudentFolder per sub folder, in sorted student order. Files in the
+        assignments folder itself are ignored.
+    """
+    return list(iter_assignments_folder(assignments_folder, allowed_extensions, max_workers))
+
+
+def iter_assignments_folder(assignments_folder, allowed_extensions, max_workers=settings.SCAN_WORKERS):
+    """
+    Scan the student folders of an assignments folder one after another, as they are needed.
+
+    Args:
+        assignments_folder (str): Path to the main folder containing individual student
+        assignment folders.
+        allowed_extensions (list): List of file extensions that are considered valid for assignments.
+        max_workers (int, optional): Number of threads scanning student folders ahead of the
+        caller. 1 scans each folder when it is asked for. Defaults to settings.SCAN_WORKERS.
+
+    Yields:
+        StudentFolder: One per sub folder, in sorted student order.
+
+    Only the sorted folder names are listed up front. At most `max_workers` folders are
+    scanned ahead, so memory does not grow with the number of files in the class.
+    """
+    with os.scandir(assignments_folder) as entries:
+        student_paths = sorted((entry.name, entry.path) for entry in entries if entry.is_dir())
+
+    if max_workers <= 1 or len(student_paths) <= 1:
+        for name, path in student_paths:
+            yield scan_student_folder(path, allowed_extensions, name)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scanner') as executor:
+        scans = deque()
+        for name, path in student_paths:
+            scans.append(executor.submit(scan_student_folder, path, allowed_extensions, name))
+            if len(scans) > max_workers:
+                yield scans.popleft().result()
+        while scans:
+            yield scans.popleft().result()
+
+
+def scan_student_folder(student_folder_path, allowed_extensions, name=None):
+    """
+    Index the gradable files in a single student's folder.
+
+    Args:
+        student_folder_path (str): The path to the individual student's folder.
+        allowed_extensions (list): List of file extensions that are considered valid for assignments.
+        name (str, optional): The student's name. Defaults to the folder name.
+
+    Returns:
+        StudentFolder: The student's gradable files (sorted by name) with their size and mtime.
+
+    Files are matched on their lower cased name ending with one of the extensions; sub
+    folders are never gradable files, whatever their name. A file that disappears between
+    listing and stat'ing the folder is logged and left out.
+    """
+    extensions = tuple(extension.lower() for extension in allowed_extensions)
+    files = []
+    skipped_files = []
+    entry_count = 0
+    with os.scandir(student_folder_path) as entries:
+        for entry in entries:
+            entry_count += 1
+            # A sub folder named like a file (e.g. "project.py/") is not read
+            if not entry.name.lower().endswith(extensions) or not entry.is_file():
+                skipped_files.append(entry.name)
+                continue
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                logging.warning(f"The file {entry.path} disappeared while scanning. Skipping...")
+                continue
+            files.append(AssignmentFile(entry.name, entry.path, stat_result.st_size, stat_result.st_mtime_ns))
+
+    files.sort()
+    skipped_files.sort()
+    return StudentFolder(name or os.path.basename(os.path.normpath(student_folder_path)), student_folder_path,
+                         entry_count, files, skipped_files)
@@ -0,0 +1,100 @@
+"""
+grade_consensus Module
+
+This module merges several independent gradings of the same submission into one grade.
+A single grading is noisy; asking for a few samples in one request (see the `samples`
+option of `file_actions.grade_combined_assignment`) and keeping the middle one gives a
+steadier grade for about the latency of one request.
+
+- Numeric grades ("Grade: 8/10") are merged into their median. The response kept is a
+  sample that gave the median score, so its feedback matches the grade.
+- Other grades (e.g. "Grade: B+") are merged by majority vote.
+
+A student is flagged for review when the samples disagree: when their scores spread over
+more than settings.CONSENSUS_MAX_SPREAD of the maximum score, when no grade has a
+majority, or when some samples have no score at all.
+
+Dependencies:
+- re: For reading letter grades.
+- statistics, collections.Counter: For the median and the majority vote.
+- results_store: For reading the score of each sample.
+"""
+
+import re
+import statistics
+from collections import Counter
+from file_actions import results_store
+from settings import settings
+
+# Matches e.g. "Grade: B+", "Final grade = A"
+_LETTER_GRADE_PATTERN = re.compile(r'(?:grade|score)\s*[:=]?\s*([A-F][+-]?)(?![\w+-])', re.IGNORECASE)
+
+
+def sample_cache_model(cache_model, index):
+    """
+    Return the model name a sample is cached under.
+
+    Args:
+        cache_model (str): The backend's cache model name (see `GradingBackend.cache_model`).
+        index (int): The sample's number, from 0.
+
+    Returns:
+        str: The cache model name itself for the first sample, so a single grading and the
+        first sample of a consensus share their cache entry; a numbered name otherwise.
+    """
+    return cache_model if index == 0 else f'{cache_model}#sample{index}'
+
+
+def merge_samples(responses, max_spread=settings.CONSENSUS_MAX_SPREAD):
+    """
+    Merge the sampled gradings of one student into one grade response.
+
+    Args:
+        responses (list): The grade response of each sample. Failed samples are None.
+        max_spread (float, optional): The largest spread of the sample scores, as a share of
+        the maximum score, that is not flagged for review. Defaults to settings.CONSENSUS_MAX_SPREAD.
+
+    Returns:
+        tuple: (response, consensus). The response is the sample that gave the median (or
+        majority) grade, or None when every sample failed. consensus holds the
+        `sample_scores` (None for a sample without a score) and whether the student
+        `needs_review`.
+    """
+    responses = [response for response in responses if response]
+    if not responses:
+        return None, {'sample_scores': [], 'needs_review': False}
+
+    scored = [(results_store.extract_score(response), response) for response in responses]
+    sample_scores = [score for (score, _), _ in scored]
+    numeric = [(score, max_score, response) for (score, max_score), response in scored if score is not None]
+    if not numeric:
+        return _majority_vote(responses, sample_scores)
+
+    median_score = statistics.median_low(score for score, _, _ in numeric)
+    response = next(response for score, _, response in numeric if score == median_score)
+    max_scores = Counter(max_score for _, max_score, _ in numeric if max_score is not None)
+    # Without a maximum score, the spread is measured against the highest score given
+    scale = max_scores.most_common(1)[0][0] if max_scores else max(score for score, _, _ in numeric)
+    spread = max(score for score, _, _ in numeric) - min(score for score, _, _ in numeric)
+    needs_review = len(numeric) < len(responses) or spread > max_spread * scale
+    return response, {'sample_scores': sample_scores, 'needs_review': needs_review}
+
+
+def _majority_vote(responses, sample_scores):
+    """
+    Keep the most common grade of samples without a numeric score.
+    """
+    labels = [_grade_label(response) for response in responses]
+    label, votes = Counter(labels).most_common(1)[0]
+    response = responses[labels.index(label)]
+    return response, {'sample_scores': sample_scores, 'needs_review': votes * 2 <= len(responses)}
+
+
+def _grade_label(response):
+    """
+    The grade a response gives: its letter grade, or else its first line.
+    """
+    match = _LETTER_GRADE_PATTERN.search(response)
+    if match:
+        return match.group(1).upper()
+    return ' '.join(response.strip().split('\n', 1)[0].lower().split())
@@ -0,0 +1,311 @@
+"""
+results_store Module
+
+This module keeps the results of a grading run as structured data, one JSON object
+per student in a JSON Lines file next to the text report (grading_results.txt ->
+grading_results.jsonl). Every student's record holds their status, grade response,
+parsed score, model, latency and token counts, the student whose identical
+submission it was graded with, the students with similar submissions and, when it was
+graded several times, the score of every grading and whether they disagree, so results
+can be queried without re-parsing the text report.
+
+The store is written once per run through a single buffered file handle, and the
+text report, CSV export and email body are all rendered from it by streaming over
+its records. For large classes, the email only holds a summary and the report is
+attached as a gzip file (see settings.EMAIL_INLINE_MAX_STUDENTS).
+
+Dependencies:
+- csv: For the CSV export.
+- gzip: For the compressed report attached to the email of a large class.
+- json: For reading and writing the store.
+- os: For file paths.
+- re: For finding the score in a grade response.
+"""
+
+import csv
+import gzip
+import json
+import os
+import re
+
+STORE_EXTENSION = '.jsonl'
+
+# The fields of a student record, in CSV column order
+FIELDS = ['student', 'status', 'score', 'max_score', 'model', 'latency_seconds',
+          'prompt_tokens', 'completion_tokens', 'cached', 'duplicate_of', 'similar_to', 'section_scores',
+          'sample_scores', 'needs_review', 'result']
+
+# Matches e.g. "Grade: 85/100", "Score: 17 out of 20", "Final grade = 92"
+_SCORE_PATTERN = re.compile(r'(?:grade|score)\s*[:=]?\s*(\d+(?:\.\d+)?)\s*(?:(?:/|out of)\s*(\d+(?:\.\d+)?))?',
+                            re.IGNORECASE)
+
+# The total line of a response whose score is not known, e.g. a merged response with an unscored section
+UNSCORED_GRADE = 'Grade: unknown'
+
+_WRITE_BUFFER_BYTES = 1024 * 1024
+
+
+def has_complete_grade(grade_response):
+    """
+    Check whether a (partial) grade response already holds a complete grade line.
+
+    Args:
+        grade_response (str): The text of the response received so far.
+
+    Returns:
+        bool: True once a score has been found and the line it is on has ended, so a
+        score like "8" is not mistaken for the start of "85/100".
+    """
+    match = _SCORE_PATTERN.search(grade_response)
+    return match is not None and '\n' in grade_response[match.end():]
+
+
+def format_similar_to(similar_to):
+    """
+    Format a student's similar submissions for the reports.
+
+    Args:
+        similar_to (list or None): The {"student", "similarity"} dicts of a record.
+
+    Returns:
+        str: e.g. "alice (93% similar), bob (85% similar)", or an empty string.
+    """
+    return ', '.join(f"{match['student']} ({match['similarity']:.0%} similar)" for match in similar_to or [])
+
+
+def format_section_scores(section_scores):
+    """
+    Format the per-section scores of a student graded by rubric section.
+
+    Args:
+        section_scores (list or None): The {"section", "score", "max_score"} dicts of a record.
+
+    Returns:
+        str: e.g. "Correctness: 8/10; Style: 4/5", or an empty string.
+    """
+    return '; '.join(f"{entry['section']}: {_format_points(entry['score'])}"
+                     + (f"/{entry['max_score']:g}" if entry['max_score'] is not None else '')
+                     for entry in section_scores or [])
+
+
+def format_sample_scores(sample_scores):
+    """
+    Format the scores of the sampled gradings of a student graded several times.
+
+    Args:
+        sample_scores (list or None): The score of each sample, None for a sample without one.
+
+    Returns:
+        str: e.g. "scores 8, 9, ?", or an empty string.
+    """
+    return f"scores {', '.join(_format_points(score) for score in sample_scores)}" if sample_scores else ''
+
+
+def _format_points(points):
+    return '?' if points is None else f'{points:g}'
+
+
+def _format_grade(record):
+    """
+    Format one student's entry of the text report and email body.
+    """
+    # Adding four new lines for separation, the student's name, and their grade
+    entry = f"\n\n\n\nStudent: {record['student']}\nGrade: {record['result']}"
+    if record.get('duplicate_of'):
+        entry += f"\nIdentical submission to: {record['duplicate_of']}"
+    if record.get('similar_to'):
+        entry += f"\nPossible shared work with: {format_similar_to(record['similar_to'])}"
+    if record.get('needs_review'):
+        disagreement = format_sample_scores(record.get('sample_scores')) or 'in a section'
+        entry += f"\nThe gradings disagree ({disagreement}). Please review."
+    return entry
+
+
+def _in_report(record):
+    """
+    Students who did not submit anything gradable are left out of the reports.
+    """
+    return record['result'] is not None or record['status'] == 'failed'
+
+
+def get_store_path(results_path):
+    """
+    Return the results store that belongs to a text results file.
+
+    Args:
+        results_path (str): The path to the text results file.
+
+    Returns:
+        str: The results path with its extension replaced by STORE_EXTENSION.
+    """
+    return os.path.splitext(results_path)[0] + STORE_EXTENSION
+
+
+def extract_score(grade_response):
+    """
+    Find the numeric score in a grade response.
+
+    Args:
+        grade_response (str or None): The grading response from the API.
+
+    Returns:
+        tuple: (score, max_score) as floats, either of which is None when it was not found. 
+        Both are None for a response that starts with UNSCORED_GRADE, whatever scores 
+        follow it.
+    """
+    if grade_response and grade_response.startswith(UNSCORED_GRADE):
+        return None, None
+    match = _SCORE_PATTERN.search(grade_response or '')
+    if not match:
+        return None, None
+    max_score = float(match.group(2)) if match.group(2) else None
+    return float(match.group(1)), max_score
+
+
+class ResultsStore:
+    """
+    A JSON Lines file holding one structured record per student of a grading run.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+
+    def write(self, student_records):
+        """
+        Replace the store with the records of a run, in sorted student order.
+
+        Args:
+            student_records (dict or iterable): Student name -> the student's record in the 
+            run manifest, or the records themselves, already in sorted student order (e.g. 
+            streamed by `run_manifest.ManifestWriter.iter_records`).
+
+        The records are written through one buffered handle to a temporary file that
+        then replaces the store, so readers never see a half written store.
+        """
+        temporary_path = self.store_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8', buffering=_WRITE_BUFFER_BYTES) as store_file:
+            if isinstance(student_records, dict):
+                student_records = (student_records[student_name] for student_name in sorted(student_records))
+            for record in student_records:
+                store_file.write(json.dumps({field: record.get(field) for field in FIELDS}) + '\n')
+        os.replace(temporary_path, self.store_path)
+
+    def __iter__(self):
+        """
+        Stream the student records from the store, one at a time.
+        """
+        if not os.path.exists(self.store_path):
+            return
+        with open(self.store_path, 'r', encoding='utf-8') as store_file:
+            for line in store_file:
+                yield json.loads(line)
+
+    def render_text_report(self, report_path):
+        """
+        Write the classic text report (grading_results.txt) from the store.
+
+        Args:
+            report_path (str): The path of the text report.
+
+        Students who did not submit anything gradable are left out, and students
+        who failed to grade are listed with a grade of None.
+        """
+        with open(report_path, 'w', encoding='utf-8', buffering=_WRITE_BUFFER_BYTES) as report_file:
+            self._write_text_report(report_file)
+
+    def render_compressed_report(self, report_path):
+        """
+        Write the text report as a gzip file, e.g. to attach it to an email.
+
+        Args:
+            report_path (str): The path of the compressed report (e.g. grading_results.txt.gz).
+        """
+        with gzip.open(report_path, 'wt', encoding='utf-8') as report_file:
+            self._write_text_report(report_file)
+
+    def _write_text_report(self, report_file):
+        for record in self:
+            if _in_report(record):
+                report_file.write(_format_grade(record))
+
+    def render_csv(self, csv_path):
+        """
+        Write the store as a CSV file with one row per student and one column per field.
+
+        Args:
+            csv_path (str): The path of the CSV file.
+        """
+        with open(csv_path, 'w', encoding='utf-8', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(dict(record, similar_to=format_similar_to(record['similar_to']),
+                                  section_scores=format_section_scores(record['section_scores']),
+                                  sample_scores=format_sample_scores(record['sample_scores']))
+                             for record in self)
+
+    def count_report_entries(self):
+        """
+        Count the students listed in the text report and the email body.
+        """
+        return sum(1 for record in self if _in_report(record))
+
+    def render_email_body(self, include_grades=True):
+        """
+        Build the results email body: a short summary followed by every student's grade.
+
+        Args:
+            include_grades (bool, optional): Follow the summary with every student's grade. 
+            Otherwise the body says the grades are in the attached report. Defaults to True.
+
+        Returns:
+            str: The email body, or a message saying there are no results.
+        """
+        counts = {}
+        score_total = 0.0
+        scored_students = 0
+        flagged_students = 0
+        review_students = 0
+        for record in self:
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+            if record['score'] is not None:
+                score_total += record['score']
+                scored_students += 1
+            if record['similar_to']:
+                flagged_students += 1
+            if record['needs_review']:
+                review_students += 1
+
+        if not counts:
+            return 'There are no grading results for this run.'
+
+        summary = f"Graded {counts.get('graded', 0)} of {sum(counts.values())} students"
+        details = [f'{count} {status.replace("_", " ")}' for status, count in sorted(counts.items())
+                   if status != 'graded']
+        if details:
+            summary += f" ({', '.join(details)})"
+        if scored_students:
+            summary += f'. Average score: {score_total / scored_students:.1f}'
+        if flagged_students:
+            summary += f'. {flagged_students} students handed in work similar to another student\'s'
+        if review_students:
+            summary += f'. {review_students} grades need a review because their gradings disagree'
+        if not include_grades:
+            return summary + '.\n\nEvery student\'s grade is in the attached report.'
+        return summary + '.' + ''.join(_format_grade(record) for record in self if _in_report(record))
+
+    def render_digest_body(self, students):
+        """
+        Build a digest email body for the students graded since the last digest.
+
+        Args:
+            students (set): The names of the students to include.
+
+        Returns:
+            str: A one line summary followed by the grade of each of those students.
+        """
+        records = [record for record in self if record['student'] in students]
+        failed = sum(1 for record in records if record['status'] == 'failed')
+        summary = f'{len(records)} new or changed submissions were graded since the last digest'
+        if failed:
+            summary += f' ({failed} failed and will be retried)'
+        return summary + '.' + ''.join(_format_grade(record) for record in records)
@@ -0,0 +1,154 @@
+"""
+rubric_sections Module
+
+This module splits the grading criteria into sections, so every section of the rubric
+can be graded by its own short request against the same submission. The requests run
+side by side, so a student takes as long as their slowest section instead of one long
+generation covering every rubric item, and a section that fails can be graded again
+without redoing the others (the sections that succeeded are in the response cache).
+
+Sections are found in this order of preference:
+- Markdown headings ("# Part 1", "## Style"), of the shallowest level that occurs at
+  least twice, so a rubric's "# Title" above its "## Part" headings is not a section.
+- Lines starting with "Section", "Part" or "Criterion" ("Part A: Correctness").
+- Top level numbered items ("1. Correctness (10 points)").
+
+Any text before the first section (e.g. general instructions) is repeated in every
+section's prompt. Criteria with fewer than two sections are not split.
+
+Dependencies:
+- re: For finding the section headings and scores.
+- collections: Counter for the heading levels, namedtuple for the sections.
+- general_functions: For preparing each section's criteria as a system message.
+- results_store: For reading the score of each section's response.
+"""
+
+import re
+from collections import Counter, namedtuple
+from file_actions import results_store
+from general_functions import general_functions
+
+# A section of the rubric: its title and its criteria, prepared as a system message
+Section = namedtuple('Section', ['title', 'criteria_prefix'])
+
+# Markdown headings of any level; the sections are the headings of one level (see _section_headings)
+_MARKDOWN_HEADING_PATTERN = re.compile(r'^(?P<level>#{1,6})[ \t]+(?P<title>.+)$', re.MULTILINE)
+_HEADING_PATTERNS = [
+    _MARKDOWN_HEADING_PATTERN,
+    re.compile(r'^(?P<title>(?:section|part|criterion)\b.*)$', re.IGNORECASE | re.MULTILINE),
+    re.compile(r'^(?P<title>\d+[.)][ \t]+.+)$', re.MULTILINE),
+]
+
+SECTION_INSTRUCTIONS = ('Only grade the part of the rubric above; other parts are graded separately. '
+                        'Start your reply with "Score: <points>/<maximum points>" for this part.')
+
+
+def split_criteria(grading_criteria):
+    """
+    Split grading criteria into a shared preamble and sections.
+
+    Args:
+        grading_criteria (str): Content of the grading criteria file.
+
+    Returns:
+        tuple: (preamble, sections), where sections is a list of (title, text) tuples
+        in criteria order. The list is empty when the criteria have fewer than two sections.
+
+    Markdown sections are the headings of the shallowest level that occurs at least twice.
+    Shallower headings (e.g. the rubric's "# Title") go to the preamble with their text,
+    and deeper ones stay inside their section. A heading with nothing under it is never a
+    section of its own; it goes to the preamble too.
+
+    Example:
+        >>> split_criteria('# Lab Rubric\\n## Part 1\\nLoops (5 points)\\n## Part 2\\nStyle (5 points)')
+        ('# Lab Rubric', [('Part 1', '## Part 1\\nLoops (5 points)'), ('Part 2', '## Part 2\\nStyle (5 points)')])
+    """
+    for pattern in _HEADING_PATTERNS:
+        headings = list(pattern.finditer(grading_criteria))
+        if pattern is _MARKDOWN_HEADING_PATTERN:
+            headings = _section_headings(headings)
+        else:
+            headings = [(heading, True) for heading in headings]
+        if len([heading for heading, is_section in headings if is_section]) < 2:
+            continue
+
+        preamble = [grading_criteria[:headings[0][0].start()].strip()]
+        sections = []
+        for index, (heading, is_section) in enumerate(headings):
+            end = headings[index + 1][0].start() if index + 1 < len(headings) else len(grading_criteria)
+            text = grading_criteria[heading.start():end].strip()
+            if is_section and text != heading.group(0).strip():
+                sections.append((heading.group('title').strip(), text))
+            else:
+                preamble.append(text)
+        if len(sections) < 2:
+            continue
+        return '\n\n'.join(part for part in preamble if part), sections
+    return grading_criteria.strip(), []
+
+
+def _section_headings(headings):
+    """
+    Pick the Markdown headings that start sections.
+
+    Returns:
+        list: (heading, is_section) tuples, in criteria order. The sections are the headings
+        of the shallowest level that occurs at least twice; shallower headings are listed
+        as not sections, and deeper ones are left out so they stay in their section's text.
+    """
+    levels = Counter(len(heading.group('level')) for heading in headings)
+    section_levels = [level for level, count in levels.items() if count >= 2]
+    if not section_levels:
+        return []
+    section_level = min(section_levels)
+    return [(heading, len(heading.group('level')) == section_level) for heading in headings
+            if len(heading.group('level')) <= section_level]
+
+
+def build_sections(grading_criteria):
+    """
+    Prepare every section of the grading criteria as its own system message, once per run.
+
+    Args:
+        grading_criteria (str): Content of the grading criteria file.
+
+    Returns:
+        list: One Section per section of the criteria, or an empty list when the criteria
+        cannot be split.
+    """
+    preamble, sections = split_criteria(grading_criteria)
+    return [Section(title, general_functions.build_criteria_prefix('\n\n'.join(
+                part for part in (preamble, text, SECTION_INSTRUCTIONS) if part)))
+            for title, text in sections]
+
+
+def merge_section_results(sections, responses):
+    """
+    Merge the graded sections of one student into one grade response.
+
+    Args:
+        sections (list): The Sections of the run.
+        responses (list): The grade response of each section, in the same order.
+
+    Returns:
+        tuple: (response, section_scores). The response starts with the total
+        "Grade: <score>/<maximum>" line (the maximum is left out when a section did not
+        give one, and the student is unscored when a section gave no score at all),
+        followed by every section's response under its title. section_scores holds a
+        {"section", "score", "max_score"} dict per section.
+    """
+    section_scores = []
+    for section, response in zip(sections, responses):
+        score, max_score = results_store.extract_score(response)
+        section_scores.append({'section': section.title, 'score': score, 'max_score': max_score})
+
+    scores = [section_score['score'] for section_score in section_scores]
+    max_scores = [section_score['max_score'] for section_score in section_scores]
+    if None in scores:
+        total = f'{results_store.UNSCORED_GRADE} (a section has no score)'
+    elif None in max_scores:
+        total = f'Grade: {sum(scores):g}'
+    else:
+        total = f'Grade: {sum(scores):g}/{sum(max_scores):g}'
+    parts = [total] + [f'## {section.title}\n{response.strip()}' for section, response in zip(sections, responses)]
+    return '\n\n'.join(parts), section_scores
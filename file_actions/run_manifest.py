@@ -0,0 +1,297 @@
+"""
+run_manifest Module
+
+This module keeps a manifest of a grading run, so an interrupted or repeated
+run only grades the students that are new, failed last time, or changed.
+
+The manifest is an append-only JSON Lines journal stored next to the results
+file (grading_results.txt -> grading_results_manifest.jsonl). The first line identifies the run (a hash of the grading criteria and the
+model), and every following line records one student's status, file
+fingerprint, content hash and result. When a student appears more than once,
+the last record wins, so checkpointing a student is a single appended line.
+A finished run compacts the journal back to one line per student.
+
+For very large classes, the writer can keep the grade responses on disk only
+(see the `result_offsets` of load_manifest and ManifestWriter): every student's
+record in memory then leaves out its `result`, which is read back from the
+journal when the run is compacted and written out.
+
+Student statuses:
+- graded: The submission was sent to the API and a response was recorded.
+- failed: Grading raised an error or the API returned no response.
+- empty: The student's folder was empty.
+- no_submission: The folder had no readable files with an allowed extension.
+
+Dependencies:
+- hashlib: For hashing the grading criteria and submissions.
+- json: For reading and writing the journal.
+- logging: For recording problems with the manifest.
+- os: For file paths.
+- folder_scanner: For the file metadata of the student folders.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from file_actions import folder_scanner
+
+MANIFEST_SUFFIX = '_manifest.jsonl'
+
+# Statuses whose results can be reused when the student's files have not changed
+REUSABLE_STATUSES = ('graded', 'empty', 'no_submission')
+
+
+def hash_text(text):
+    """
+    Return the SHA-256 hex digest of a string.
+
+    Args:
+        text (str): The text to hash.
+
+    Returns:
+        str: The hex digest.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def get_manifest_path(results_path):
+    """
+    Return the manifest path that belongs to a results file.
+
+    Args:
+        results_path (str): The path to the results file of the run.
+
+    Returns:
+        str: The results path with its extension replaced by MANIFEST_SUFFIX.
+    """
+    return os.path.splitext(results_path)[0] + MANIFEST_SUFFIX
+
+
+def fingerprint_student_folder(student_folder_path, allowed_extensions):
+    """
+    Build a cheap fingerprint of the gradable files in a student's folder.
+
+    Args:
+        student_folder_path (str): The path to the individual student's folder.
+        allowed_extensions (list): List of file extensions that are considered valid for assignments.
+
+    Returns:
+        list: Sorted [file name, size, mtime in nanoseconds] entries, one per gradable file.
+
+    The fingerprint only uses file metadata, so unchanged students can be skipped
+    without reading their files.
+    """
+    return fingerprint_files(folder_scanner.scan_student_folder(student_folder_path, allowed_extensions).files)
+
+
+def fingerprint_files(assignment_files):
+    """
+    Build the fingerprint of a student from their files in the folder_scanner index.
+
+    Args:
+        assignment_files (list): The student's folder_scanner.AssignmentFile entries.
+
+    Returns:
+        list: Sorted [file name, size, mtime in nanoseconds] entries, one per gradable file.
+    """
+    return sorted([assignment_file.name, assignment_file.size, assignment_file.mtime_ns]
+                  for assignment_file in assignment_files)
+
+
+def load_manifest(manifest_path, criteria_hash, model_name, result_offsets=None):
+    """
+    Load the student records of a previous run from the manifest journal.
+
+    Args:
+        manifest_path (str): The path to the manifest file.
+        criteria_hash (str): The hash of the grading criteria for this run.
+        model_name (str): The model used for this run.
+        result_offsets (dict, optional): When given, the records are loaded without their 
+        `result`, and this dict is filled with student name -> the byte offset of the 
+        student's latest line in the journal, where ManifestWriter reads it back from.
+
+    Returns:
+        dict: Student name -> the latest record for that student. Empty if there is
+        no manifest, it cannot be read, or it was written for different criteria or
+        a different model.
+    """
+    students = {}
+    if not os.path.exists(manifest_path):
+        return students
+
+    try:
+        with open(manifest_path, 'rb') as manifest_file:
+            header = json.loads(manifest_file.readline() or '{}')
+            if header.get('criteria_hash') != criteria_hash or header.get('model') != model_name:
+                logging.info('The grading criteria or model changed since the last run. Regrading everyone.')
+                return students
+
+            offset = manifest_file.tell()
+            for line in manifest_file:
+                line_offset, offset = offset, offset + len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave a partially written last line behind
+                    logging.warning('Ignoring an unreadable line in the grading manifest: '
+                                    f"{line[:80].decode('utf-8', 'replace')}")
+                    continue
+                if result_offsets is not None:
+                    record.pop('result', None)
+                    result_offsets[record['student']] = line_offset
+                students[record['student']] = record
+    except (OSError, ValueError, KeyError) as ex:
+        logging.error(f'An error occurred while reading the grading manifest. Regrading everyone. Error: {ex}')
+        if result_offsets is not None:
+            result_offsets.clear()
+        return {}
+
+    logging.info(f'Loaded {len(students)} student records from the grading manifest')
+    return students
+
+
+def needs_grading(record, fingerprint):
+    """
+    Decide whether a student's previous record can be reused without reading their files.
+
+    Args:
+        record (dict or None): The student's record from the previous run.
+        fingerprint (list): The student's current file fingerprint.
+
+    Returns:
+        bool: True if the student is missing, failed last time, or their files changed.
+    """
+    return record is None or record.get('status') not in REUSABLE_STATUSES or record.get('fingerprint') != fingerprint
+
+
+class ManifestWriter:
+    """
+    Appends student records to the manifest journal as they complete.
+
+    Use it as a context manager. When the previous run's records are being
+    resumed, new records are appended after them, so a crash at any point leaves
+    a journal that is complete enough to resume from. Otherwise the journal is
+    started over. Call `compact` once the run has finished.
+
+    With `result_offsets` (the dict filled by load_manifest, or an empty dict when not
+    resuming), `students` holds every record without its `result`, so memory does not
+    grow with the length of the grade responses. Read the results back with
+    `read_result` and `iter_records`.
+    """
+
+    def __init__(self, manifest_path, criteria_hash, model_name, previous_students=None, result_offsets=None):
+        self.manifest_path = manifest_path
+        self.header = {'criteria_hash': criteria_hash, 'model': model_name}
+        self.previous_students = previous_students or {}
+        self.students = {}
+        self._result_offsets = result_offsets
+        self._file = None
+
+    def __enter__(self):
+        if self.previous_students:
+            self._file = open(self.manifest_path, 'ab')
+        else:
+            self._file = open(self.manifest_path, 'wb')
+            self._write_line(self._file, self.header)
+            self._file.flush()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        self._file = None
+
+    def record(self, student, status, fingerprint=None, content_hash=None, **fields):
+        """
+        Checkpoint one student's record by appending it to the journal.
+
+        Args:
+            student (str): The name of the student's folder.
+            status (str): One of graded, failed, empty or no_submission.
+            fingerprint (list, optional): The student's file fingerprint.
+            content_hash (str, optional): The hash of the student's combined submission.
+            fields: Any other values to keep, e.g. `result`.
+        """
+        record = dict(fields, student=student, status=status, fingerprint=fingerprint, content_hash=content_hash)
+        offset = self._write_line(self._file, record)
+        self._file.flush()
+        if self._result_offsets is not None:
+            self._result_offsets[student] = offset
+            record.pop('result', None)
+        self.students[student] = record
+
+    def carry_over(self, record, fingerprint=None):
+        """
+        Keep a student's record from the previous run for this run.
+
+        Args:
+            record (dict): The student's record from the previous run.
+            fingerprint (list, optional): The student's current file fingerprint, if it changed
+            while the content stayed the same. The record is re-appended in that case.
+        """
+        if fingerprint is not None and fingerprint != record.get('fingerprint'):
+            if self._result_offsets is not None:
+                record = self._read_record(record['student'])
+            fields = {key: value for key, value in record.items()
+                      if key not in ('student', 'status', 'fingerprint', 'content_hash')}
+            self.record(record['student'], record['status'], fingerprint, record.get('content_hash'), **fields)
+        else:
+            self.students[record['student']] = record
+
+    def compact(self):
+        """
+        Rewrite the journal with one line per student of this run, in sorted student order.
+        """
+        temporary_path = self.manifest_path + '.tmp'
+        compacted_offsets = {}
+        with open(temporary_path, 'wb') as manifest_file:
+            self._write_line(manifest_file, self.header)
+            for record in self.iter_records():
+                compacted_offsets[record['student']] = self._write_line(manifest_file, record)
+        self._file.close()
+        os.replace(temporary_path, self.manifest_path)
+        if self._result_offsets is not None:
+            self._result_offsets.clear()
+            self._result_offsets.update(compacted_offsets)
+        self._file = open(self.manifest_path, 'ab')
+
+    def iter_records(self):
+        """
+        Yield the full record of every student of this run, in sorted student order.
+
+        When the results are kept on disk, each record is read back from the journal and 
+        updated with any field changed in `students` since it was written.
+        """
+        if self._result_offsets is None:
+            for student in sorted(self.students):
+                yield self.students[student]
+            return
+
+        with open(self.manifest_path, 'rb') as manifest_file:
+            for student in sorted(self.students):
+                manifest_file.seek(self._result_offsets[student])
+                yield dict(json.loads(manifest_file.readline()), **self.students[student])
+
+    def read_result(self, student):
+        """
+        Return the grade response recorded for a student of this run.
+        """
+        if self._result_offsets is None:
+            return self.students[student].get('result')
+        return self._read_record(student).get('result')
+
+    def _read_record(self, student):
+        if self._file is not None:
+            self._file.flush()
+        with open(self.manifest_path, 'rb') as manifest_file:
+            manifest_file.seek(self._result_offsets[student])
+            return json.loads(manifest_file.readline())
+
+    @staticmethod
+    def _write_line(manifest_file, record):
+        """
+        Append a record to a journal opened in binary mode and return the offset it starts at.
+        """
+        offset = manifest_file.tell()
+        manifest_file.write(json.dumps(record).encode('utf-8') + b'\n')
+        return offset
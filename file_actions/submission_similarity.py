@@ -0,0 +1,209 @@
+"""
+submission_similarity Module
+
+This module finds content that students share, so it is not graded over and over:
+
+- Starter code: a file whose content is identical in many student folders (e.g. a
+  template handed out with the assignment) is treated as boilerplate. It is left out
+  of every submission and replaced by a one line marker, so its tokens are not sent
+  to the API for every student.
+- Near-duplicate submissions: every submission gets a MinHash sketch of its word
+  shingles, and submissions whose sketches are at least settings.SIMILARITY_THRESHOLD
+  alike are reported as possible shared work. Exact duplicates are graded once by
+  `file_actions.grade_assignments`, which compares content hashes.
+
+The boilerplate search only hashes files whose size is shared by enough students, so
+most files are never read twice. The sketches use one-permutation MinHash (one hash
+per shingle, kept as the minimum of one of MINHASH_SIZE bins), and similar pairs are
+found through locality sensitive hashing over bands of the sketch, so a class is
+never compared pair by pair.
+
+Dependencies:
+- hashlib: For hashing file contents and shingles.
+- math: For the boilerplate student count.
+- re: For splitting submissions into words.
+- collections: For grouping files and sketch bands.
+- itertools: For the candidate pairs within a band.
+- logging: For recording unreadable files.
+- settings: For the default thresholds.
+"""
+
+import hashlib
+import logging
+import math
+import re
+from collections import defaultdict
+from itertools import combinations
+from settings import settings
+
+# Rows of the sketch hashed together into one LSH band
+BAND_ROWS = 4
+
+_WORD_PATTERN = re.compile(r'\w+')
+# The marker a starter file is replaced by (see boilerplate_marker)
+_BOILERPLATE_MARKER_PATTERN = re.compile(r'^\[[^\n]*: unchanged starter file, left out\]$', re.MULTILINE)
+_HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def hash_file(file_path):
+    """
+    Return the SHA-256 hex digest of a file's bytes.
+
+    Args:
+        file_path (str): The path to the file.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_boilerplate_files(scanned_folders, min_students=settings.BOILERPLATE_MIN_STUDENTS,
+                           min_share=settings.BOILERPLATE_MIN_SHARE):
+    """
+    Find the files that are identical in many student folders.
+
+    Args:
+        scanned_folders (iterable): The folder_scanner.StudentFolder entries of the class. 
+        They are read once, so a lazy scan (`folder_scanner.iter_assignments_folder`) works too.
+        min_students (int, optional): The fewest students that must share a file for it
+        to count as boilerplate. Defaults to settings.BOILERPLATE_MIN_STUDENTS.
+        min_share (float, optional): The smallest share of the students with gradable
+        files that must share it. Defaults to settings.BOILERPLATE_MIN_SHARE.
+
+    Returns:
+        dict: File path -> the number of students whose folder holds the same content,
+        for every boilerplate file of every student.
+
+    Only files whose size occurs in enough folders are read and hashed. Empty files and
+    files that cannot be read are never boilerplate.
+    """
+    students_with_files = 0
+    files_by_size = defaultdict(list)
+    for scanned_folder in scanned_folders:
+        students_with_files += 1 if scanned_folder.files else 0
+        for assignment_file in scanned_folder.files:
+            if assignment_file.size:
+                files_by_size[assignment_file.size].append((scanned_folder.name, assignment_file.path))
+    required_students = max(min_students, math.ceil(min_share * students_with_files))
+
+    files_by_hash = defaultdict(list)
+    for size_group in files_by_size.values():
+        if len({student for student, _ in size_group}) < required_students:
+            continue
+        for student, file_path in size_group:
+            try:
+                files_by_hash[hash_file(file_path)].append((student, file_path))
+            except OSError as ex:
+                logging.warning(f'Could not hash {file_path} while looking for starter code: {ex}')
+
+    boilerplate_files = {}
+    for hash_group in files_by_hash.values():
+        student_count = len({student for student, _ in hash_group})
+        if student_count >= required_students:
+            boilerplate_files.update((file_path, student_count) for _, file_path in hash_group)
+    return boilerplate_files
+
+
+def boilerplate_marker(file_name):
+    """
+    Return the one line marker a starter file is replaced by in a submission.
+
+    The marker names only the file: it is part of the submission's content hash and
+    cache key, so it must not change when students join or leave the class.
+    """
+    return f'[{file_name}: unchanged starter file, left out]'
+
+
+def sketch_submission(text, sketch_size=settings.MINHASH_SIZE, shingle_words=settings.SHINGLE_WORDS):
+    """
+    Build the MinHash sketch of a submission.
+
+    Args:
+        text (str): The combined submission of one student.
+        sketch_size (int, optional): The number of values in the sketch. Defaults to
+        settings.MINHASH_SIZE.
+        shingle_words (int, optional): The number of consecutive words in a shingle.
+        Defaults to settings.SHINGLE_WORDS.
+
+    Returns:
+        list or None: `sketch_size` values (None for bins no shingle fell into), or None
+        if the submission holds no words.
+
+    Words are lower cased, so changes in case and whitespace do not hide a copy. Starter
+    file markers are left out, so students do not look alike for the starter code they share.
+    """
+    words = _WORD_PATTERN.findall(_BOILERPLATE_MARKER_PATTERN.sub('', text).lower())
+    if not words:
+        return None
+
+    shingles = {' '.join(words[index:index + shingle_words])
+                for index in range(max(1, len(words) - shingle_words + 1))}
+    sketch = [None] * sketch_size
+    for shingle in shingles:
+        shingle_hash = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        bin_index, value = shingle_hash % sketch_size, shingle_hash // sketch_size
+        if sketch[bin_index] is None or value < sketch[bin_index]:
+            sketch[bin_index] = value
+    return sketch
+
+
+def estimate_similarity(first_sketch, second_sketch):
+    """
+    Estimate the Jaccard similarity of two submissions from their sketches.
+
+    Args:
+        first_sketch (list): The sketch of one submission.
+        second_sketch (list): The sketch of the other submission, of the same size.
+
+    Returns:
+        float: The share of used bins holding the same value, between 0 and 1.
+    """
+    used_bins = [(first, second) for first, second in zip(first_sketch, second_sketch)
+                 if first is not None or second is not None]
+    if not used_bins:
+        return 0.0
+    return sum(1 for first, second in used_bins if first == second) / len(used_bins)
+
+
+def find_similar_submissions(sketches, threshold=settings.SIMILARITY_THRESHOLD):
+    """
+    Find the pairs of submissions that are at least `threshold` alike.
+
+    Args:
+        sketches (dict): Student name -> the sketch of their submission.
+        threshold (float, optional): The smallest estimated similarity that is reported.
+        Defaults to settings.SIMILARITY_THRESHOLD.
+
+    Returns:
+        dict: Student name -> a list of {"student", "similarity"} dicts, most similar
+        first, for every student with at least one similar submission.
+
+    Students land in the same bucket when one band of their sketches is identical, and
+    only students sharing a bucket are compared.
+    """
+    buckets = defaultdict(list)
+    for student, sketch in sketches.items():
+        for band_start in range(0, len(sketch), BAND_ROWS):
+            band = tuple(sketch[band_start:band_start + BAND_ROWS])
+            if any(value is not None for value in band):
+                buckets[(band_start, band)].append(student)
+
+    candidate_pairs = set()
+    for students in buckets.values():
+        candidate_pairs.update(combinations(sorted(students), 2))
+
+    similar_submissions = defaultdict(list)
+    for first, second in candidate_pairs:
+        similarity = estimate_similarity(sketches[first], sketches[second])
+        if similarity >= threshold:
+            similar_submissions[first].append({'student': second, 'similarity': round(similarity, 2)})
+            similar_submissions[second].append({'student': first, 'similarity': round(similarity, 2)})
+
+    for matches in similar_submissions.values():
+        matches.sort(key=lambda match: (-match['similarity'], match['student']))
+    return dict(similar_submissions)
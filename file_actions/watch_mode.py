@@ -0,0 +1,228 @@
+"""
+watch_mode Module
+
+This module keeps grading an assignments folder as submissions come in, so a late
+student is graded within minutes by a single request instead of a re-run of the
+whole section.
+
+The folder is polled every settings.WATCH_POLL_SECONDS with the same single pass
+`os.scandir` index the graders use (see folder_scanner), which only reads file
+metadata. A student whose files changed is graded once their files have stayed
+unchanged for settings.WATCH_DEBOUNCE_SECONDS, so a submission that is still being
+copied or uploaded is not graded half way. Only the settled students are read and
+graded (see the `students` option of `file_actions.grade_assignments`); everyone else
+keeps their record, and the results files are rewritten after every grading pass.
+
+Every settings.WATCH_DIGEST_MINUTES, the students graded since the last digest are
+emailed in one digest, and students whose grading failed are tried again.
+
+Every grading pass is a run of its own for the per-run budget caps (see usage_ledger),
+so students deferred when a cap was reached are graded by the pass after the digest.
+
+Dependencies:
+- logging: For recording the progress of the watcher.
+- os: For the results store path.
+- threading: For stopping the watcher from another thread.
+- time: For the debounce and digest clocks.
+- concurrent.futures: For the worker pool shared by all grading passes.
+- file_actions: For grading the settled students.
+- folder_scanner: For scanning the assignments folder.
+- run_manifest: For the file fingerprints of the students.
+- results_store: For the digest email body.
+- email_delivery: For sending the digests.
+- usage_ledger: For starting the budget of every grading pass.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email_functions import email_delivery as email
+from file_actions import file_actions, folder_scanner, results_store, run_manifest
+from openai_actions import usage_ledger
+from settings import settings
+
+
+class SubmissionWatcher:
+    """
+    Tracks the students whose files changed and decides when they are ready to grade.
+
+    Call `observe` with every scan of the assignments folder. A student is pending from
+    the first scan that shows new files (every student is pending after the first scan),
+    and settled once their fingerprint has not changed for `debounce_seconds`.
+    """
+
+    def __init__(self, debounce_seconds=settings.WATCH_DEBOUNCE_SECONDS, clock=time.monotonic):
+        self.debounce_seconds = debounce_seconds
+        self.clock = clock
+        self._fingerprints = {}
+        # Student -> when their current fingerprint was first seen, for students not graded since
+        self._changed_at = {}
+
+    def observe(self, scanned_folders):
+        """
+        Record a scan of the assignments folder.
+
+        Args:
+            scanned_folders (list): The folder_scanner.StudentFolder entries of the scan.
+        """
+        now = self.clock()
+        for scanned_folder in scanned_folders:
+            fingerprint = run_manifest.fingerprint_files(scanned_folder.files)
+            if self._fingerprints.get(scanned_folder.name) != fingerprint:
+                self._fingerprints[scanned_folder.name] = fingerprint
+                self._changed_at[scanned_folder.name] = now
+
+    def settled_students(self):
+        """
+        Return the pending students whose files have not changed for the debounce time.
+
+        Returns:
+            set: The names of the students to grade now.
+        """
+        now = self.clock()
+        return {student for student, changed_at in self._changed_at.items()
+                if now - changed_at >= self.debounce_seconds}
+
+    def pending_students(self):
+        """
+        Return every student still waiting to be graded, settled or not.
+        """
+        return set(self._changed_at)
+
+    def mark_graded(self, students):
+        """
+        Stop tracking students until their files change again.
+        """
+        for student in students:
+            self._changed_at.pop(student, None)
+
+    def retry(self, students):
+        """
+        Make students ready to grade again at once, e.g. after their grading failed.
+        """
+        for student in students:
+            self._changed_at[student] = self.clock() - self.debounce_seconds
+
+
+def watch_assignments(assignments_folder, grading_criteria, allowed_extensions, results_path=None,
+                      poll_seconds=settings.WATCH_POLL_SECONDS, debounce_seconds=settings.WATCH_DEBOUNCE_SECONDS,
+                      digest_minutes=settings.WATCH_DIGEST_MINUTES, send_email=True, recipient=None,
+                      max_workers=settings.MAX_GRADING_WORKERS, stop_event=None, **grading_options):
+    """
+    Grade new and changed submissions as they arrive, until stopped.
+
+    Args:
+        assignments_folder (str): Path to the main folder containing individual student
+        assignment folders.
+        grading_criteria (str): The criteria to use for grading assignments. Changing the
+        criteria file has no effect until the watcher is restarted.
+        allowed_extensions (list): List of file extensions that are considered valid for assignments.
+        results_path (str, optional): The results file to keep up to date. Defaults to
+        file_actions.get_results_file_path().
+        poll_seconds (float, optional): Seconds between two scans of the folder.
+        debounce_seconds (float, optional): Seconds a student's files must stay unchanged
+        before they are graded.
+        digest_minutes (float, optional): Minutes between two digest emails.
+        send_email (bool, optional): Email the digests. Defaults to True.
+        recipient (str, optional): The digest recipient. Defaults to settings.RESULTS_EMAIL.
+        max_workers (int, optional): Number of students graded at the same time.
+        stop_event (threading.Event, optional): Set it to stop the watcher after the current
+        pass. The watcher also stops on KeyboardInterrupt. A scan that fails with an OSError
+        is logged and tried again on the next poll.
+        grading_options: Passed on to file_actions.grade_assignments (use_cache, model_name,
+        backend, grade_by_section, samples, ...).
+
+    Returns:
+        dict: Student name -> the student's latest record.
+
+    Students already graded by an earlier run with unchanged files are resumed from the
+    run manifest, so starting the watcher costs no requests for them. A digest with any
+    students graded since the last one is also sent when the watcher stops.
+    """
+    results_path = results_path or file_actions.get_results_file_path()
+    stop_event = stop_event or threading.Event()
+    watcher = SubmissionWatcher(debounce_seconds)
+    published_results = _load_published_results(results_path)
+    student_records = {}
+    digest_students = set()
+    next_digest_at = time.monotonic() + digest_minutes * 60
+    logging.info(f'Watching {assignments_folder} for new and changed submissions every {poll_seconds} seconds')
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='grader') as executor:
+        try:
+            while not stop_event.is_set():
+                try:
+                    watcher.observe(folder_scanner.scan_assignments_folder(assignments_folder, allowed_extensions))
+                    settled_students = watcher.settled_students()
+                except OSError as ex:
+                    # E.g. a network share that is briefly unavailable: the next scan tries again
+                    logging.error(f'Could not scan {assignments_folder}. Trying again on the next scan. Error: {ex}')
+                    settled_students = set()
+                if settled_students:
+                    logging.info(f"{len(settled_students)} student folders are new or changed: "
+                                 f"{', '.join(sorted(settled_students))}")
+                    usage_ledger.start_run()
+                    records = file_actions.grade_assignments(assignments_folder, grading_criteria,
+                                                             allowed_extensions, resume=True,
+                                                             results_path=results_path, executor=executor,
+                                                             students=settled_students, **grading_options)
+                    if records is None:
+                        logging.error('The grading pass failed. The students are tried again on the next scan.')
+                    else:
+                        watcher.mark_graded(settled_students)
+                        student_records = records
+                        digest_students |= _update_published_results(published_results, records)
+
+                if time.monotonic() >= next_digest_at:
+                    _send_digest(digest_students, results_path, send_email, recipient)
+                    digest_students = set()
+                    # Failed students are retried once per digest, not on every scan
+                    watcher.retry(student for student, record in student_records.items()
+                                  if record['status'] == 'failed' and student not in watcher.pending_students())
+                    next_digest_at = time.monotonic() + digest_minutes * 60
+                stop_event.wait(poll_seconds)
+        except KeyboardInterrupt:
+            logging.info('Watch mode interrupted')
+
+    _send_digest(digest_students, results_path, send_email, recipient)
+    logging.info(f'Stopped watching {assignments_folder}')
+    return student_records
+
+
+def _load_published_results(results_path):
+    """
+    Read the status and result of every student in the results store of an earlier run.
+    """
+    store_path = results_store.get_store_path(results_path)
+    if not os.path.exists(store_path):
+        return {}
+    return {record['student']: (record['status'], record['result'])
+            for record in results_store.ResultsStore(store_path)}
+
+
+def _update_published_results(published_results, student_records):
+    """
+    Remember the latest results and return the students whose results changed.
+    """
+    changed_students = set()
+    for student, record in student_records.items():
+        result = (record['status'], record.get('result'))
+        if published_results.get(student) != result:
+            published_results[student] = result
+            changed_students.add(student)
+    return changed_students
+
+
+def _send_digest(students, results_path, send_email, recipient):
+    """
+    Email the grades of the students graded since the last digest.
+    """
+    if not students:
+        return
+    body = results_store.ResultsStore(results_store.get_store_path(results_path)).render_digest_body(students)
+    logging.info(body.split('\n', 1)[0])
+    if send_email:
+        email.send_email_to_user(body, recipient=recipient,
+                                 subject=f'{settings.FIRST_NAME}, {len(students)} new submissions were graded')
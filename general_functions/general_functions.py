@@ -1,10 +1,17 @@
 '''
 The general_functions file handles basic functions and
 actions for the app
+
+Message boxes are shown through show_info and show_error, which
+only import tkinter when the app runs interactively. In headless
+mode (see set_interactive) messages are logged instead, so nothing
+blocks waiting for a click.
 '''
 import datetime
+import hashlib
 import logging
 import os
+from collections import namedtuple
 
 
 def configure_logging():
@@ -31,31 +38,84 @@ def configure_logging():
         print(f"An error occurred while configuring logging: {ex}")
 
 
+_interactive = True
+
+
+def set_interactive(interactive):
+    '''
+    Turns the tkinter message boxes on (GUI mode) or off (headless mode)
+    '''
+    global _interactive
+    _interactive = interactive
+
+
+def show_info(title, message):
+    '''
+    Shows an information message box, or logs the message when running headless
+    '''
+    if not _interactive:
+        logging.info('%s %s', title, message)
+        return
+    from tkinter import messagebox
+    messagebox.showinfo(title, message)
+
+
+def show_error(title, message):
+    '''
+    Shows an error message box, or logs the message when running headless
+    '''
+    if not _interactive:
+        logging.error('%s %s', title, message)
+        return
+    from tkinter import messagebox
+    messagebox.showerror(title, message)
+
+
+# The grading criteria prepared once per run: the system message sent first in
+# every request, and the SHA-256 hex digest of its content
+CriteriaPrefix = namedtuple('CriteriaPrefix', ['message', 'criteria_hash'])
+
+
+def build_criteria_prefix(grading_criteria):
+    """
+    Prepare the grading criteria once per run as a reusable system message.
+
+    Args:
+    - grading_criteria (str): Content of the grading criteria file.
+
+    Returns:
+    - CriteriaPrefix: The system message and the hash of its content.
+
+    Every request of a run starts with the same system message object, so it is
+    only built and hashed once, and the identical prefix lets the provider reuse
+    its prompt cache across students.
+    """
+    content = grading_criteria.strip()
+    message = {"role": "system", "content": content}
+    return CriteriaPrefix(message, hashlib.sha256(content.encode('utf-8')).hexdigest())
+
+
 def combine_contents_into_message(grading_criteria, assignment_content):
     """
-    Combine the contents of two strings and format the message.
+    Combine the grading criteria and a student's submission into chat messages.
 
     Args:
-    - grading_criteria (str): Content of the first string.
-    - assignment_content (str): Content of the second string.
+    - grading_criteria (CriteriaPrefix or str): The criteria prepared by
+      build_criteria_prefix. A plain string is prepared on the fly.
+    - assignment_content (str): The combined submission of one student.
 
     Returns:
-    - list: A list containing a dictionary with the combined and formatted message.
+    - list: The shared criteria system message followed by a user message with
+      the submission, or None if an error occurred.
     """
     try:
         logging.info('Creating chat message for open ai')
 
-        # Combine the contents
-        message = f'''{grading_criteria}\n{assignment_content}'''
-
-        # Prepare the message
-        message = message.replace("\n", "\\n")
-        message = message.strip()
-
-        # Format the message as per the structure you showed
-        message_object = [{"role": "user", "content": message}]
+        if isinstance(grading_criteria, str):
+            grading_criteria = build_criteria_prefix(grading_criteria)
 
-        return message_object
+        # The submission is used as is, so it is not copied again
+        return [grading_criteria.message, {"role": "user", "content": assignment_content}]
     except Exception as ex:
         logging.error(f'An error occurred in combine_contents_into_message. Error: {ex}')
         return None
@@ -0,0 +1,193 @@
+'''
+The instrumentation file records how long each stage of a grading
+run takes, so we can tell whether a run is bound by the API, the
+disk or our own code.
+
+The stages timed by the grading pipeline are:
+- scan: indexing the assignments folder and every student's files
+- read: reading and combining a student's files
+- prompt_build: building the message, counting its tokens and routing it
+- queue_wait: waiting for a free grading worker
+- rate_limit_wait: waiting for room in the model's rate limits
+- api_call: the whole chat completion call, including rate limit waits and retries
+- batch_api: submitting a Batch API job and waiting for its results
+- similarity: finding shared starter code, sketching submissions and comparing them
+- write: writing the results store, text report and CSV
+- email: sending the results email
+
+Next to the stage timings, counters keep the token usage, cache hits,
+rate limit retries, timed out requests sent again, completions stopped
+early, fallback model requests, duplicate submissions,
+starter files left out, the number of requests sent to each model,
+the dollars spent and the requests downgraded or held back by the
+budget (see openai_actions/usage_ledger.py). At the end of a run the summary (count, total,
+p50, p95 and max per stage, and students per minute) is logged and
+exported as JSON next to the results file.
+'''
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_SUFFIX = '_metrics.json'
+
+
+class RunMetrics:
+    '''
+    Thread safe stage timings and counters of one grading run
+    '''
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.started_at = clock()
+        self.durations = {}
+        self.counters = {}
+
+    def record(self, stage_name, seconds):
+        '''
+        Adds one timing (in seconds) to a stage
+        '''
+        with self._lock:
+            self.durations.setdefault(stage_name, []).append(seconds)
+
+    def count(self, counter_name, amount=1):
+        '''
+        Adds an amount to a counter
+        '''
+        if not amount:
+            return
+        with self._lock:
+            self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+    @contextmanager
+    def stage(self, stage_name):
+        '''
+        Times the body of a `with` block as one run of a stage, even when it raises
+        '''
+        started_at = self._clock()
+        try:
+            yield
+        finally:
+            self.record(stage_name, self._clock() - started_at)
+
+    def summary(self):
+        '''
+        Returns the run summary as a dict: the wall time, students per minute,
+        the counters and count/total/mean/p50/p95/max seconds per stage
+        '''
+        with self._lock:
+            durations = {name: sorted(values) for name, values in self.durations.items()}
+            counters = dict(self.counters)
+        wall_seconds = self._clock() - self.started_at
+        students = counters.get('students', 0)
+        return {
+            'wall_seconds': round(wall_seconds, 3),
+            'students': students,
+            'students_per_minute': round(students * 60 / wall_seconds, 2) if wall_seconds > 0 else None,
+            'counters': counters,
+            'stages': {name: {
+                'count': len(values),
+                'total_seconds': round(sum(values), 3),
+                'mean_seconds': round(sum(values) / len(values), 4),
+                'p50_seconds': round(_percentile(values, 50), 4),
+                'p95_seconds': round(_percentile(values, 95), 4),
+                'max_seconds': round(values[-1], 4),
+            } for name, values in sorted(durations.items())},
+        }
+
+
+def _percentile(sorted_values, percent):
+    '''
+    Nearest-rank percentile of an already sorted, non empty list
+    '''
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+_run_metrics = RunMetrics()
+_run_metrics_lock = threading.Lock()
+
+
+def start_run():
+    '''
+    Starts a fresh set of metrics for a new run and returns it
+    '''
+    global _run_metrics
+    with _run_metrics_lock:
+        _run_metrics = RunMetrics()
+        return _run_metrics
+
+
+def get_run_metrics():
+    '''
+    Returns the metrics of the current run
+    '''
+    return _run_metrics
+
+
+def stage(stage_name):
+    '''
+    Times the body of a `with` block as one run of a stage of the current run
+    '''
+    return get_run_metrics().stage(stage_name)
+
+
+def record(stage_name, seconds):
+    '''
+    Adds one timing (in seconds) to a stage of the current run
+    '''
+    get_run_metrics().record(stage_name, seconds)
+
+
+def count(counter_name, amount=1):
+    '''
+    Adds an amount to a counter of the current run
+    '''
+    get_run_metrics().count(counter_name, amount)
+
+
+def submit_timed(executor, function, *args, **kwargs):
+    '''
+    Submits a call to a worker pool and records how long it waited for a
+    free worker as the queue_wait stage
+    '''
+    metrics = get_run_metrics()
+    submitted_at = time.perf_counter()
+
+    def run():
+        metrics.record('queue_wait', time.perf_counter() - submitted_at)
+        return function(*args, **kwargs)
+
+    return executor.submit(run)
+
+
+def get_metrics_path(results_path):
+    '''
+    Returns the metrics file that belongs to a results file
+    (grading_results.txt -> grading_results_metrics.json)
+    '''
+    return os.path.splitext(results_path)[0] + METRICS_SUFFIX
+
+
+def export_run_metrics(metrics_path):
+    '''
+    Logs the summary of the current run and writes it to a JSON file.
+    Returns the summary, or None if it could not be written.
+    '''
+    try:
+        summary = get_run_metrics().summary()
+        logging.info('Run metrics: %s students in %ss (%s students/minute)',
+                     summary['students'], summary['wall_seconds'], summary['students_per_minute'])
+        for stage_name, stage_summary in summary['stages'].items():
+            logging.info('Run metrics: %s p50 %ss, p95 %ss over %s runs', stage_name,
+                         stage_summary['p50_seconds'], stage_summary['p95_seconds'], stage_summary['count'])
+        with open(metrics_path, 'w', encoding='utf-8') as metrics_file:
+            json.dump(summary, metrics_file, indent=2)
+        return summary
+    except Exception as ex:
+        logging.error(f'An error occurred while exporting the run metrics: {ex}')
+        return None
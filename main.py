@@ -1,12 +1,43 @@
 '''
 The main.py file serves as our main entry
 point to our grading bot
+
+Run it without arguments to pick the assignments folder,
+criteria file and extension through tkinter dialogs, or pass
+--folder and --criteria to grade headless, e.g. from cron:
+
+    python main.py --folder ./section1 --criteria criteria.txt --extensions .py .txt --workers 8
+
+or pass --batch with a manifest of many folders (see
+file_actions/batch_grading.py) to grade them all in one process:
+
+    python main.py --batch sections.json --workers 16
+
+Add --batch-api to either to grade through the OpenAI Batch API
+overnight instead of one request at a time (see openai_actions/batch_api.py).
+
+Add --watch to a --folder run to keep grading late submissions as they
+arrive and email a digest of them (see file_actions/watch_mode.py):
+
+    python main.py --folder ./section1 --criteria criteria.txt --watch --digest-minutes 60
+
+Every run exports its per-stage timings and throughput as JSON
+(e.g. grading_results_metrics.json, see general_functions/instrumentation.py).
+
+Add --estimate to a --folder or --batch run to see the requests, tokens,
+cost and time it would take, without sending anything (see
+file_actions/cost_estimate.py). Every request is recorded in the usage
+ledger and held to the budget caps in settings (see
+openai_actions/usage_ledger.py).
 '''
+import argparse
 import logging
-from tkinter import messagebox
-from general_functions import general_functions
-from file_actions import file_actions
+import sys
+from general_functions import general_functions, instrumentation
+from file_actions import batch_grading, cost_estimate, file_actions, watch_mode
 from email_functions import email_delivery as email
+from openai_actions import grading_backends
+from settings import settings
 
 
 def main():
@@ -23,15 +54,20 @@ def main():
 
     Exception handling is done to catch and log any errors that may occur during execution.
     """
+    from tkinter import messagebox
+
     try:
         logging.info('Main method executing')
         assignments_folder, grading_criteria_file = file_actions.prompt_user_for_input()
         grading_criteria = file_actions.read_grading_criteria(grading_criteria_file)
-        extension = file_actions.get_file_extension()
-        if extension:
-            file_actions.grade_assignments(assignments_folder, grading_criteria, extension)
-            grading_results = file_actions.read_results_from_file()
-            email.send_email_to_user(grading_results)
+        extensions = file_actions.get_file_extensions()
+        if extensions:
+            # Started once the dialogs are answered, so the metrics leave out the user's think time
+            instrumentation.start_run()
+            file_actions.grade_assignments(assignments_folder, grading_criteria, extensions)
+            grading_results, attachment_path = file_actions.get_results_email()
+            email.send_email_to_user(grading_results, attachment_path=attachment_path)
+            instrumentation.export_run_metrics(instrumentation.get_metrics_path(file_actions.get_results_file_path()))
             messagebox.showinfo('Grading completed!', '''The grading has been completed!
                             Please check your downloads folder for the results.''')
 
@@ -44,7 +80,264 @@ def main():
         messagebox.showerror('Error!', f'The grading process failed. Error: {ex}')
 
 
+def parse_arguments(argv=None):
+    """
+    Parse the command line arguments for a headless run.
+
+    Args:
+        argv (list, optional): The arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed arguments. `folder` and `batch` are None when no
+        headless run was requested.
+    """
+    parser = argparse.ArgumentParser(description='Grade student assignments with OpenAI.')
+    parser.add_argument('--folder', help='Folder containing one sub folder per student.')
+    parser.add_argument('--criteria', help='Text file with the grading criteria.')
+    parser.add_argument('--batch', help='JSON manifest of many assignment folders to grade in one process.')
+    parser.add_argument('--extensions', nargs='+', default=['.txt'],
+                        help='File extensions to grade, e.g. .py .txt (default: .txt).')
+    parser.add_argument('--workers', type=int, default=settings.MAX_GRADING_WORKERS,
+                        help='Number of students graded at the same time.')
+    parser.add_argument('--model', default=settings.ENGINE_NAME, help='The OpenAI model to grade with.')
+    parser.add_argument('--backend', default=settings.GRADING_BACKEND, choices=sorted(grading_backends.BACKENDS),
+                        help='The service that grades the submissions (default: settings.GRADING_BACKEND).')
+    parser.add_argument('--output', help='Results file to write (default: Downloads/Grading Results).')
+    parser.add_argument('--no-resume', action='store_true', help='Regrade every student instead of resuming.')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the response cache.')
+    parser.add_argument('--no-email', action='store_true', help='Do not email the results.')
+    parser.add_argument('--sections', action='store_true', default=settings.GRADE_BY_SECTION,
+                        help='Grade every section of the criteria separately and side by side, then merge the scores.')
+    parser.add_argument('--samples', type=int, default=settings.CONSENSUS_SAMPLES,
+                        help='Grade every student this many times in one request, keep the median grade and flag '
+                             'students whose gradings disagree.')
+    parser.add_argument('--stream', action='store_true', default=settings.STREAM_PIPELINE,
+                        help='Keep memory bounded for very large classes: scan, read and record the students a '
+                             'window at a time, and email a summary with the full report attached.')
+    parser.add_argument('--batch-api', action='store_true',
+                        help='Send all requests as one OpenAI Batch API job and wait for it (slow, but not '
+                             'bound by the per-minute rate limits).')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep watching --folder and grade new and changed submissions as they arrive.')
+    parser.add_argument('--poll-seconds', type=float, default=settings.WATCH_POLL_SECONDS,
+                        help='Seconds between two scans of the folder in watch mode.')
+    parser.add_argument('--debounce-seconds', type=float, default=settings.WATCH_DEBOUNCE_SECONDS,
+                        help="Seconds a student's files must stay unchanged before watch mode grades them.")
+    parser.add_argument('--digest-minutes', type=float, default=settings.WATCH_DIGEST_MINUTES,
+                        help='Minutes between two digest emails of the students graded in watch mode.')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Estimate the requests, tokens, cost and time of the run without sending anything. '
+                             'Exits with status 1 when the run would pass a budget cap.')
+    parser.add_argument('--metrics', help='JSON file for the run metrics (default: next to the results file, '
+                                          'or the batch manifest).')
+    args = parser.parse_args(argv)
+
+    if args.folder and args.batch:
+        parser.error('--folder and --batch cannot be used together')
+    if args.folder and not args.criteria:
+        parser.error('--criteria is required with --folder')
+    if args.watch and not args.folder:
+        parser.error('--watch requires --folder')
+    if args.watch and args.batch_api:
+        parser.error('--watch and --batch-api cannot be used together')
+    if args.estimate and not (args.folder or args.batch):
+        parser.error('--estimate requires --folder or --batch')
+    if args.samples < 1:
+        parser.error('--samples must be at least 1')
+    for extension in args.extensions:
+        if not extension.startswith('.'):
+            parser.error(f"The file extension {extension} should start with a dot (e.g., '.xlsx').")
+    return args
+
+
+def run_headless(args):
+    """
+    Grade one assignments folder without any tkinter dialogs.
+
+    Args:
+        args (argparse.Namespace): The arguments from parse_arguments.
+
+    Returns:
+        int: The process exit code. 0 if every student was graded, 1 if the run failed
+        or any student failed to grade.
+    """
+    general_functions.set_interactive(False)
+    try:
+        logging.info('Headless grading of %s executing', args.folder)
+        instrumentation.start_run()
+        grading_criteria = file_actions.read_grading_criteria(args.criteria)
+        results_path = args.output or file_actions.get_results_file_path()
+        student_records = file_actions.grade_assignments(args.folder, grading_criteria, args.extensions,
+                                                         resume=not args.no_resume,
+                                                         max_workers=args.workers,
+                                                         use_cache=not args.no_cache,
+                                                         model_name=args.model,
+                                                         results_path=results_path,
+                                                         use_batch_api=args.batch_api,
+                                                         backend=args.backend,
+                                                         grade_by_section=args.sections,
+                                                         samples=args.samples, stream=args.stream)
+        if student_records is None:
+            print(f'Grading {args.folder} failed. See the application log for details.', file=sys.stderr)
+            return 1
+
+        if not args.no_email:
+            grading_results, attachment_path = file_actions.get_results_email(results_path)
+            email.send_email_to_user(grading_results, attachment_path=attachment_path)
+        instrumentation.export_run_metrics(args.metrics or instrumentation.get_metrics_path(results_path))
+
+        failed = sorted(name for name, record in student_records.items() if record['status'] == 'failed')
+        print(f'Graded {len(student_records)} students from {args.folder}. Results: {results_path}')
+        if failed:
+            print(f'Failed to grade: {", ".join(failed)}', file=sys.stderr)
+            return 1
+
+        logging.info('Headless grading completed! Results written to %s', results_path)
+        return 0
+    except Exception as ex:
+        logging.error(f'An unexpected error occurred in run_headless. Error: {ex}')
+        print(f'The grading process failed. Error: {ex}', file=sys.stderr)
+        return 1
+
+
+def run_estimate(args):
+    """
+    Print what a --folder or --batch run would cost, without sending anything.
+
+    Args:
+        args (argparse.Namespace): The arguments from parse_arguments.
+
+    Returns:
+        int: The process exit code. 0 if the run fits the budget caps, 1 if it would pass 
+        one or the estimate failed.
+    """
+    general_functions.set_interactive(False)
+    try:
+        if args.batch:
+            jobs = batch_grading.load_batch_manifest(args.batch)
+        else:
+            jobs = [{'name': args.folder, 'folder': args.folder, 'criteria': args.criteria,
+                     'extensions': args.extensions, 'model': None, 'backend': None,
+                     'output': args.output or file_actions.get_results_file_path(create=False)}]
+        estimates = []
+        for job in jobs:
+            grading_criteria = file_actions.read_grading_criteria(job['criteria'])
+            # Only looked up: an estimate creates no folders
+            results_path = batch_grading.get_job_output(job, create=False)
+            estimate = cost_estimate.estimate_assignments(job['folder'], grading_criteria, job['extensions'],
+                                                          resume=not args.no_resume,
+                                                          use_cache=not args.no_cache,
+                                                          model_name=job['model'] or args.model,
+                                                          results_path=results_path,
+                                                          backend=job['backend'] or args.backend,
+                                                          grade_by_section=args.sections, samples=args.samples,
+                                                          use_batch_api=args.batch_api)
+            estimates.append(estimate)
+            print(f"{job['name']}: {cost_estimate.format_estimate(estimate)}")
+
+        budget = cost_estimate.check_budget(estimates)
+        if len(estimates) > 1:
+            print(f"Total: {sum(estimate['requests'] for estimate in estimates)} requests, "
+                  f"${sum(estimate['dollars'] for estimate in estimates):,.2f}")
+        if budget:
+            print(cost_estimate.format_budget(budget))
+        return 0 if all(row['fits'] for row in budget) else 1
+    except Exception as ex:
+        logging.error(f'An unexpected error occurred in run_estimate. Error: {ex}')
+        print(f'The estimate failed. Error: {ex}', file=sys.stderr)
+        return 1
+
+
+def run_watch(args):
+    """
+    Keep grading new and changed submissions in one assignments folder until interrupted.
+
+    Args:
+        args (argparse.Namespace): The arguments from parse_arguments.
+
+    Returns:
+        int: The process exit code. 0 once the watcher was stopped, 1 if it could not start.
+    """
+    general_functions.set_interactive(False)
+    try:
+        logging.info('Watching %s', args.folder)
+        instrumentation.start_run()
+        grading_criteria = file_actions.read_grading_criteria(args.criteria)
+        results_path = args.output or file_actions.get_results_file_path()
+        watch_mode.watch_assignments(args.folder, grading_criteria, args.extensions,
+                                     results_path=results_path,
+                                     poll_seconds=args.poll_seconds,
+                                     debounce_seconds=args.debounce_seconds,
+                                     digest_minutes=args.digest_minutes,
+                                     send_email=not args.no_email,
+                                     max_workers=args.workers,
+                                     use_cache=not args.no_cache,
+                                     model_name=args.model,
+                                     backend=args.backend,
+                                     grade_by_section=args.sections,
+                                     samples=args.samples)
+        instrumentation.export_run_metrics(args.metrics or instrumentation.get_metrics_path(results_path))
+        return 0
+    except Exception as ex:
+        logging.error(f'An unexpected error occurred in run_watch. Error: {ex}')
+        print(f'Watch mode failed. Error: {ex}', file=sys.stderr)
+        return 1
+
+
+def run_batch(args):
+    """
+    Grade every job of a batch manifest in one process, without any tkinter dialogs.
+
+    Args:
+        args (argparse.Namespace): The arguments from parse_arguments.
+
+    Returns:
+        int: The process exit code. 0 if every job and student was graded, 1 otherwise.
+    """
+    general_functions.set_interactive(False)
+    try:
+        logging.info('Batch grading of %s executing', args.batch)
+        instrumentation.start_run()
+        jobs = batch_grading.load_batch_manifest(args.batch)
+        results = batch_grading.grade_batch(jobs, max_workers=args.workers,
+                                            model_name=args.model,
+                                            resume=not args.no_resume,
+                                            use_cache=not args.no_cache,
+                                            send_email=not args.no_email,
+                                            use_batch_api=args.batch_api,
+                                            backend=args.backend,
+                                            grade_by_section=args.sections,
+                                            samples=args.samples, stream=args.stream)
+        instrumentation.export_run_metrics(args.metrics or instrumentation.get_metrics_path(args.batch))
+        exit_code = 0
+        for job in jobs:
+            student_records = results.get(job['name'])
+            if student_records is None:
+                print(f"{job['name']}: failed. See the application log for details.", file=sys.stderr)
+                exit_code = 1
+                continue
+            failed = sorted(name for name, record in student_records.items() if record['status'] == 'failed')
+            print(f"{job['name']}: graded {len(student_records)} students. "
+                  f"Results: {batch_grading.get_job_output(job)}")
+            if failed:
+                print(f"{job['name']}: failed to grade {', '.join(failed)}", file=sys.stderr)
+                exit_code = 1
+        return exit_code
+    except Exception as ex:
+        logging.error(f'An unexpected error occurred in run_batch. Error: {ex}')
+        print(f'The batch grading process failed. Error: {ex}', file=sys.stderr)
+        return 1
+
+
 if __name__ == "__main__":
     general_functions.configure_logging()
+    arguments = parse_arguments()
+    if arguments.estimate:
+        sys.exit(run_estimate(arguments))
+    if arguments.batch:
+        sys.exit(run_batch(arguments))
+    if arguments.watch:
+        sys.exit(run_watch(arguments))
+    if arguments.folder:
+        sys.exit(run_headless(arguments))
     main()
-   
\ No newline at end of file
@@ -0,0 +1,220 @@
+'''
+The batch api file grades many students through the OpenAI
+Batch API instead of one chat completion request at a time.
+
+All prompts of a run are written to a JSON Lines request file,
+uploaded, and submitted as one batch job. The job runs against
+the batch quota instead of the per-minute rate limits, so very
+large runs (e.g. end-of-term grading of thousands of students)
+are not throttled, at the price of finishing within hours
+instead of minutes. The job is polled until it ends, and its
+output file is read back into one response per student.
+
+The id of a submitted job is saved next to its request file,
+so a run that is restarted while the job is still running
+picks it up again instead of paying for it twice.
+
+Requests go to the same OPENAI_API_BASE as the chat completions,
+so benchmarks/mock_openai_server.py can stand in for the API. The
+openai package (which holds the key and endpoint) is only imported
+once the first batch request is sent.
+'''
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from settings import settings
+
+CHAT_COMPLETIONS_ENDPOINT = '/v1/chat/completions'
+
+# Batch statuses after which the job no longer changes
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+BATCH_STATE_SUFFIX = '_state.json'
+
+
+class BatchJobError(RuntimeError):
+    '''
+    Raised when a batch job cannot be submitted, fails, or does not finish in time.
+    '''
+
+
+def write_batch_requests(requests, request_path):
+    '''
+    Write the chat completion requests of a run to a batch request file.
+
+    Parameters:
+    - requests (list): (custom_id, model_name, messages) tuples, one per student.
+    - request_path (str): The JSON Lines file to write.
+
+    Returns:
+    - str: The SHA-256 hex digest of the file, which identifies the batch.
+    '''
+    digest = hashlib.sha256()
+    with open(request_path, 'w', encoding='utf-8') as request_file:
+        for custom_id, model_name, messages in requests:
+            line = json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': CHAT_COMPLETIONS_ENDPOINT,
+                               'body': {'model': model_name, 'messages': messages}}) + '\n'
+            digest.update(line.encode('utf-8'))
+            request_file.write(line)
+    return digest.hexdigest()
+
+
+def submit_batch(request_path):
+    '''
+    Upload a batch request file and start a batch job for it.
+
+    Parameters:
+    - request_path (str): The JSON Lines file written by write_batch_requests.
+
+    Returns:
+    - dict: The batch job as returned by the API, including its `id` and `status`.
+    '''
+    with open(request_path, 'rb') as request_file:
+        uploaded_file = _upload_file(os.path.basename(request_path), request_file.read())
+    batch = _request_json('POST', '/batches', {'input_file_id': uploaded_file['id'],
+                                               'endpoint': CHAT_COMPLETIONS_ENDPOINT,
+                                               'completion_window': settings.BATCH_COMPLETION_WINDOW})
+    logging.info('Submitted batch job %s for %s', batch['id'], request_path)
+    return batch
+
+
+def wait_for_batch(batch_id, poll_seconds=settings.BATCH_POLL_SECONDS,
+                   max_wait_seconds=settings.BATCH_MAX_WAIT_HOURS * 3600, sleep=time.sleep):
+    '''
+    Poll a batch job until it has ended.
+
+    Parameters:
+    - batch_id (str): The id of the batch job.
+    - poll_seconds (float, optional): Seconds between two polls. Defaults to settings.BATCH_POLL_SECONDS.
+    - max_wait_seconds (float, optional): How long to wait for the job. Defaults to
+                                          settings.BATCH_MAX_WAIT_HOURS.
+
+    Returns:
+    - dict: The ended batch job.
+
+    Raises:
+    - BatchJobError: If the job is still running after `max_wait_seconds`.
+    '''
+    deadline = time.monotonic() + max_wait_seconds
+    while True:
+        batch = _request_json('GET', f'/batches/{batch_id}')
+        if batch['status'] in FINAL_STATUSES:
+            logging.info('Batch job %s ended with status %s (%s)', batch_id, batch['status'],
+                         batch.get('request_counts'))
+            return batch
+        if time.monotonic() >= deadline:
+            raise BatchJobError(f'Batch job {batch_id} was still {batch["status"]} after {max_wait_seconds} seconds.')
+        sleep(poll_seconds)
+
+
+def read_batch_results(batch):
+    '''
+    Download the output of an ended batch job.
+
+    Parameters:
+    - batch (dict): The ended batch job from wait_for_batch.
+
+    Returns:
+    - dict: custom_id -> the chat completion response body (a dict), or None for
+            requests that failed. Requests missing from the output are left out.
+    '''
+    results = {}
+    for file_id in (batch.get('output_file_id'), batch.get('error_file_id')):
+        if not file_id:
+            continue
+        for line in _request('GET', f'/files/{file_id}/content').decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if response.get('status_code') == 200 and not result.get('error'):
+                results[result['custom_id']] = response['body']
+            else:
+                logging.error('The batch request for %s failed: %s', result['custom_id'],
+                              result.get('error') or response.get('body'))
+                results.setdefault(result['custom_id'], None)
+    return results
+
+
+def run_batch(requests, request_path, poll_seconds=settings.BATCH_POLL_SECONDS):
+    '''
+    Grade a list of requests as one batch job and wait for the responses.
+
+    Parameters:
+    - requests (list): (custom_id, model_name, messages) tuples, one per student.
+    - request_path (str): Where to write the batch request file. The id of the job is
+                          saved next to it, with BATCH_STATE_SUFFIX in place of its extension.
+    - poll_seconds (float, optional): Seconds between two polls of the job.
+
+    Returns:
+    - dict: custom_id -> the chat completion response body, or None if that request failed.
+
+    Raises:
+    - BatchJobError: If the job failed, expired without any output or did not finish in time.
+
+    When the saved job was submitted for exactly the same requests, it is polled again
+    instead of being submitted a second time.
+    '''
+    request_hash = write_batch_requests(requests, request_path)
+    state_path = os.path.splitext(request_path)[0] + BATCH_STATE_SUFFIX
+    batch_id = _load_batch_id(state_path, request_hash)
+    if batch_id:
+        logging.info('Resuming batch job %s for %s', batch_id, request_path)
+    else:
+        batch_id = submit_batch(request_path)['id']
+        with open(state_path, 'w', encoding='utf-8') as state_file:
+            json.dump({'request_hash': request_hash, 'batch_id': batch_id}, state_file)
+
+    batch = wait_for_batch(batch_id, poll_seconds)
+    if batch['status'] == 'failed' or not (batch.get('output_file_id') or batch.get('error_file_id')):
+        os.remove(state_path)
+        raise BatchJobError(f'Batch job {batch_id} ended with status {batch["status"]}: {batch.get("errors")}')
+
+    results = read_batch_results(batch)
+    os.remove(state_path)
+    return results
+
+
+def _load_batch_id(state_path, request_hash):
+    try:
+        with open(state_path, 'r', encoding='utf-8') as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+    return state.get('batch_id') if state.get('request_hash') == request_hash else None
+
+
+def _upload_file(file_name, data):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="purpose"\r\n\r\nbatch\r\n'
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+            'Content-Type: application/jsonl\r\n\r\n').encode('utf-8') + data + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return json.loads(_request('POST', '/files', body, f'multipart/form-data; boundary={boundary}'))
+
+
+def _request_json(method, path, payload=None):
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    return json.loads(_request(method, path, data, 'application/json'))
+
+
+def _request(method, path, data=None, content_type=None):
+    import urllib.error
+    import urllib.request
+    # Importing open_ai_api_calls sets the key and endpoint on the openai package
+    from openai_actions import open_ai_api_calls
+
+    openai = open_ai_api_calls.openai
+    request = urllib.request.Request(openai.api_base.rstrip('/') + path, data=data, method=method)
+    request.add_header('Authorization', f'Bearer {openai.api_key}')
+    if content_type:
+        request.add_header('Content-Type', content_type)
+    try:
+        with urllib.request.urlopen(request, timeout=settings.BATCH_REQUEST_TIMEOUT_SECONDS) as response:
+            return response.read()
+    except urllib.error.HTTPError as ex:
+        raise BatchJobError(f'{method} {path} failed with HTTP {ex.code}: {ex.read()[:500]!r}') from ex
+    except urllib.error.URLError as ex:
+        raise BatchJobError(f'{method} {path} failed: {ex.reason}') from ex
@@ -0,0 +1,374 @@
+'''
+The grading backends file puts the services a submission can
+be graded by behind one interface, so the grading pipeline does
+not care which one answers:
+
+- openai: the OpenAI chat completions API, with the rate limits,
+  backoff, streaming and model routing of open_ai_api_calls. The
+  openai package is only imported by the first request, so runs
+  served entirely from the cache never load it.
+- openai_compatible: any self-hosted server that speaks the
+  OpenAI chat completions protocol (e.g. vLLM, llama.cpp,
+  Ollama), at settings.OPENAI_COMPATIBLE_API_BASE.
+- local_rubric: a deterministic scorer that runs on the CPU. It
+  awards the points of every rubric item whose keywords appear
+  in the submission. It is free and instant, so it can also
+  pre-screen submissions and settle the easy ones (see
+  settings.PRESCREEN_WITH_LOCAL_RUBRIC).
+
+Several independent gradings of a student (see grade_consensus)
+are asked for with `grade_samples`: in one request with the `n`
+parameter where the service supports it, otherwise with requests
+sent at the same time.
+
+Requests to the OpenAI API and to self-hosted servers are written
+to the usage ledger and held to its budget caps (see usage_ledger).
+
+Backends are created once per process and reused, so each keeps
+its HTTP connections open across students (the openai package
+keeps one session per thread, the compatible backend does the
+same with its own sessions).
+'''
+import logging
+import re
+import threading
+import time
+from openai_actions import model_routing, rate_limiter, token_counter, usage_ledger
+from settings import settings
+
+
+class GradingBackend:
+    '''
+    A service that grades chat messages. Subclasses implement `grade`.
+    '''
+    name = None
+
+    def select_model(self, prompt_tokens, model_name):
+        '''
+        Pick the model a request of `prompt_tokens` is sent to, when `model_name` was requested.
+        '''
+        return model_name
+
+    def cache_model(self, model_name):
+        '''
+        The model name used in cache keys and run manifests, so grades from different
+        backends are never mixed up.
+        '''
+        return f'{self.name}:{model_name}'
+
+    def grade(self, messages, model_name, prompt_tokens=None, details=None, stop_when=None):
+        '''
+        Grade the chat messages of one student.
+
+        Parameters:
+        - messages (list): The criteria system message and the submission.
+        - model_name (str): The model picked by select_model.
+        - prompt_tokens (int, optional): The number of prompt tokens, if already counted.
+        - details (dict, optional): Filled with the `model`, `prompt_tokens` and
+                                    `completion_tokens` of the request.
+        - stop_when (callable, optional): Stop reading the response once it returns True,
+                                          for backends that stream.
+
+        Returns:
+        - str or None: The grade response, or None if the request failed.
+        '''
+        raise NotImplementedError
+
+    def grade_samples(self, messages, model_name, samples, prompt_tokens=None, details=None):
+        '''
+        Grade the chat messages of one student `samples` times, independently.
+
+        Parameters:
+        - messages, model_name, prompt_tokens: As for grade.
+        - samples (int): The number of gradings.
+        - details (dict, optional): Filled like by grade, with the tokens of all the gradings.
+
+        Returns:
+        - list: `samples` grade responses, None for every grading that failed.
+
+        Backends without a way to ask for several answers in one request send the
+        requests at the same time, so the samples take about as long as one.
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        sample_details = [{} for _ in range(samples)]
+        with ThreadPoolExecutor(max_workers=samples, thread_name_prefix='sample') as pool:
+            responses = list(pool.map(lambda details: self.grade(messages, model_name, prompt_tokens, details),
+                                      sample_details))
+        _merge_sample_details(details, model_name, sample_details)
+        return responses
+
+
+class OpenAIBackend(GradingBackend):
+    '''
+    Grades through the OpenAI chat completions API.
+    '''
+    name = 'openai'
+
+    def select_model(self, prompt_tokens, model_name):
+        return model_routing.select_model(prompt_tokens, model_name)
+
+    def cache_model(self, model_name):
+        # Plain model names, so the cache and manifests of earlier runs stay valid
+        return model_name
+
+    def grade(self, messages, model_name, prompt_tokens=None, details=None, stop_when=None):
+        from openai_actions import open_ai_api_calls
+
+        return open_ai_api_calls.generate_chat_completions(messages, model_name=model_name,
+                                                           prompt_tokens=prompt_tokens, details=details,
+                                                           stop_when=stop_when)
+
+    def grade_samples(self, messages, model_name, samples, prompt_tokens=None, details=None):
+        from openai_actions import open_ai_api_calls
+
+        # One request with the `n` parameter: the prompt is only sent and billed once
+        responses = open_ai_api_calls.generate_chat_completions(messages, model_name=model_name,
+                                                                prompt_tokens=prompt_tokens, details=details,
+                                                                samples=samples)
+        return responses if responses is not None else [None] * samples
+
+
+class OpenAICompatibleBackend(GradingBackend):
+    '''
+    Grades through a self-hosted server that speaks the OpenAI chat completions protocol.
+    '''
+    name = 'openai_compatible'
+
+    def __init__(self, api_base=settings.OPENAI_COMPATIBLE_API_BASE, api_key=settings.OPENAI_COMPATIBLE_API_KEY,
+                 model=settings.OPENAI_COMPATIBLE_MODEL):
+        self.url = api_base.rstrip('/') + '/chat/completions'
+        self.api_key = api_key
+        self.model = model
+        self._sessions = threading.local()
+
+    def select_model(self, prompt_tokens, model_name):
+        return self.model
+
+    def cache_model(self, model_name):
+        return f'{self.name}:{self.model}'
+
+    def _session(self):
+        session = getattr(self._sessions, 'session', None)
+        if session is None:
+            import requests
+            session = self._sessions.session = requests.Session()
+            if self.api_key:
+                session.headers['Authorization'] = f'Bearer {self.api_key}'
+        return session
+
+    def grade(self, messages, model_name, prompt_tokens=None, details=None, stop_when=None):
+        return self._complete(messages, model_name, prompt_tokens, details)[0]
+
+    def grade_samples(self, messages, model_name, samples, prompt_tokens=None, details=None):
+        details = details if details is not None else {}
+        responses = self._complete(messages, model_name, prompt_tokens, details, samples)
+        if responses[0] is None:
+            return [None] * samples
+        if len(responses) < samples:
+            # Some servers (e.g. llama.cpp) ignore `n` and send one choice; ask for the rest separately
+            logging.info('The grading server at %s sent %s of %s samples. Asking for the rest at the same time.',
+                         self.url, len(responses), samples)
+            rest_details = {}
+            responses += super().grade_samples(messages, model_name, samples - len(responses), prompt_tokens,
+                                               rest_details)
+            _merge_sample_details(details, model_name, [dict(details), rest_details])
+        return responses
+
+    def _complete(self, messages, model_name, prompt_tokens, details, samples=1):
+        '''
+        Send one chat completions request and return the text of its choices ([None] if it failed).
+        '''
+        details = details if details is not None else {}
+        if prompt_tokens is None:
+            prompt_tokens = token_counter.count_tokens(messages, model_name)
+        details.update(model=model_name, prompt_tokens=prompt_tokens, completion_tokens=None)
+        request_body = {'model': model_name, 'messages': messages}
+        if samples > 1:
+            request_body['n'] = samples
+        ledger = usage_ledger.get_ledger()
+        # The server has one model, so the request is never downgraded, only held to the token caps
+        reservation = ledger.reserve(model_name, prompt_tokens, settings.EXPECTED_COMPLETION_TOKENS * samples,
+                                     allow_downgrade=False)
+        try:
+            return self._send(request_body, details, samples, ledger, reservation)
+        finally:
+            ledger.release(reservation)
+
+    def _send(self, request_body, details, samples, ledger, reservation):
+        '''
+        Post a chat completions request, retrying connection problems, rate limits and server errors.
+        '''
+        import requests
+
+        attempt = 0
+        while True:
+            try:
+                response = self._session().post(self.url, json=request_body,
+                                                timeout=(settings.REQUEST_CONNECT_TIMEOUT_SECONDS,
+                                                         settings.REQUEST_TOTAL_TIMEOUT_SECONDS))
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                response, error = None, ex
+            else:
+                error = f'HTTP {response.status_code}: {response.text[:200]}'
+
+            if response is not None and response.ok:
+                try:
+                    body = response.json()
+                    usage = body.get('usage') or {}
+                    contents = [choice['message']['content'] for choice in body['choices'][:samples]]
+                    details['prompt_tokens'] = usage.get('prompt_tokens') or details['prompt_tokens']
+                    details['completion_tokens'] = usage.get('completion_tokens')
+                    if details['completion_tokens'] is None:
+                        details['completion_tokens'] = sum(token_counter.count_text_tokens(content or '',
+                                                                                           details['model'])
+                                                           for content in contents)
+                    ledger.record(details['model'], details['prompt_tokens'], details['completion_tokens'],
+                                  reservation, backend=self.name)
+                    return contents or [None]
+                except (ValueError, KeyError, IndexError, TypeError) as ex:
+                    logging.error('The grading server at %s sent an unreadable response: %s', self.url, ex)
+                    return [None]
+
+            # Connection problems, rate limits and server errors are worth another try
+            retryable = response is None or response.status_code == 429 or response.status_code >= 500
+            if not retryable or attempt >= settings.RATE_LIMIT_MAX_RETRIES:
+                logging.error('An error occurred while calling the grading server at %s: %s', self.url, error)
+                return [None]
+
+            retry_after = rate_limiter.parse_retry_after(response.headers, response.text) if response is not None else None
+            delay = rate_limiter.compute_backoff(attempt, retry_after)
+            attempt += 1
+            logging.warning('The grading server at %s failed (%s). Retrying in %.2f seconds', self.url, error, delay)
+            time.sleep(delay)
+
+
+# A rubric item: "- Uses a loop to sum the list (10 points) keywords: for, while"
+_RUBRIC_ITEM_PATTERN = re.compile(r'^[ \t]*(?:[-*•]|\d+[.)])?[ \t]*(?P<item>.+?)[ \t]*[(\[]?[ \t]*'
+                                  r'(?P<points>\d+(?:\.\d+)?)[ \t]*(?:points?|pts?|marks?)\b[ \t]*[)\]]?[ \t]*'
+                                  r'(?P<rest>.*)$', re.IGNORECASE | re.MULTILINE)
+_KEYWORDS_PATTERN = re.compile(r'keywords?\s*:\s*(.+)$', re.IGNORECASE)
+_WORD_PATTERN = re.compile(r'\w+')
+_STOP_WORDS = frozenset('''about above after also and another any are because been before being between both
+    but can could does each every from have having into least more most must other should some such than that
+    their them then there these they this those through uses using what when where which while will with
+    within without would your'''.split())
+
+
+class LocalRubricBackend(GradingBackend):
+    '''
+    Scores a submission on the CPU against the point values of the rubric items.
+
+    Every criteria line with a point value ("(10 points)", "5 pts", ...) is a rubric item.
+    The item's points are awarded when its keywords appear in the submission: the words
+    listed after "keywords:" on the line (any one of them is enough; a phrase matches
+    anywhere in the text), or otherwise at least half of the item's significant words.
+    Items with neither are not scored. The grade is deterministic and cheap, so it suits
+    pre-screening rather than final grading of nuanced work.
+    '''
+    name = 'local_rubric'
+
+    def select_model(self, prompt_tokens, model_name):
+        return self.name
+
+    def grade(self, messages, model_name, prompt_tokens=None, details=None, stop_when=None):
+        details = details if details is not None else {}
+        details.update(model=self.name, prompt_tokens=0, completion_tokens=0)
+        criteria = '\n'.join(message['content'] for message in messages if message['role'] == 'system')
+        submission = '\n'.join(message['content'] for message in messages if message['role'] == 'user')
+        items = parse_rubric(criteria)
+        if not items:
+            logging.warning('The grading criteria have no rubric items with point values to score locally')
+            return None
+
+        submission = submission.lower()
+        submission_words = set(_WORD_PATTERN.findall(submission))
+        lines = []
+        earned_points = 0.0
+        for item, points, keywords, required in items:
+            # Single words must appear as words, phrases like "if n == 0" anywhere in the text
+            found = sum(1 for keyword in keywords if keyword in submission_words
+                        or (not _WORD_PATTERN.fullmatch(keyword) and keyword in submission))
+            earned = points if found >= required else 0.0
+            earned_points += earned
+            lines.append(f'- {item}: {earned:g}/{points:g}')
+        total_points = sum(points for _, points, _, _ in items)
+        return f'Grade: {earned_points:g}/{total_points:g}\n' + '\n'.join(lines)
+
+    def grade_samples(self, messages, model_name, samples, prompt_tokens=None, details=None):
+        # The scorer is deterministic, so every sample would be the same
+        return [self.grade(messages, model_name, prompt_tokens, details)] * samples
+
+
+def _merge_sample_details(details, model_name, sample_details):
+    '''
+    Fill `details` with the model and the summed tokens of several gradings.
+    '''
+    if details is None:
+        return
+    completion_tokens = [sample.get('completion_tokens') for sample in sample_details]
+    details.update(model=model_name,
+                   prompt_tokens=sum(sample.get('prompt_tokens') or 0 for sample in sample_details),
+                   completion_tokens=None if None in completion_tokens else sum(completion_tokens))
+
+
+def parse_rubric(criteria):
+    '''
+    Find the rubric items with point values in the grading criteria.
+
+    Parameters:
+    - criteria (str): The grading criteria.
+
+    Returns:
+    - list: (item text, points, keyword set, keywords required) tuples, in criteria order.
+            Items without keywords or significant words are left out, so they count
+            towards neither the points earned nor the total.
+    '''
+    items = []
+    for match in _RUBRIC_ITEM_PATTERN.finditer(criteria):
+        item = match.group('item').strip(' :-')
+        listed_keywords = _KEYWORDS_PATTERN.search(match.group('rest'))
+        if listed_keywords:
+            keywords = {keyword.strip().lower() for keyword in listed_keywords.group(1).split(',') if keyword.strip()}
+            required = 1
+        else:
+            keywords = {word for word in _WORD_PATTERN.findall(item.lower())
+                        if len(word) > 3 and word not in _STOP_WORDS}
+            required = (len(keywords) + 1) // 2
+        if not keywords:
+            # Nothing to look for, so the item could only ever earn its points unchecked
+            continue
+        items.append((item, float(match.group('points')), keywords, required))
+    return items
+
+
+BACKENDS = {backend.name: backend for backend in (OpenAIBackend, OpenAICompatibleBackend, LocalRubricBackend)}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None):
+    '''
+    Return the shared instance of a grading backend.
+
+    Parameters:
+    - name (str or GradingBackend, optional): The backend's name (see BACKENDS), or a
+                                              backend, which is returned as is. Defaults
+                                              to settings.GRADING_BACKEND.
+
+    Returns:
+    - GradingBackend: The backend, created on first use.
+
+    Raises:
+    - ValueError: If there is no backend with that name.
+    '''
+    if isinstance(name, GradingBackend):
+        return name
+    name = name or settings.GRADING_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown grading backend {name}. Choose one of: {", ".join(BACKENDS)}')
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = BACKENDS[name]()
+        return _backends[name]
@@ -0,0 +1,79 @@
+'''
+The model routing file picks the model each grading request
+is sent to, based on how many tokens the prompt uses, and
+works out what a request is expected to cost.
+'''
+import logging
+from settings import settings
+
+
+class SubmissionTooLargeError(ValueError):
+    '''
+    Raised when a prompt does not fit the context window of any model it can be routed to.
+    '''
+
+
+def fits_context_window(model_name, prompt_tokens):
+    '''
+    Check whether a prompt and the expected reply fit in a model's context window.
+
+    Parameters:
+    - model_name (str): The model to check.
+    - prompt_tokens (int): The number of prompt tokens.
+
+    Returns:
+    - bool: True if the model can take the request. Models without a known
+            context window are assumed to fit.
+    '''
+    context_window = settings.MODEL_CONTEXT_WINDOWS.get(model_name)
+    return context_window is None or prompt_tokens + settings.EXPECTED_COMPLETION_TOKENS <= context_window
+
+
+def estimate_cost(model_name, prompt_tokens, completion_tokens=settings.EXPECTED_COMPLETION_TOKENS):
+    '''
+    Estimate the dollar cost of a request.
+
+    Parameters:
+    - model_name (str): The model the request is sent to.
+    - prompt_tokens (int): The number of prompt tokens.
+    - completion_tokens (int, optional): The number of completion tokens.
+                                         Defaults to settings.EXPECTED_COMPLETION_TOKENS.
+
+    Returns:
+    - float: The estimated cost in dollars, or 0.0 if the model has no known price.
+    '''
+    prompt_price, completion_price = settings.MODEL_PRICES_PER_1K_TOKENS.get(model_name, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def select_model(prompt_tokens, model_name=settings.ENGINE_NAME):
+    '''
+    Pick the cheapest model whose context window fits the prompt.
+
+    Parameters:
+    - prompt_tokens (int): The number of prompt tokens.
+    - model_name (str, optional): The model requested for the run. It is always a
+                                  candidate, together with settings.ROUTING_MODELS.
+
+    Returns:
+    - str: The model to send the request to. When routing is turned off
+           (settings.ENABLE_MODEL_ROUTING), this is `model_name` as long as it fits.
+
+    Raises:
+    - SubmissionTooLargeError: If the prompt fits none of the candidate models.
+    '''
+    candidates = [model_name]
+    if settings.ENABLE_MODEL_ROUTING:
+        candidates += [candidate for candidate in settings.ROUTING_MODELS if candidate != model_name]
+
+    fitting_models = [candidate for candidate in candidates if fits_context_window(candidate, prompt_tokens)]
+    if not fitting_models:
+        largest_window = max(settings.MODEL_CONTEXT_WINDOWS.get(candidate, 0) for candidate in candidates)
+        raise SubmissionTooLargeError(f'The prompt uses {prompt_tokens} tokens, which does not fit the '
+                                      f'largest available context window ({largest_window} tokens).')
+
+    # min() keeps the first of equally priced models, so the requested model wins ties
+    selected_model = min(fitting_models, key=lambda candidate: estimate_cost(candidate, prompt_tokens))
+    if selected_model != model_name:
+        logging.info('Routing a %s token prompt to %s instead of %s', prompt_tokens, selected_model, model_name)
+    return selected_model
@@ -2,15 +2,37 @@
 The open ai api calls file handles the chat completion
 request to open ai. Also will handle any other api cals
 to open ai.
+
+Completions are streamed by default (settings.STREAM_COMPLETIONS),
+so every request is bound by a connect, a read and a total
+deadline, and can stop reading as soon as the caller has what
+it needs. A request that runs past its deadline is cancelled
+and sent again, so one hung request cannot stall a run.
+
+The model and tokens of every completion are written to the
+usage ledger, which also keeps the requests within the budget
+caps (see usage_ledger).
 '''
 import logging
+import time
 import openai
+import requests
+from general_functions import instrumentation
+from openai_actions import model_routing, rate_limiter, token_counter, usage_ledger
 from settings import settings
 openai.api_key = settings.OPENAI_API_KEY
+openai.api_base = settings.OPENAI_API_BASE
+
+
+class TotalTimeoutError(openai.error.Timeout):
+    '''
+    Raised when a streamed completion is still running at its total deadline.
+    '''
 
 
 MAX_RETRIES = 2
-def generate_chat_completions(grading_criteria, model_name=settings.ENGINE_NAME, retries=0):
+def generate_chat_completions(grading_criteria, model_name=settings.ENGINE_NAME, retries=0, prompt_tokens=None,
+                              details=None, stop_when=None, samples=1):
     '''
     Generate chat completions using OpenAI's chat completion endpoint.
 
@@ -20,13 +42,28 @@ def generate_chat_completions(grading_criteria, model_name=settings.ENGINE_NAME,
     Parameters:
     - grading_criteria (list): A list of message objects indicating the conversation 
                                history and user prompts.
+    - prompt_tokens (int, optional): The number of prompt tokens, if the caller already
+                                     counted them. Counted here otherwise.
+    - details (dict, optional): If given, it is filled with the `model` that answered,
+                                its `prompt_tokens` and `completion_tokens` (as reported by
+                                the API when available, counted otherwise), the number of
+                                `rate_limit_retries` and `timeout_retries`, and `stopped_early`.
+    - stop_when (callable, optional): Called with the text received so far whenever a
+                                      streamed line ends. Once it returns True, the
+                                      stream is closed and that text is returned.
+                                      Only used for a single sample.
+    - samples (int, optional): Number of independent completions to ask for in this one
+                               request, with the API's `n` parameter. The prompt is only
+                               sent (and billed) once.
 
     Returns:
-    - str: The completed message content if successful.
+    - str: The completed message content if successful, or a list of `samples` of them
+           when more than one was asked for.
     - None: If there's an error in calling the OpenAI endpoint.
 
     Raises:
     - openai.error.OpenAIError: If there's any issue in calling the OpenAI API.
+    - usage_ledger.BudgetExceededError: If the request would pass a budget cap. It is not sent.
 
     Example Usage:
     ```python
@@ -36,27 +73,188 @@ def generate_chat_completions(grading_criteria, model_name=settings.ENGINE_NAME,
     print(message)
     ```
 
+    Every request first waits for room in the model's requests-per-minute and
+    tokens-per-minute budget (see settings.MODEL_RATE_LIMITS). When the API still
+    answers with a rate limit, the request is retried on the same model after an
+    exponential backoff with jitter, honoring any retry-after hint. A failed attempt
+    gives its tokens back to the budget before the request is retried. Only after
+    settings.RATE_LIMIT_MAX_RETRIES attempts does it fall back to the backup model,
+    and only if the prompt fits the backup model's context window.
+
+    Every request must connect within settings.REQUEST_CONNECT_TIMEOUT_SECONDS, receive
+    data at least every settings.REQUEST_READ_TIMEOUT_SECONDS and, when streamed, finish
+    within settings.REQUEST_TOTAL_TIMEOUT_SECONDS. A request that times out is cancelled
+    and sent again right away, up to settings.TIMEOUT_MAX_RETRIES times.
+
+    The expected tokens and cost of every request are reserved in the usage ledger
+    before it is sent, which may downgrade it to a cheaper model when the budget is
+    nearly used (see usage_ledger). The model and tokens of every completion are
+    written to the ledger.
+
     Note: Ensure that the OpenAI package is properly set up with necessary 
     API keys for this function to work.
     '''
+    if prompt_tokens is None:
+        prompt_tokens = token_counter.count_tokens(grading_criteria, model_name)
+    ledger = usage_ledger.get_ledger()
+    # May move the request to a cheaper model when the budget is nearly used
+    reservation = ledger.reserve(model_name, prompt_tokens, settings.EXPECTED_COMPLETION_TOKENS * samples)
+    model_name = reservation.model_name
+    limiter = rate_limiter.get_rate_limiter(model_name)
+    estimated_tokens = prompt_tokens + settings.EXPECTED_COMPLETION_TOKENS * samples
+    # Only the first line of a single completion is watched; samples are always read in full
+    stop_when = stop_when if samples == 1 else None
+    sample_options = {'n': samples} if samples > 1 else {}
+    details = details if details is not None else {}
+    details.update(model=model_name, prompt_tokens=prompt_tokens, completion_tokens=None)
+    attempt = 0
+    timeout_attempt = 0
     try:
-        logging.info('Generating the chat completion message using model %s', model_name)
+        while True:
+            try:
+                with instrumentation.stage('rate_limit_wait'):
+                    limiter.acquire(estimated_tokens)
+                logging.info('Generating the chat completion message using model %s', model_name)
+
+                if settings.STREAM_COMPLETIONS:
+                    completion_messages = _stream_chat_completion(grading_criteria, model_name, details, stop_when,
+                                                                  samples)
+                    details['completion_tokens'] = sum(token_counter.count_text_tokens(completion_message, model_name)
+                                                       for completion_message in completion_messages)
+                    limiter.record_usage(estimated_tokens, prompt_tokens + details['completion_tokens'])
+                else:
+                    response = openai.ChatCompletion.create(
+                        model=model_name,
+                        messages=grading_criteria,
+                        request_timeout=_request_timeout(),
+                        **sample_options
+                    )
+
+                    limiter.record_usage(estimated_tokens, _total_tokens(response))
+                    usage = getattr(response, 'usage', None)
+                    details['prompt_tokens'] = getattr(usage, 'prompt_tokens', None) or prompt_tokens
+                    details['completion_tokens'] = getattr(usage, 'completion_tokens', None)
+                    completion_messages = [None] * samples
+                    for choice in response.choices:
+                        completion_messages[choice.index] = choice.message.content
+                    if details['completion_tokens'] is None:
+                        details['completion_tokens'] = sum(token_counter.count_text_tokens(completion_message or '',
+                                                                                           model_name)
+                                                           for completion_message in completion_messages)
+                ledger.record(model_name, details['prompt_tokens'], details['completion_tokens'], reservation)
+                logging.info('Returning the completed message')
+                return completion_messages[0] if samples == 1 else completion_messages
+
+            except openai.error.OpenAIError as ex:
+                # Give back the tokens the failed attempt took, so a retry does not take them twice
+                limiter.record_usage(estimated_tokens, 0)
+                if isinstance(ex, openai.error.Timeout) and timeout_attempt < settings.TIMEOUT_MAX_RETRIES:
+                    timeout_attempt += 1
+                    details['timeout_retries'] = details.get('timeout_retries', 0) + 1
+                    instrumentation.count('timeout_retries')
+                    logging.warning('The request to model %s timed out (%s). Sending it again (retry %s of %s)',
+                                    model_name, ex, timeout_attempt, settings.TIMEOUT_MAX_RETRIES)
+                    continue
 
-        response = openai.ChatCompletion.create(
-            model=model_name,
-            messages=grading_criteria
-        )
+                if not _is_rate_limit_error(ex):
+                    logging.error('An error occurred while calling the OpenAI chat completion endpoint: %s', ex)
+                    return None
 
-        completion_message = response.choices[0].message.content
-        logging.info('Returning the completed message')
-        return completion_message
+                if attempt < settings.RATE_LIMIT_MAX_RETRIES:
+                    retry_after = rate_limiter.parse_retry_after(getattr(ex, 'headers', None), str(ex))
+                    delay = rate_limiter.compute_backoff(attempt, retry_after)
+                    attempt += 1
+                    details['rate_limit_retries'] = details.get('rate_limit_retries', 0) + 1
+                    instrumentation.count('rate_limit_retries')
+                    logging.warning('Rate limit reached for model %s. Backing off %.2f seconds (retry %s of %s)',
+                                    model_name, delay, attempt, settings.RATE_LIMIT_MAX_RETRIES)
+                    limiter.pause(delay)
+                    continue
 
-    except openai.error.OpenAIError as ex:
-        logging.error('An error occurred while calling the OpenAI chat completion endpoint: %s', ex)
+                logging.error('An error occurred while calling the OpenAI chat completion endpoint: %s', ex)
+                if (retries < MAX_RETRIES and model_name != settings.BACKUP_ENGINE_NAME
+                        and model_routing.fits_context_window(settings.BACKUP_ENGINE_NAME, prompt_tokens)):
+                    logging.warning('Rate limit retries exhausted for model %s. Retrying with a different model...',
+                                    model_name)
+                    instrumentation.count('fallback_requests')
+                    ledger.release(reservation)
+                    return generate_chat_completions(grading_criteria, model_name=settings.BACKUP_ENGINE_NAME,
+                                                     retries=retries+1, prompt_tokens=prompt_tokens, details=details,
+                                                     stop_when=stop_when, samples=samples)
 
-        if 'Rate limit reached' in str(ex) and retries < MAX_RETRIES:
-            logging.info('Rate limit reached for model %s. Retrying with a different model...', model_name)
-            return generate_chat_completions(grading_criteria, model_name=settings.BACKUP_ENGINE_NAME, retries=retries+1)
+                return None
+    finally:
+        # Failed requests give back what they reserved
+        ledger.release(reservation)
+
+
+def _stream_chat_completion(messages, model_name, details, stop_when=None, samples=1):
+    '''
+    Stream a chat completion and return the text of each of its `samples` choices.
 
-        return None
-    
\ No newline at end of file
+    The stream is closed once `stop_when` is satisfied by the first choice, and
+    TotalTimeoutError is raised when it is still running at
+    settings.REQUEST_TOTAL_TIMEOUT_SECONDS. A read timeout or a dropped
+    connection while the stream is read raises openai.error.Timeout, so the
+    request is sent again like any other timeout.
+    '''
+    deadline = time.monotonic() + settings.REQUEST_TOTAL_TIMEOUT_SECONDS
+    stream = openai.ChatCompletion.create(
+        model=model_name,
+        messages=messages,
+        stream=True,
+        request_timeout=_request_timeout(),
+        **({'n': samples} if samples > 1 else {})
+    )
+    choice_parts = [[] for _ in range(samples)]
+    parts = choice_parts[0]
+    details['stopped_early'] = False
+    try:
+        for chunk in stream:
+            if time.monotonic() > deadline:
+                raise TotalTimeoutError(f'No complete answer within {settings.REQUEST_TOTAL_TIMEOUT_SECONDS} seconds')
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            content = choice.delta.get('content')
+            if not content:
+                continue
+            choice_parts[choice.get('index', 0)].append(content)
+            if choice.get('index', 0):
+                continue
+            # Only check once a line has ended, so the received text is not joined for every chunk
+            if stop_when and '\n' in content and stop_when(''.join(parts)):
+                details['stopped_early'] = True
+                instrumentation.count('early_stops')
+                logging.info('Stopped reading the completion from model %s early', model_name)
+                break
+    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout) as ex:
+        # The openai package only wraps errors of the initial request, not those of reading the stream
+        raise openai.error.Timeout(f'The stream from model {model_name} broke off: {ex}') from ex
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+    return [''.join(parts) for parts in choice_parts]
+
+
+def _request_timeout():
+    '''
+    The (connect, read) timeout of a request, in seconds.
+    '''
+    return (settings.REQUEST_CONNECT_TIMEOUT_SECONDS, settings.REQUEST_READ_TIMEOUT_SECONDS)
+
+
+def _is_rate_limit_error(ex):
+    '''
+    Check whether an OpenAI error was caused by a rate limit (HTTP 429).
+    '''
+    return isinstance(ex, openai.error.RateLimitError) or 'Rate limit reached' in str(ex)
+
+
+def _total_tokens(response):
+    '''
+    Read the total token usage from a chat completion response, if it was reported.
+    '''
+    usage = getattr(response, 'usage', None)
+    return getattr(usage, 'total_tokens', None)
@@ -0,0 +1,171 @@
+'''
+The rate limiter file keeps our open ai calls inside the
+requests-per-minute and tokens-per-minute budgets of each
+model, and works out how long to back off after a rate limit.
+'''
+import logging
+import random
+import re
+import threading
+import time
+from settings import settings
+
+
+class TokenBucket:
+    '''
+    A thread safe token bucket that refills continuously.
+
+    Callers reserve capacity up front. When the bucket does not hold enough,
+    the balance goes negative and the caller is told how long to wait, so
+    concurrent callers are served in the order they asked.
+    '''
+
+    def __init__(self, capacity, refill_per_second, clock=time.monotonic):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._clock = clock
+        self._available = float(capacity)
+        self._updated_at = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated_at
+        self._available = min(self.capacity, self._available + elapsed * self.refill_per_second)
+        self._updated_at = now
+
+    def reserve(self, amount):
+        '''
+        Take `amount` from the bucket and return the seconds to wait before using it.
+        '''
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(self._clock())
+            self._available -= amount
+            if self._available >= 0:
+                return 0.0
+            return -self._available / self.refill_per_second
+
+    def adjust(self, amount):
+        '''
+        Give back (positive) or take away (negative) capacity after the real usage is known.
+        '''
+        with self._lock:
+            self._refill(self._clock())
+            self._available = min(self.capacity, self._available + amount)
+
+
+class ModelRateLimiter:
+    '''
+    Requests-per-minute and tokens-per-minute budgets for a single model.
+    '''
+
+    def __init__(self, model_name, requests_per_minute, tokens_per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.model_name = model_name
+        self._clock = clock
+        self._sleep = sleep
+        self._requests = TokenBucket(requests_per_minute, requests_per_minute / 60, clock)
+        self._tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60, clock)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens):
+        '''
+        Block until one request of `estimated_tokens` fits in the model's budget.
+
+        Returns:
+        - float: The number of seconds spent waiting.
+        '''
+        with self._lock:
+            wait = max(self._requests.reserve(1),
+                       self._tokens.reserve(estimated_tokens),
+                       self._paused_until - self._clock())
+        if wait > 0:
+            logging.info('Waiting %.2f seconds for the %s rate limit budget', wait, self.model_name)
+            self._sleep(wait)
+        return max(wait, 0.0)
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        '''
+        Correct the token budget once the response reports how many tokens were used.
+        '''
+        if actual_tokens is not None:
+            self._tokens.adjust(estimated_tokens - actual_tokens)
+
+    def pause(self, seconds):
+        '''
+        Hold back every request to this model for `seconds`, e.g. after a 429.
+        '''
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model_name):
+    '''
+    Return the shared rate limiter for a model, creating it from settings on first use.
+
+    Parameters:
+    - model_name (str): The model the request is sent to.
+
+    Returns:
+    - ModelRateLimiter: The limiter shared by every caller of this model.
+    '''
+    with _rate_limiters_lock:
+        if model_name not in _rate_limiters:
+            limits = settings.MODEL_RATE_LIMITS.get(model_name, settings.DEFAULT_RATE_LIMIT)
+            _rate_limiters[model_name] = ModelRateLimiter(model_name,
+                                                          limits['requests_per_minute'],
+                                                          limits['tokens_per_minute'])
+        return _rate_limiters[model_name]
+
+
+def compute_backoff(attempt, retry_after=None):
+    '''
+    Work out how long to wait before retrying a rate limited request.
+
+    Parameters:
+    - attempt (int): How many times this request has already been retried (0 for the first retry).
+    - retry_after (float, optional): The delay in seconds suggested by the server, if any.
+
+    Returns:
+    - float: The number of seconds to wait. Uses exponential backoff with full jitter,
+             and never waits less than the server asked for.
+    '''
+    ceiling = min(settings.BACKOFF_MAX_SECONDS, settings.BACKOFF_BASE_SECONDS * (2 ** attempt))
+    delay = random.uniform(0, ceiling)
+    if retry_after is not None:
+        delay = retry_after + random.uniform(0, settings.BACKOFF_BASE_SECONDS)
+    return delay
+
+
+_TRY_AGAIN_PATTERN = re.compile(r'try again in (\d+(?:\.\d+)?)\s*(ms|s)', re.IGNORECASE)
+
+
+def parse_retry_after(headers, message=''):
+    '''
+    Read the retry delay suggested by open ai from the response headers or error message.
+
+    Parameters:
+    - headers (dict): The HTTP headers of the rate limited response.
+    - message (str, optional): The error message, which often says "Please try again in 20s".
+
+    Returns:
+    - float or None: The suggested delay in seconds, or None if the server gave no hint.
+    '''
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        logging.warning('Could not parse the retry-after header: %s', headers)
+
+    match = _TRY_AGAIN_PATTERN.search(message or '')
+    if match:
+        value = float(match.group(1))
+        return value / 1000 if match.group(2).lower() == 'ms' else value
+    return None
@@ -0,0 +1,108 @@
+'''
+The token counter file counts how many tokens a chat
+completion request will use before it is sent to open ai.
+
+It uses the tiktoken package when it is installed, and a
+fast characters-per-token estimate otherwise. tiktoken is
+imported by the first count, not at startup.
+'''
+import functools
+import logging
+
+# Rough average for English text and source code with the gpt tokenizers
+CHARACTERS_PER_TOKEN = 4
+
+# Every chat message carries a few tokens of role/formatting overhead
+TOKENS_PER_MESSAGE = 4
+
+# Every reply is primed with a few tokens
+TOKENS_PER_REPLY = 3
+
+_encodings = {}
+
+
+def estimate_tokens(messages):
+    '''
+    Estimate the number of prompt tokens used by a list of chat messages.
+
+    Parameters:
+    - messages (list): A list of message objects, e.g. [{"role": "user", "content": "..."}].
+
+    Returns:
+    - int: The estimated number of prompt tokens.
+    '''
+    total_tokens = 0
+    for message in messages:
+        content = message.get('content') or ''
+        total_tokens += TOKENS_PER_MESSAGE + len(content) // CHARACTERS_PER_TOKEN
+    return total_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tiktoken():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken
+
+
+def _get_encoding(model_name):
+    tiktoken = _get_tiktoken()
+    if model_name not in _encodings:
+        try:
+            _encodings[model_name] = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            logging.warning('No tiktoken encoding known for model %s. Using cl100k_base.', model_name)
+            _encodings[model_name] = tiktoken.get_encoding('cl100k_base')
+    return _encodings[model_name]
+
+
+def count_tokens(messages, model_name):
+    '''
+    Count the prompt tokens of a list of chat messages for a model.
+
+    Parameters:
+    - messages (list): A list of message objects, e.g. [{"role": "user", "content": "..."}].
+    - model_name (str): The model whose tokenizer should be used.
+
+    Returns:
+    - int: The exact number of prompt tokens when tiktoken is installed,
+           otherwise the estimate from estimate_tokens.
+    '''
+    if _get_tiktoken() is None:
+        return estimate_tokens(messages)
+
+    total_tokens = TOKENS_PER_REPLY
+    for message in messages:
+        # The system message is the criteria prefix shared by every request of a run
+        count = _count_cached_text_tokens if message.get('role') == 'system' else _count_text_tokens
+        total_tokens += TOKENS_PER_MESSAGE
+        for value in message.values():
+            total_tokens += count(value or '', model_name)
+    return total_tokens
+
+
+def count_text_tokens(text, model_name):
+    '''
+    Count the tokens of a piece of text, e.g. a completion, for a model.
+
+    Parameters:
+    - text (str): The text to count.
+    - model_name (str): The model whose tokenizer should be used.
+
+    Returns:
+    - int: The exact number of tokens when tiktoken is installed, otherwise an estimate.
+    '''
+    if _get_tiktoken() is None:
+        return len(text) // CHARACTERS_PER_TOKEN
+    return _count_text_tokens(text, model_name)
+
+
+def _count_text_tokens(text, model_name):
+    return len(_get_encoding(model_name).encode(text, disallowed_special=()))
+
+
+@functools.lru_cache(maxsize=32)
+def _count_cached_text_tokens(text, model_name):
+    return _count_text_tokens(text, model_name)
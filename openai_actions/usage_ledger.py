@@ -0,0 +1,319 @@
+'''
+The usage ledger file records the model and the prompt and
+completion tokens of every chat completion, with what it cost,
+and keeps the spending of a run and of a day within the caps
+in settings.
+
+Every completion is written to a SQLite database
+(settings.USAGE_LEDGER_PATH), so the spending of a day adds up
+across runs. Days are counted in UTC, like the OpenAI usage page.
+
+Before a request is sent, its expected tokens and cost are
+reserved against the caps (settings.BUDGET_MAX_RUN_TOKENS,
+BUDGET_MAX_RUN_DOLLARS, BUDGET_MAX_DAY_TOKENS and
+BUDGET_MAX_DAY_DOLLARS, None for no cap), so requests sent at
+the same time cannot overshoot them together:
+
+- Once a dollar cap is settings.BUDGET_DOWNGRADE_SHARE used,
+  requests are downgraded to settings.BUDGET_DOWNGRADE_MODEL
+  when it is cheaper and the prompt fits its context window.
+- A request that would still pass a cap is not sent:
+  BudgetExceededError is raised, and the ledger stays exhausted
+  until the next run (or the next day), so the remaining
+  students are left for a later run instead of being sent.
+
+A run starts with start_run: every process, every grading pass
+of watch mode, and a --batch run as a whole, since its jobs are
+graded side by side.
+'''
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from general_functions import instrumentation
+from openai_actions import model_routing
+from settings import settings
+
+
+class BudgetExceededError(RuntimeError):
+    '''
+    Raised instead of sending a request that would pass a token or dollar cap.
+    '''
+
+
+class Reservation:
+    '''
+    The expected tokens and cost of a request, held against the caps until it is recorded or released.
+    '''
+
+    def __init__(self, model_name, tokens, dollars):
+        self.model_name = model_name
+        self.tokens = tokens
+        self.dollars = dollars
+        self.open = True
+
+
+class UsageLedger:
+    '''
+    Thread safe record of the tokens and dollars spent, checked against the budget caps.
+    '''
+
+    def __init__(self, ledger_path=settings.USAGE_LEDGER_PATH, caps=None, clock=time.time):
+        self.ledger_path = ledger_path
+        self.caps = caps if caps is not None else get_budget_caps()
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._day = None
+        self._spent = {}
+        self._reserved = {'tokens': 0, 'dollars': 0.0}
+        self.exhausted = False
+        self.start_run()
+
+    def start_run(self):
+        '''
+        Start counting the spending of a new run, and lift a pause from the previous one.
+        '''
+        with self._lock:
+            self._spent['run'] = {'tokens': 0, 'dollars': 0.0}
+            self.exhausted = False
+
+    def reserve(self, model_name, prompt_tokens, completion_tokens=settings.EXPECTED_COMPLETION_TOKENS,
+                allow_downgrade=True):
+        '''
+        Hold the expected usage of a request against the caps, before it is sent.
+
+        Parameters:
+        - model_name (str): The model the request is meant for.
+        - prompt_tokens (int): The number of prompt tokens.
+        - completion_tokens (int, optional): The expected completion tokens of all its choices.
+        - allow_downgrade (bool, optional): Let the request move to settings.BUDGET_DOWNGRADE_MODEL
+                                            once a dollar cap is nearly used.
+
+        Returns:
+        - Reservation: What was reserved. Its model_name is the model to send the request to.
+
+        Raises:
+        - BudgetExceededError: If the request would pass a cap, even when downgraded.
+        '''
+        with self._lock:
+            self._roll_day()
+            if self.exhausted:
+                raise BudgetExceededError('The grading budget is used up. No more requests are sent in this run.')
+            downgrade_model = settings.BUDGET_DOWNGRADE_MODEL
+            dollars = model_routing.estimate_cost(model_name, prompt_tokens, completion_tokens)
+            if (allow_downgrade and downgrade_model and downgrade_model != model_name
+                    and self._nearly_used(dollars)
+                    and model_routing.fits_context_window(downgrade_model, prompt_tokens)):
+                downgrade_dollars = model_routing.estimate_cost(downgrade_model, prompt_tokens, completion_tokens)
+                if downgrade_dollars < dollars:
+                    logging.info('The grading budget is nearly used. Sending the request to %s instead of %s',
+                                 downgrade_model, model_name)
+                    instrumentation.count('budget_downgrades')
+                    model_name, dollars = downgrade_model, downgrade_dollars
+
+            tokens = prompt_tokens + completion_tokens
+            passed_cap = self._passed_cap(tokens, dollars)
+            if passed_cap:
+                self.exhausted = True
+                raise BudgetExceededError(f'The request would pass the {passed_cap}. '
+                                          f'No more requests are sent in this run.')
+            self._reserved['tokens'] += tokens
+            self._reserved['dollars'] += dollars
+            return Reservation(model_name, tokens, dollars)
+
+    def release(self, reservation):
+        '''
+        Give back what a request reserved, e.g. when it failed. Releasing twice does nothing.
+        '''
+        if reservation is None:
+            return
+        with self._lock:
+            self._release(reservation)
+
+    def record(self, model_name, prompt_tokens, completion_tokens, reservation=None, backend='openai'):
+        '''
+        Write the usage of a completed request to the ledger and count it against the caps.
+
+        Parameters:
+        - model_name (str): The model that answered.
+        - prompt_tokens (int): The prompt tokens, as reported by the API or counted.
+        - completion_tokens (int): The completion tokens of all its choices. None counts as 0.
+        - reservation (Reservation, optional): The reservation of the request, released here.
+        - backend (str, optional): The grading backend that sent the request.
+
+        Returns:
+        - float: The cost of the request in dollars, 0.0 for models without a known price.
+        '''
+        prompt_tokens, completion_tokens = prompt_tokens or 0, completion_tokens or 0
+        dollars = model_routing.estimate_cost(model_name, prompt_tokens, completion_tokens)
+        now = self._clock()
+        with self._lock:
+            self._roll_day()
+            self._release(reservation)
+            for scope in ('run', 'day'):
+                self._spent[scope]['tokens'] += prompt_tokens + completion_tokens
+                self._spent[scope]['dollars'] += dollars
+        instrumentation.count('dollars', dollars)
+        try:
+            with closing(_connect(self.ledger_path)) as connection, connection:
+                connection.execute('INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (now, _utc_day(now), backend, model_name, prompt_tokens, completion_tokens,
+                                    dollars))
+        except sqlite3.Error as ex:
+            logging.error(f'An error occurred while writing to the usage ledger: {ex}')
+        return dollars
+
+    def get_spending(self):
+        '''
+        Return the tokens and dollars spent, per scope.
+
+        Returns:
+        - dict: {'run': {'tokens', 'dollars'}, 'day': {'tokens', 'dollars'}}. The day
+                includes the earlier runs of today (UTC).
+        '''
+        with self._lock:
+            self._roll_day()
+            return {scope: dict(spent) for scope, spent in self._spent.items()}
+
+    def _roll_day(self):
+        # Called with the lock held: (re)load the day's spending when the day starts
+        today = _utc_day(self._clock())
+        if today != self._day:
+            # A pause for the daily caps ends with the day; the run caps are checked again by the next request
+            self.exhausted = self.exhausted and self._day is None
+            self._day = today
+            self._spent['day'] = _read_day_spending(self.ledger_path, today)
+
+    def _release(self, reservation):
+        if reservation is not None and reservation.open:
+            reservation.open = False
+            self._reserved['tokens'] -= reservation.tokens
+            self._reserved['dollars'] -= reservation.dollars
+
+    def _nearly_used(self, dollars):
+        for scope in ('run', 'day'):
+            cap = self.caps.get(f'{scope}_dollars')
+            if cap is not None and (self._spent[scope]['dollars'] + self._reserved['dollars'] + dollars
+                                    > cap * settings.BUDGET_DOWNGRADE_SHARE):
+                return True
+        return False
+
+    def _passed_cap(self, tokens, dollars):
+        # The description of the first cap the request would pass, or None
+        for scope in ('run', 'day'):
+            for unit, amount in (('tokens', tokens), ('dollars', dollars)):
+                cap = self.caps.get(f'{scope}_{unit}')
+                if cap is not None and self._spent[scope][unit] + self._reserved[unit] + amount > cap:
+                    return f'{"per-run" if scope == "run" else "daily"} cap of {format_amount(unit, cap)}'
+        return None
+
+
+def get_budget_caps():
+    '''
+    Read the budget caps from settings.
+
+    Returns:
+    - dict: run_tokens, run_dollars, day_tokens and day_dollars. None means no cap.
+    '''
+    return {'run_tokens': settings.BUDGET_MAX_RUN_TOKENS, 'run_dollars': settings.BUDGET_MAX_RUN_DOLLARS,
+            'day_tokens': settings.BUDGET_MAX_DAY_TOKENS, 'day_dollars': settings.BUDGET_MAX_DAY_DOLLARS}
+
+
+def format_amount(unit, amount):
+    '''
+    Format a number of tokens or dollars for the logs and reports.
+    '''
+    return f'${amount:,.2f}' if unit == 'dollars' else f'{amount:,} tokens'
+
+
+def _utc_day(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def _connect(ledger_path):
+    directory = os.path.dirname(ledger_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(ledger_path, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('''CREATE TABLE IF NOT EXISTS usage (
+                              created_at REAL NOT NULL,
+                              day TEXT NOT NULL,
+                              backend TEXT NOT NULL,
+                              model_name TEXT NOT NULL,
+                              prompt_tokens INTEGER NOT NULL,
+                              completion_tokens INTEGER NOT NULL,
+                              dollars REAL NOT NULL)''')
+    connection.execute('CREATE INDEX IF NOT EXISTS usage_day ON usage (day)')
+    return connection
+
+
+def _read_day_spending(ledger_path, day):
+    '''
+    Add up the tokens and dollars the ledger holds for a day.
+    '''
+    try:
+        with closing(_connect(ledger_path)) as connection:
+            tokens, dollars = connection.execute('SELECT SUM(prompt_tokens + completion_tokens), SUM(dollars) '
+                                                 'FROM usage WHERE day = ?', (day,)).fetchone()
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while reading the usage ledger: {ex}')
+        return {'tokens': 0, 'dollars': 0.0}
+    return {'tokens': tokens or 0, 'dollars': dollars or 0.0}
+
+
+def read_usage(day=None, ledger_path=settings.USAGE_LEDGER_PATH):
+    '''
+    Add up the ledger per model, for one day or for all time.
+
+    Parameters:
+    - day (str, optional): The UTC day, as YYYY-MM-DD. Defaults to all days.
+    - ledger_path (str, optional): The SQLite file holding the ledger.
+
+    Returns:
+    - dict: Model name -> {'requests', 'prompt_tokens', 'completion_tokens', 'dollars'}.
+    '''
+    query = ('SELECT model_name, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(dollars) FROM usage'
+             + (' WHERE day = ?' if day else '') + ' GROUP BY model_name ORDER BY model_name')
+    try:
+        with closing(_connect(ledger_path)) as connection:
+            rows = connection.execute(query, (day,) if day else ()).fetchall()
+    except sqlite3.Error as ex:
+        logging.error(f'An error occurred while reading the usage ledger: {ex}')
+        return {}
+    return {model_name: {'requests': requests, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                         'dollars': round(dollars, 6)}
+            for model_name, requests, prompt_tokens, completion_tokens, dollars in rows}
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    '''
+    Return the ledger shared by all requests of the process, created on first use.
+    '''
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+        return _ledger
+
+
+def start_run(ledger_path=None):
+    '''
+    Start counting the spending of a new run (see UsageLedger.start_run).
+
+    Parameters:
+    - ledger_path (str, optional): Record the run in this ledger file from now on, e.g. a
+                                   scratch ledger for a benchmark against the mock server.
+    '''
+    global _ledger
+    if ledger_path is None:
+        get_ledger().start_run()
+        return
+    with _ledger_lock:
+        _ledger = UsageLedger(ledger_path)
@@ -1,17 +1,149 @@
-from settings import app_secrets
+import os
 
-# Personal Data
-RESULTS_EMAIL = app_secrets.RESULTS_EMAIL
-FIRST_NAME = app_secrets.FIRST_NAME
+# Personal data, the OpenAI key and the sender's credentials come from settings/app_secrets.py.
+# It is only imported when one of them is first read (see __getattr__ at the end), so runs that
+# need none of them, e.g. a resumed run that sends no email, start without it.
+_SECRET_NAMES = ('RESULTS_EMAIL', 'FIRST_NAME', 'OPENAI_API_KEY', 'SENDER_EMAIL', 'SENDER_EMAIL_PASSWORD')
+
+# Grading backend: 'openai', 'openai_compatible' (a self-hosted server) or 'local_rubric'
+GRADING_BACKEND = 'openai'
+OPENAI_COMPATIBLE_API_BASE = 'http://localhost:8000/v1'
+OPENAI_COMPATIBLE_API_KEY = ''
+OPENAI_COMPATIBLE_MODEL = 'llama-3-8b-instruct'
+# Score every submission with the local rubric first and keep grades below this share of the points
+PRESCREEN_WITH_LOCAL_RUBRIC = False
+PRESCREEN_ACCEPT_BELOW = 0.25
 
 # OpenAI data
-OPENAI_API_KEY = app_secrets.OPENAI_API_KEY
 ENGINE_NAME = 'gpt-4'
 BACKUP_ENGINE_NAME = 'gpt-3.5-turbo-16k'
 CHAT_COMPLETIONS_URL = 'https://api.openai.com/v1/chat/completions'
+# Point this at a local fake endpoint (e.g. benchmarks/mock_openai_server.py) for offline testing
+OPENAI_API_BASE = 'https://api.openai.com/v1'
+
+# OpenAI rate limits (per model, check your account's limits page)
+MODEL_RATE_LIMITS = {
+    'gpt-4': {'requests_per_minute': 200, 'tokens_per_minute': 10000},
+    'gpt-4-32k': {'requests_per_minute': 200, 'tokens_per_minute': 40000},
+    'gpt-3.5-turbo-16k': {'requests_per_minute': 3500, 'tokens_per_minute': 180000},
+}
+DEFAULT_RATE_LIMIT = {'requests_per_minute': 60, 'tokens_per_minute': 10000}
+EXPECTED_COMPLETION_TOKENS = 500
+
+# OpenAI model sizes and prices (dollars per 1K prompt and completion tokens)
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+}
+MODEL_PRICES_PER_1K_TOKENS = {
+    'gpt-4': (0.03, 0.06),
+    'gpt-4-32k': (0.06, 0.12),
+    'gpt-3.5-turbo': (0.0015, 0.002),
+    'gpt-3.5-turbo-16k': (0.003, 0.004),
+}
+# Usage ledger: the model and tokens of every request, and budget caps per run and per day (UTC).
+# None means no cap. Once a dollar cap is BUDGET_DOWNGRADE_SHARE used, requests go to
+# BUDGET_DOWNGRADE_MODEL; a request that would pass a cap is not sent, and the students left
+# are graded by a later run
+USAGE_LEDGER_PATH = os.path.join('settings', 'usage_ledger.sqlite3')
+BUDGET_MAX_RUN_TOKENS = None
+BUDGET_MAX_RUN_DOLLARS = None
+BUDGET_MAX_DAY_TOKENS = None
+BUDGET_MAX_DAY_DOLLARS = None
+BUDGET_DOWNGRADE_SHARE = 0.8
+BUDGET_DOWNGRADE_MODEL = 'gpt-3.5-turbo-16k'
+# Each student goes to the cheapest of these (plus the requested model) whose context fits
+ENABLE_MODEL_ROUTING = True
+ROUTING_MODELS = ['gpt-4', 'gpt-4-32k']
+RATE_LIMIT_MAX_RETRIES = 5
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+# Stream completions, so every request is bound by connect/read/total deadlines
+STREAM_COMPLETIONS = True
+# Stop reading a completion once its grade line is complete (the feedback after it is lost)
+STREAM_STOP_AFTER_GRADE = False
+REQUEST_CONNECT_TIMEOUT_SECONDS = 10
+REQUEST_READ_TIMEOUT_SECONDS = 60
+REQUEST_TOTAL_TIMEOUT_SECONDS = 180
+# Timed out requests are cancelled and sent again this many times
+TIMEOUT_MAX_RETRIES = 1
+# Batch API runs (--batch-api) trade latency for the batch quota
+BATCH_COMPLETION_WINDOW = '24h'
+BATCH_POLL_SECONDS = 60
+BATCH_MAX_WAIT_HOURS = 24
+BATCH_REQUEST_TIMEOUT_SECONDS = 120
 
 # Communication data
 SMTP_SERVER = 'smtp.gmail.com'
 SMTP_PORT = 587
-SENDER_EMAIL = app_secrets.SENDER_EMAIL
-SENDER_EMAIL_PASSWORD = app_secrets.SENDER_EMAIL_PASSWORD
+# Turn STARTTLS off (and clear the password) to send through a local test server
+SMTP_USE_STARTTLS = True
+SMTP_TIMEOUT_SECONDS = 30
+# Authenticated connections kept open and reused across emails
+SMTP_POOL_SIZE = 2
+SMTP_BACKOFF_BASE_SECONDS = 2
+# Larger classes get a summary email with the report attached as a .gz file instead of every grade inline
+EMAIL_INLINE_MAX_STUDENTS = 200
+
+# Grading data
+MAX_GRADING_WORKERS = 4
+# Number of batch jobs (sections) that feed the shared grading workers at the same time
+MAX_CONCURRENT_JOBS = 4
+# Larger files keep only their head and tail; larger submissions are cut short
+MAX_FILE_BYTES = 200000
+MAX_SUBMISSION_TOKENS = 30000
+# Students read ahead of the grading workers; reading waits for the oldest grade once this many are pending
+MAX_PENDING_GRADES = 64
+# Stream very large classes (--stream): scan folders lazily and keep grade responses on disk, not in memory
+STREAM_PIPELINE = False
+# Grade every section of the criteria with its own request, side by side, and merge the scores
+GRADE_BY_SECTION = False
+SECTION_MAX_RETRIES = 1
+# Independent gradings per student (--samples), asked for in one request and merged into the
+# median grade. Students whose sample scores spread over more than this share of the
+# maximum score are flagged for review
+CONSENSUS_SAMPLES = 1
+CONSENSUS_MAX_SPREAD = 0.1
+# Processes converting .xlsx, .docx, .pdf and .ipynb submissions to text; 1 converts them in the main process
+EXTRACTION_WORKERS = 2
+# Converted text is kept per file hash, so unchanged files are not parsed again
+USE_EXTRACTION_CACHE = True
+EXTRACTION_CACHE_PATH = os.path.join('settings', 'extraction_cache.sqlite3')
+EXTRACTION_CACHE_MAX_ENTRIES = 50000
+EXTRACTION_CACHE_MAX_AGE_DAYS = 30
+# Watch mode (--watch): seconds between scans, seconds a student's files must stay unchanged
+# before they are graded, and minutes between digest emails of the newly graded students
+WATCH_POLL_SECONDS = 30
+WATCH_DEBOUNCE_SECONDS = 60
+WATCH_DIGEST_MINUTES = 60
+# Threads listing student folders at the same time; raise it for slow network shares
+SCAN_WORKERS = 1
+
+# Duplicate submission data
+# Leave out starter files shared by many students and grade identical submissions once
+DEDUPLICATE_SUBMISSIONS = True
+# A file is starter code when at least this many students, and this share of the class, have it unchanged
+BOILERPLATE_MIN_STUDENTS = 5
+BOILERPLATE_MIN_SHARE = 0.5
+# Submissions at least this alike (estimated Jaccard similarity of word shingles) are flagged in the report
+SIMILARITY_THRESHOLD = 0.8
+MINHASH_SIZE = 64
+SHINGLE_WORDS = 5
+
+# Response cache data
+USE_RESPONSE_CACHE = True
+RESPONSE_CACHE_PATH = os.path.join('settings', 'response_cache.sqlite3')
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+RESPONSE_CACHE_MAX_AGE_DAYS = 30
+
+
+def __getattr__(name):
+    if name not in _SECRET_NAMES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    from settings import app_secrets
+    value = getattr(app_secrets, name)
+    # Later reads find the value directly, without calling __getattr__ again
+    globals()[name] = value
+    return value